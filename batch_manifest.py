@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+#Batch runner for URL files (-mf/-cf/-prf) with a JSON Lines manifest so interrupted runs can be resumed
+
+import json
+import os
+import time
+
+from termcolor import colored
+
+import url_utils
+
+
+def read_url_file(filepath):
+    #Blank lines and "#" comments are skipped, duplicates (after normalization) are only kept once
+    urls = []
+    seen = set()
+    with open(filepath, "r") as fileptr:
+        for line in fileptr:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            url = url_utils.normalize_url(line)
+            if url in seen:
+                continue
+            seen.add(url)
+            urls.append(url)
+    return urls
+
+
+class Manifest:
+    def __init__(self, filepath, resume=False):
+        self.filepath = filepath
+        self.records = {}
+        if resume and os.path.exists(filepath):
+            #Later lines win, so a URL retried on resume ends up with its latest status
+            with open(filepath, "r") as fileptr:
+                for line in fileptr:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.records[record["url"]] = record
+        folder = os.path.dirname(filepath)
+        if folder != "":
+            os.makedirs(folder, exist_ok=True)
+        self.fileptr = open(filepath, "a" if resume else "w")
+
+    def is_completed(self, url):
+        return self.records.get(url, {}).get("status") == "completed"
+
+    def record(self, url, status, files=(), error=None):
+        record = {
+            "url": url,
+            "status": status,
+            "files": len(files),
+            "bytes": sum(item["bytes"] for item in files),
+            "hashes": {item["path"]: item["sha256"] for item in files},
+            "error": error,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        self.records[url] = record
+        self.fileptr.write(json.dumps(record) + "\n")
+        self.fileptr.flush()
+        return record
+
+    def close(self):
+        self.fileptr.close()
+
+
+def run_batch(urls, download, manifest_path, resume=False, prepare=None):
+    #prepare is called once with the URLs that will actually be downloaded (Ex: to fetch their metadata in a few batched requests)
+    manifest = Manifest(manifest_path, resume=resume)
+    completed, failed, skipped = 0, 0, 0
+    try:
+        if prepare is not None:
+            prepare([url for url in urls if not (resume and manifest.is_completed(url))])
+        for url in urls:
+            if resume and manifest.is_completed(url):
+                skipped += 1
+                print(colored(f"\n[-] Skipped (already completed): {url}","light_grey"))
+                continue
+
+            print(colored(f"\n[-] {url}","cyan"))
+            try:
+                files = download(url) or []
+            except Exception as e:
+                failed += 1
+                manifest.record(url, "failed", error=f"{e.__class__.__name__}: {e}")
+                print(colored(f"[X] Failed: {url}: {e}","red"))
+                continue
+            completed += 1
+            manifest.record(url, "completed", files)
+    finally:
+        manifest.close()
+
+    print(colored(f"\n[*] Batch: {completed} completed, {failed} failed, {skipped} skipped (Manifest: {manifest_path})","cyan"))
+    return failed == 0
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+#Local stand-in for Gitlab, Github and Jira so the downloaders can be benchmarked without live hosts
+
+import argparse
+import base64
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+
+class FakeServerConfig:
+    def __init__(self, latency_ms=0, files=20, payload_kb=4, issues=50, mrs=10):
+        self.latency = latency_ms / 1000
+        self.files = files                   #Files per MR/commit/PR
+        self.payload_kb = payload_kb         #Approximate size of every file diff/blob
+        self.issues = issues                 #Issues in the fake epic
+        self.mrs = mrs                       #Distinct MRs linked from the epic's issues
+
+
+def synthetic_diff(seed, payload_kb):
+    lines = ["@@ -1,4 +1,5 @@ class Synthetic:\n"]
+    size = 0
+    i = 0
+    while size < payload_kb * 1024:
+        line = f" context line {seed} {i}\n" if i % 3 else f"+added line {seed} {i}\n"
+        if i % 7 == 0:
+            line = f"-removed line {seed} {i}\n"
+        lines.append(line)
+        size += len(line)
+        i += 1
+    return "".join(lines)
+
+
+def synthetic_sha(*parts):
+    return hashlib.sha1("/".join(str(part) for part in parts).encode()).hexdigest()
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"                #Keep-alive, like the real hosts
+    disable_nagle_algorithm = True
+    routes = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, obj, status=200, headers=None):
+        self.send_body(json.dumps(obj).encode(), "application/json", status, headers)
+
+    def send_body(self, body, content_type, status=200, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-AUSERNAME", "benchmark")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        start = time.perf_counter()
+        config = self.server.config
+        if config.latency:
+            time.sleep(config.latency)
+
+        parsed = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        for pattern, handler in self.routes:
+            match = pattern.search(parsed.path)
+            if match:
+                handler(self, config, query, *match.groups())
+                break
+        else:
+            self.send_json({"message": "404 Not Found"}, status=404)
+
+        with self.server.stats_lock:
+            self.server.request_times.append(time.perf_counter() - start)
+
+    def do_POST(self):
+        #Only the GraphQL endpoint (same path on both hosts)
+        start = time.perf_counter()
+        config = self.server.config
+        if config.latency:
+            time.sleep(config.latency)
+
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if urlparse(self.path).path == "/api/graphql":
+            self.graphql(config, body.get("query", ""))
+        else:
+            self.send_json({"message": "404 Not Found"}, status=404)
+
+        with self.server.stats_lock:
+            self.server.request_times.append(time.perf_counter() - start)
+
+    def graphql(self, config, query):
+        #Not a GraphQL server, it only recognizes the aliased queries built by graphql_batch
+        data = {}
+        for alias, owner, repo, number, first, after in GITHUB_PR_QUERY_RE.findall(query):
+            start = int(after or 0)
+            end = min(start + int(first), config.files)
+            nodes = [{"path": f"pr{number}/src/file{i}.py", "changeType": "MODIFIED"} for i in range(start, end)]
+            data[alias] = {"pr": {"headRefOid": synthetic_sha("pr-head", number),
+                                  "files": {"nodes": nodes, "pageInfo": {"hasNextPage": end < config.files, "endCursor": str(end)}}}}
+        for alias, project, iids in GITLAB_MR_QUERY_RE.findall(query):
+            nodes = []
+            for iid in json.loads(iids):
+                fields = self.gitlab_mr_fields(config, iid)
+                diff_refs = fields["diff_refs"]
+                nodes.append({"iid": str(iid), "state": fields["state"], "diffHeadSha": fields["sha"], "updatedAt": fields["updated_at"],
+                              "diffRefs": {"baseSha": diff_refs["base_sha"], "headSha": diff_refs["head_sha"], "startSha": diff_refs["start_sha"]},
+                              "diffStatsSummary": {"fileCount": config.files}})
+            data[alias] = {"id": f"gid://gitlab/Project/{GITLAB_PROJECT_ID}", "mergeRequests": {"nodes": nodes}}
+        self.send_json({"data": data})
+
+    #Gitlab
+    def gitlab_token(self, config, query):
+        self.send_json({"active": True, "scopes": ["api"]})
+
+    def gitlab_mr(self, config, query, project, iid):
+        self.send_json(self.gitlab_mr_fields(config, iid))
+
+    def gitlab_mr_fields(self, config, iid):
+        return {"iid": int(iid), "project_id": GITLAB_PROJECT_ID, "state": "merged", "changes_count": str(config.files), "source_branch": f"feature-{iid}", "sha": synthetic_sha("head", iid),
+                "updated_at": "2024-01-01T00:00:00.000Z",
+                "diff_refs": {"base_sha": synthetic_sha("base", iid), "head_sha": synthetic_sha("head", iid), "start_sha": synthetic_sha("base", iid)}}
+
+    def gitlab_project(self, config, query, project):
+        self.send_json({"id": GITLAB_PROJECT_ID, "path_with_namespace": unquote(project)})
+
+    def gitlab_mr_change(self, config, iid, i):
+        return {"old_path": f"mr{iid}/src/file{i}.py", "new_path": f"mr{iid}/src/file{i}.py",
+                "diff": synthetic_diff(f"{iid}-{i}", config.payload_kb)}
+
+    def gitlab_mr_changes(self, config, query, project, iid):
+        changes = [self.gitlab_mr_change(config, iid, i) for i in range(config.files)]
+        self.send_json(dict(self.gitlab_mr_fields(config, iid), changes=changes))
+
+    def gitlab_mr_diffs(self, config, query, project, iid):
+        per_page = int(query.get("per_page", 20))
+        page = int(query.get("page", 1))
+        last_page = max((config.files + per_page - 1) // per_page, 1)
+        headers = {"X-Total": str(config.files), "X-Total-Pages": str(last_page), "X-Next-Page": str(page + 1) if page < last_page else ""}
+        self.send_json([self.gitlab_mr_change(config, iid, i) for i in range((page - 1) * per_page, min(page * per_page, config.files))], headers=headers)
+
+    def gitlab_mr_raw_diffs(self, config, query, project, iid):
+        self.send_body(self.unified_diff(f"mr{iid}", config.files), "text/plain")
+
+    def gitlab_commit_diff(self, config, query, project, sha):
+        #Paginated like the real API, 20 files per page unless per_page says otherwise
+        per_page = int(query.get("per_page", 20))
+        page = int(query.get("page", 1))
+        last_page = max((config.files + per_page - 1) // per_page, 1)
+        headers = {"X-Total": str(config.files), "X-Total-Pages": str(last_page), "X-Next-Page": str(page + 1) if page < last_page else ""}
+        self.send_json([{"old_path": f"commit/src/file{i}.py", "new_path": f"commit/src/file{i}.py",
+                         "diff": synthetic_diff(f"{sha}-{i}", config.payload_kb)} for i in range((page - 1) * per_page, min(page * per_page, config.files))],
+                       headers=headers)
+
+    def gitlab_raw_file(self, config, query, project, path):
+        self.send_body(synthetic_diff(path, config.payload_kb).encode(), "text/plain")
+
+    #Github
+    def github_user(self, config, query):
+        self.send_json({"login": "benchmark"})
+
+    def github_pr_files(self, config, query, org, repo, number):
+        per_page = int(query.get("per_page", 30))
+        page = int(query.get("page", 1))
+        last_page = max((config.files + per_page - 1) // per_page, 1)
+        files = [{"filename": f"pr{number}/src/file{i}.py", "sha": synthetic_sha("blob", number, i), "status": "modified"}
+                 for i in range((page - 1) * per_page, min(page * per_page, config.files))]
+        link = f'<{self.base_url()}{urlparse(self.path).path}?per_page={per_page}&page={last_page}>; rel="last"'
+        self.send_json(files, headers={"Link": link})
+
+    #Github commits form one linear history: commit i is synthetic_sha("gh-commit", i) and its parent is commit i - 1
+    def github_commit_index(self, sha):
+        #Abbreviated SHAs resolve like on Github
+        if sha in self.server.github_commits:
+            return self.server.github_commits[sha]
+        return next((index for full_sha, index in self.server.github_commits.items() if full_sha.startswith(sha)), None)
+
+    def github_commit_json(self, index):
+        parents = [{"sha": synthetic_sha("gh-commit", index - 1)}] if index > 0 else []
+        return {"sha": synthetic_sha("gh-commit", index), "parents": parents}
+
+    def unified_diff(self, seed, count):
+        sections = []
+        for i in range(count):
+            path = f"{seed}/src/file{i}.py"
+            sections.append(f"diff --git a/{path} b/{path}\nindex 1111111..2222222 100644\n--- a/{path}\n+++ b/{path}\n")
+            sections.append(synthetic_diff(f"{seed}-{i}", self.server.config.payload_kb))
+        return "".join(sections).encode()
+
+    def github_commit(self, config, query, org, repo, sha):
+        index = self.github_commit_index(sha)
+        if index is None:
+            return self.send_json({"message": "No commit found for SHA"}, status=422)
+        if "diff" in self.headers.get("Accept", ""):
+            return self.send_body(self.unified_diff(f"commit{index}", config.files), "text/plain")
+        per_page = int(query.get("per_page", 300))
+        page = int(query.get("page", 1))
+        last_page = max((config.files + per_page - 1) // per_page, 1)
+        files = [{"filename": f"commit{index}/src/file{i}.py", "sha": synthetic_sha("blob", "commit", index, i), "status": "modified"}
+                 for i in range((page - 1) * per_page, min(page * per_page, config.files))]
+        link = f'<{self.base_url()}{urlparse(self.path).path}?per_page={per_page}&page={last_page}>; rel="last"'
+        self.send_json(dict(self.github_commit_json(index), files=files), headers={"Link": link})
+
+    def github_compare(self, config, query, org, repo, base, head):
+        base_index, head_index = self.github_commit_index(base), self.github_commit_index(head)
+        if base_index is None or head_index is None:
+            return self.send_json({"message": "Not Found"}, status=404)
+        if "diff" in self.headers.get("Accept", ""):
+            return self.send_body(self.unified_diff(f"compare{base_index}-{head_index}", config.files), "text/plain")
+        ahead = list(range(base_index + 1, head_index + 1))
+        status = "ahead" if ahead else ("identical" if base_index == head_index else "behind")
+        self.send_json({"status": status, "total_commits": len(ahead), "base_commit": self.github_commit_json(base_index),
+                        "commits": [self.github_commit_json(index) for index in ahead]})
+
+    def github_pr(self, config, query, org, repo, number):
+        if "diff" in self.headers.get("Accept", ""):
+            return self.send_body(self.unified_diff(f"pr{number}", config.files), "text/plain")
+        self.send_json({"number": int(number), "state": "open", "head": {"sha": synthetic_sha("pr-head", number)}})
+
+    def github_contents(self, config, query, org, repo, path):
+        self.send_body(synthetic_diff(f"{path}@{query.get('ref')}", config.payload_kb).encode(), "application/vnd.github.raw")
+
+    def github_blob(self, config, query, org, repo, sha):
+        content = synthetic_diff(sha, config.payload_kb).encode()
+        if "raw" in self.headers.get("Accept", ""):
+            self.send_body(content, "application/vnd.github.raw")
+        else:
+            self.send_json({"sha": sha, "encoding": "base64", "content": base64.encodebytes(content).decode()})
+
+    #Jira
+    def jira_server_info(self, config, query):
+        self.send_json({"baseUrl": self.base_url(), "version": "9.12.0", "versionNumbers": [9, 12, 0], "deploymentType": "Server"})
+
+    def jira_fields(self, config, query):
+        self.send_json([])
+
+    def jira_myself(self, config, query):
+        self.send_json({"name": "benchmark"})
+
+    def jira_mr_url(self, index):
+        return f"{self.base_url()}/group/project/-/merge_requests/{index % max(self.server.config.mrs, 1) + 1}"
+
+    def jira_issue_fields(self, index):
+        return {"summary": f"Issue {index}", "comment": {"total": 1, "maxResults": 1, "comments": [{"body": f"Linked a merge request|{self.jira_mr_url(index)}]"}]}}
+
+    def jira_search(self, config, query):
+        #Like Jira, a "key in (...)" naming an issue that does not exist rejects the whole query
+        missing = [key for key in re.findall(r"BENCH-(\d+)", query.get("jql", "")) if int(key) >= config.issues]
+        if missing:
+            self.send_json({"errorMessages": [f"An issue with key 'BENCH-{missing[0]}' does not exist for field 'key'."]}, status=400)
+            return
+        start_at = int(query.get("startAt", 0))
+        max_results = int(query.get("maxResults", 50))
+        issues = [{"id": str(JIRA_ISSUE_ID + i), "key": f"BENCH-{i}", "fields": self.jira_issue_fields(i)} for i in range(start_at, min(start_at + max_results, config.issues))]
+        self.send_json({"startAt": start_at, "maxResults": max_results, "total": config.issues, "issues": issues})
+
+    def jira_issue(self, config, query, key):
+        index = int(key.split("-")[-1])
+        if index >= config.issues:
+            self.send_json({"errorMessages": ["Issue does not exist or you do not have permission to see it."]}, status=404)
+            return
+        self.send_json({"id": str(JIRA_ISSUE_ID + index), "key": key, "fields": self.jira_issue_fields(index)})
+
+    def jira_remote_links(self, config, query, key):
+        index = int(key.split("-")[-1])
+        self.send_json([{"id": index, "object": {"url": self.jira_mr_url(index), "title": "GitLab: Mentioned on merge request"}}])
+
+    def jira_dev_status_summary(self, config, query):
+        self.send_json({"summary": {"pullrequest": {"overall": {"count": 1}, "byInstanceType": {"GitLab": {"count": 1, "name": "GitLab"}}}}})
+
+    def jira_dev_status_detail(self, config, query):
+        index = int(query["issueId"]) - JIRA_ISSUE_ID
+        self.send_json({"errors": [], "detail": [{"pullRequests": [{"url": self.jira_mr_url(index), "status": "MERGED"}]}]})
+
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+FakeHandler.routes = [(re.compile(pattern), handler) for pattern, handler in [
+    (r"^/api/v4/personal_access_tokens/self$", FakeHandler.gitlab_token),
+    (r"^/api/v4/projects/([^/]+)$", FakeHandler.gitlab_project),
+    (r"^/api/v4/projects/([^/]+)/merge_requests/(\d+)$", FakeHandler.gitlab_mr),
+    (r"^/api/v4/projects/([^/]+)/merge_requests/(\d+)/changes$", FakeHandler.gitlab_mr_changes),
+    (r"^/api/v4/projects/([^/]+)/merge_requests/(\d+)/diffs$", FakeHandler.gitlab_mr_diffs),
+    (r"^/api/v4/projects/([^/]+)/merge_requests/(\d+)/raw_diffs$", FakeHandler.gitlab_mr_raw_diffs),
+    (r"^/api/v4/projects/([^/]+)/repository/commits/([0-9a-f]+)/diff$", FakeHandler.gitlab_commit_diff),
+    (r"^/api/v4/projects/([^/]+)/repository/files/([^/]+)/raw$", FakeHandler.gitlab_raw_file),
+    (r"^/api/v3/user$", FakeHandler.github_user),
+    (r"^/api/v3/repos/([^/]+)/([^/]+)/pulls/(\d+)$", FakeHandler.github_pr),
+    (r"^/api/v3/repos/([^/]+)/([^/]+)/pulls/(\d+)/files$", FakeHandler.github_pr_files),
+    (r"^/api/v3/repos/([^/]+)/([^/]+)/git/blobs/([0-9a-f]+)$", FakeHandler.github_blob),
+    (r"^/api/v3/repos/([^/]+)/([^/]+)/contents/(.+)$", FakeHandler.github_contents),
+    (r"^/api/v3/repos/([^/]+)/([^/]+)/commits/([0-9a-f]+)$", FakeHandler.github_commit),
+    (r"^/api/v3/repos/([^/]+)/([^/]+)/compare/([0-9a-f]+)\.\.\.([0-9a-f]+)$", FakeHandler.github_compare),
+    (r"^/rest/api/\d+/serverInfo$", FakeHandler.jira_server_info),
+    (r"^/rest/api/\d+/field$", FakeHandler.jira_fields),
+    (r"^/rest/api/\d+/myself$", FakeHandler.jira_myself),
+    (r"^/rest/api/\d+/search$", FakeHandler.jira_search),
+    (r"^/rest/api/(?:\d+|latest)/issue/([A-Z]+-\d+)$", FakeHandler.jira_issue),
+    (r"^/rest/api/(?:\d+|latest)/issue/([A-Z]+-\d+)/remotelink$", FakeHandler.jira_remote_links),
+    (r"^/rest/dev-status/latest/issue/summary$", FakeHandler.jira_dev_status_summary),
+    (r"^/rest/dev-status/latest/issue/detail$", FakeHandler.jira_dev_status_detail),
+]]
+
+
+GITHUB_COMMITS = 1000                            #Length of the fake Github history
+GITHUB_PR_QUERY_RE = re.compile(r'(r\d+): repository\(owner: "([^"]+)", name: "([^"]+)"\) \{ pr: pullRequest\(number: (\d+)\) \{ headRefOid files\(first: (\d+)(?:, after: "([^"]*)")?\)')
+GITLAB_MR_QUERY_RE = re.compile(r'(p\d+): project\(fullPath: "([^"]+)"\) \{ id mergeRequests\(iids: (\[[^\]]*\])\)')
+GITLAB_PROJECT_ID = 4242                         #Numeric id of every fake Gitlab project
+JIRA_ISSUE_ID = 10000                            #Numeric id of BENCH-0, the other issues follow it
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, config, host="127.0.0.1", port=0):
+        super().__init__((host, port), FakeHandler)
+        self.config = config
+        self.stats_lock = threading.Lock()
+        self.request_times = []
+        self.github_commits = {synthetic_sha("gh-commit", index): index for index in range(GITHUB_COMMITS)}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def take_request_times(self):
+        with self.stats_lock:
+            request_times, self.request_times = self.request_times, []
+        return request_times
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p','--port',dest='port',type=int,default=8765,help="Port to listen on (Default: 8765)")
+    parser.add_argument('--latency',dest='latency',type=float,default=0,help="Artificial latency per request in ms")
+    parser.add_argument('--files',dest='files',type=int,default=20,help="Files per MR/commit/PR")
+    parser.add_argument('--payload-kb',dest='payload_kb',type=int,default=4,help="Size of every file diff/blob in KB")
+    parser.add_argument('--issues',dest='issues',type=int,default=50,help="Issues in the fake epic")
+    parser.add_argument('--mrs',dest='mrs',type=int,default=10,help="Distinct MRs linked from the epic")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    server = FakeServer(FakeServerConfig(args.latency, args.files, args.payload_kb, args.issues, args.mrs), port=args.port)
+    print(f"[-] Fake Gitlab/Github/Jira listening on {server.base_url}")
+    server.serve_forever()
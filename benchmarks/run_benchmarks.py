@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+#Drives the downloaders end to end against benchmarks/fake_server.py and reports throughput, latency, RSS and bytes written
+#Every scenario runs in its own child process so peak RSS is measured per scenario
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from termcolor import colored
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_server import FakeServer, FakeServerConfig, synthetic_sha
+
+SCENARIOS = ["mr", "mr_diff", "mr_batch", "mr_cli", "mr_server", "commit", "pr", "pr_diff", "pr_batch", "gh_commits", "epic", "epic_async"]
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s','--scenario',dest='scenarios',action='append',choices=SCENARIOS,help="Scenario to run, can be repeated (Default: all)")
+    parser.add_argument('-n','--urls',dest='urls',type=int,default=5,help="MR/commit/PR URLs per scenario (Default: 5)")
+    parser.add_argument('--latency',dest='latency',type=float,default=20,help="Artificial latency per request in ms (Default: 20)")
+    parser.add_argument('--files',dest='files',type=int,default=50,help="Files per MR/commit/PR (Default: 50)")
+    parser.add_argument('--payload-kb',dest='payload_kb',type=int,default=8,help="Size of every file diff/blob in KB (Default: 8)")
+    parser.add_argument('--issues',dest='issues',type=int,default=100,help="Issues in the fake epic (Default: 100)")
+    parser.add_argument('--mrs',dest='mrs',type=int,default=10,help="Distinct MRs linked from the epic (Default: 10)")
+    parser.add_argument('--json',dest='json_output',help="Also write the results to this JSON file")
+    #Internal: used by the parent process to run a single scenario in a child
+    parser.add_argument('--child',dest='child',help=argparse.SUPPRESS)
+    parser.add_argument('--base-url',dest='base_url',help=argparse.SUPPRESS)
+    parser.add_argument('--output-dir',dest='output_dir',help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def load_script(filename, module_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(REPO_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_mr(args):
+    gitlab = load_script("gitlab-merge-commits-downloader.py", "gitlab_merge_commits_downloader")
+    gitlab.GITLAB_API_TOKEN = "benchmark"
+    gitlab.DOWNLOAD_COMPLETE_FILE = False
+    for i in range(args.urls):
+        gitlab.Download_Code_From_MR(f"{args.base_url}/group/project/-/merge_requests/{i + 1}")
+
+
+def run_mr_diff(args):
+    gitlab = load_script("gitlab-merge-commits-downloader.py", "gitlab_merge_commits_downloader")
+    gitlab.GITLAB_API_TOKEN = "benchmark"
+    for i in range(args.urls):
+        gitlab.Download_Diff_From_MR(f"{args.base_url}/group/project/-/merge_requests/{i + 1}")
+
+
+def run_mr_batch(args):
+    #The -mf path, MR metadata comes from batched GraphQL queries
+    gitlab = load_script("gitlab-merge-commits-downloader.py", "gitlab_merge_commits_downloader")
+    gitlab.GITLAB_API_TOKEN = "benchmark"
+    gitlab.DOWNLOAD_COMPLETE_FILE = False
+    urls = [f"{args.base_url}/group/project/-/merge_requests/{i + 1}" for i in range(args.urls)]
+    gitlab.Download_MR_File_Urls(urls, os.path.join(args.output_dir, "mrs.manifest.jsonl"))
+
+
+def gitlab_cli_command(args, index, *extra):
+    return [sys.executable, os.path.join(REPO_DIR, "gitlab-merge-commits-downloader.py"), "--no-cache",
+            "-mu", f"{args.base_url}/group/project/-/merge_requests/{index + 1}", *extra]
+
+
+def run_mr_cli(args):
+    #One fresh process per MR, like CI jobs calling the script
+    for i in range(args.urls):
+        subprocess.run(gitlab_cli_command(args, i), check=True, stdout=subprocess.DEVNULL, env=dict(os.environ, GITLAB_API_TOKEN="benchmark"))
+
+
+def setup_mr_server(args):
+    #Started before the clock, the server is already running when the CI jobs come
+    args.server_socket = os.path.join(args.output_dir, "server.sock")
+    server = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "download_server.py"), "-l", args.server_socket], stdout=subprocess.DEVNULL)
+    while not os.path.exists(args.server_socket):
+        time.sleep(0.05)
+    return server
+
+
+def run_mr_server(args):
+    #Same jobs as mr_cli, through thin clients of a warm download_server.py
+    for i in range(args.urls):
+        subprocess.run(gitlab_cli_command(args, i, "--server", args.server_socket), check=True, stdout=subprocess.DEVNULL,
+                       env=dict(os.environ, GITLAB_API_TOKEN="benchmark"))
+
+
+def run_commit(args):
+    gitlab = load_script("gitlab-merge-commits-downloader.py", "gitlab_merge_commits_downloader")
+    gitlab.GITLAB_API_TOKEN = "benchmark"
+    gitlab.DOWNLOAD_COMPLETE_FILE = False
+    for i in range(args.urls):
+        gitlab.Download_Code_From_Commit_Url(f"{args.base_url}/group/project/-/commit/{synthetic_sha('commit', i)}")
+
+
+def run_pr(args):
+    github = load_script("github-pr-commits-downloader.py", "github_pr_commits_downloader")
+    github.GITHUB_API_TOKEN = "benchmark"
+    github.DOWNLOAD_COMPLETE_FILE = False
+    for i in range(args.urls):
+        github.download_code_from_pr_url(f"{args.base_url}/org/repo/pull/{i + 1}")
+
+
+def run_pr_diff(args):
+    github = load_script("github-pr-commits-downloader.py", "github_pr_commits_downloader")
+    github.GITHUB_API_TOKEN = "benchmark"
+    for i in range(args.urls):
+        github.download_diff_from_pr_url(f"{args.base_url}/org/repo/pull/{i + 1}")
+
+
+def run_pr_batch(args):
+    #The -prf path, PR file lists come from batched GraphQL queries
+    github = load_script("github-pr-commits-downloader.py", "github_pr_commits_downloader")
+    github.GITHUB_API_TOKEN = "benchmark"
+    github.DOWNLOAD_COMPLETE_FILE = False
+    urls = [f"{args.base_url}/org/repo/pull/{i + 1}" for i in range(args.urls)]
+    github.download_pr_file_urls(urls, os.path.join(args.output_dir, "prs.manifest.jsonl"))
+
+
+def run_gh_commits(args):
+    #A run of contiguous commits from one repo, the -cf path turns it into one compare diff
+    github = load_script("github-pr-commits-downloader.py", "github_pr_commits_downloader")
+    github.GITHUB_API_TOKEN = "benchmark"
+    github.DOWNLOAD_COMPLETE_FILE = False
+    urls = [f"{args.base_url}/org/repo/commit/{synthetic_sha('gh-commit', i + 1)}" for i in range(args.urls)]
+    github.download_commit_file_urls(urls, os.path.join(args.output_dir, "commits.manifest.jsonl"))
+
+
+def run_epic(args):
+    jira_script = load_script("jira-epic-mr-downloader.py", "jira_epic_mr_downloader")
+    jira_script.GITLAB_API_TOKEN = "benchmark"
+    jira_script.JIRA_API_TOKEN = "benchmark"
+    jira_script.JIRA_BASE_URL = args.base_url
+    jira = jira_script.Get_Jira_Object(args.base_url)
+    jira_script.Get_All_Issues_From_Epic(jira, f"{args.base_url}/browse/BENCH-EPIC")
+
+
+def run_epic_async(args):
+    import asyncio
+    jira_script = load_script("jira-epic-mr-downloader.py", "jira_epic_mr_downloader")
+    asyncio.run(jira_script.Async_Get_All_Issues_From_Epic(args.base_url, "benchmark", "benchmark", f"{args.base_url}/browse/BENCH-EPIC"))
+
+
+def run_child(args):
+    import http_client
+    http_client.configure(cache_dir=None)
+
+    os.chdir(args.output_dir)
+    setup = globals().get(f"setup_{args.child}")
+    background = setup(args) if setup else None
+    try:
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            globals()[f"run_{args.child}"](args)
+        wall = time.perf_counter() - start
+    finally:
+        if background is not None:
+            background.terminate()
+            background.wait()
+
+    files, bytes_written = 0, 0
+    for root, _, filenames in os.walk(args.output_dir):
+        for filename in filenames:
+            files += 1
+            bytes_written += os.path.getsize(os.path.join(root, filename))
+
+    #ru_maxrss is in KB on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"wall": wall, "files": files, "bytes": bytes_written, "peak_rss_mb": peak_rss_mb}))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def run_scenario(args, server, scenario):
+    with tempfile.TemporaryDirectory(prefix=f"bench-{scenario}-") as output_dir:
+        command = [sys.executable, os.path.abspath(__file__), "--child", scenario, "--base-url", server.base_url,
+                   "--output-dir", output_dir, "--urls", str(args.urls)]
+        server.take_request_times()
+        completed = subprocess.run(command, capture_output=True, text=True)
+        request_times = server.take_request_times()
+        if completed.returncode != 0:
+            print(colored(f"[X] Scenario {scenario} failed:\n{completed.stderr}","red"))
+            return None
+
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result.update({
+        "scenario": scenario,
+        "requests": len(request_times),
+        "p50_ms": percentile(request_times, 50) * 1000,
+        "p99_ms": percentile(request_times, 99) * 1000,
+        "files_per_s": result["files"] / result["wall"] if result["wall"] else 0,
+        "mb_per_s": result["bytes"] / 1024 / 1024 / result["wall"] if result["wall"] else 0,
+    })
+    return result
+
+
+def print_report(results):
+    header = f"{'scenario':<12}{'wall s':>9}{'requests':>10}{'p50 ms':>9}{'p99 ms':>9}{'files':>8}{'files/s':>10}{'MB/s':>8}{'MB written':>12}{'peak RSS MB':>13}"
+    print(colored(header,"cyan"))
+    for r in results:
+        print(f"{r['scenario']:<12}{r['wall']:>9.2f}{r['requests']:>10}{r['p50_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['files']:>8}"
+              f"{r['files_per_s']:>10.1f}{r['mb_per_s']:>8.2f}{r['bytes'] / 1024 / 1024:>12.2f}{r['peak_rss_mb']:>13.1f}")
+
+
+def main():
+    args = get_args()
+    if args.child:
+        run_child(args)
+        return
+
+    config = FakeServerConfig(args.latency, args.files, args.payload_kb, args.issues, args.mrs)
+    server = FakeServer(config).start()
+    print(colored(f"[-] Fake server on {server.base_url} (latency {args.latency}ms, {args.files} files x {args.payload_kb}KB)","magenta"))
+
+    results = []
+    for scenario in args.scenarios or SCENARIOS:
+        print(colored(f"[*] Running {scenario}","yellow"))
+        result = run_scenario(args, server, scenario)
+        if result:
+            results.append(result)
+    server.shutdown()
+
+    print()
+    print_report(results)
+    if args.json_output:
+        with open(args.json_output, "w") as fileptr:
+            json.dump(results, fileptr, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+#Content-addressed output: every file version is stored once under objects/<sha256>, index files map MRs/issues to them
+
+import json
+import os
+import re
+import tempfile
+
+import diff_utils
+
+
+class ContentStore:
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.index_dir = os.path.join(root, "index")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.objects_written = 0
+        self.objects_reused = 0
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256[2:])
+
+    def put_diff(self, diff, keep_removed=True):
+        #Written once to a temp file while hashing, then moved into place (or dropped if that version already exists)
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, prefix=".tmp-")
+        os.close(fd)
+        try:
+            written = diff_utils.write_diff_file(tmp_path, diff, keep_removed=keep_removed)
+            object_path = self.object_path(written["sha256"])
+            if os.path.exists(object_path):
+                self.objects_reused += 1
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.replace(tmp_path, object_path)
+                self.objects_written += 1
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        written["path"] = object_path
+        return written
+
+    @staticmethod
+    def index_name(url_or_key):
+        #https://gitlab.host.com/group/project/-/merge_requests/177 -> gitlab.host.com_group_project_-_merge_requests_177
+        return re.sub(r"[^A-Za-z0-9.-]+", "_", re.sub(r"^\w+://", "", url_or_key)).strip("_")
+
+    def write_index(self, kind, name, data):
+        folder = os.path.join(self.index_dir, kind)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"{self.index_name(name)}.json"), "w") as fileptr:
+            json.dump(data, fileptr, indent=2, sort_keys=True)
+
+    def write_indexes(self, issue_mrs, mr_issues, mr_files):
+        #index/mrs/<mr>.json: {url, issues, files: {path: sha256}}, index/issues/<key>.json: {issue, merge_requests}
+        for mr_url, files in mr_files.items():
+            self.write_index("mrs", mr_url, {"url": mr_url, "issues": mr_issues.get(mr_url, []), "files": files})
+        for issue_key, mr_urls in issue_mrs.items():
+            self.write_index("issues", issue_key, {"issue": issue_key, "merge_requests": mr_urls})
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+#Turns API diffs into readable files in a single pass, shared by the downloader scripts
+
+import hashlib
+import io
+import os
+import re
+
+import profiler
+
+
+#Matches "@@ -12,7 +12,9 @@ " as well as single line hunks like "@@ -3 +3 @@ " and headers without function context ("@@ -1,3 +1,4 @@")
+HUNK_HEADER_RE = re.compile(r'^@@ -\d+(?:,\d+)? \+\d+(?:,\d+)? @@(?: |$)')
+
+
+def beautify_lines(lines, keep_removed=True):
+    for line in lines:
+        if line.startswith("+"):
+            yield line[1:]
+        elif line.startswith("-"):
+            if keep_removed:
+                yield line[1:]
+        else:
+            match = HUNK_HEADER_RE.match(line)
+            if match is None:
+                yield line
+            elif line[match.end():].strip():
+                yield line[match.end():]            #The function context Git puts after the header, a bare header is dropped
+
+
+def write_diff_file(filepath, diff, keep_removed=True):
+    folder = os.path.dirname(filepath)
+    if folder != "":
+        os.makedirs(folder, exist_ok=True)
+
+    #newline=None gives the same \r\n handling as reading the raw diff back from disk used to
+    #diff can also be an iterable of lines (Ex: hunks from iter_file_diffs)
+    lines = io.StringIO(diff, newline=None) if isinstance(diff, str) else diff
+    sha256 = hashlib.sha256()
+    written = 0
+    with profiler.span("write", "diff file", path=filepath) as span_args, open(filepath, "wb") as fileptr:
+        for line in beautify_lines(lines, keep_removed):
+            data = line.encode("utf-8")
+            sha256.update(data)
+            fileptr.write(data)
+            written += len(data)
+        span_args["bytes"] = written
+    return {"path": filepath, "bytes": written, "sha256": sha256.hexdigest()}
+
+
+DIFF_GIT_RE = re.compile(r'^diff --git "?a/(.*?)"? "?b/(.*?)"?$')
+
+
+def parse_diff_path(path, prefix):
+    #"+++ b/new file.txt\t" -> "new file.txt", "/dev/null" -> None
+    path = path.rstrip("\r\n\t")
+    if len(path) > 1 and path.startswith('"') and path.endswith('"'):
+        path = path[1:-1]
+    if path == "/dev/null":
+        return None
+    return path[len(prefix):] if path.startswith(prefix) else path
+
+
+def iter_file_diffs(lines):
+    #Splits a "git diff" style stream on "diff --git" boundaries into (change, hunk_lines) per file
+    #change mirrors the Gitlab API fields (old_path, new_path, new_file, deleted_file, renamed_file)
+    change, hunks, in_header = None, [], False
+    for line in lines:
+        if line.startswith("diff --git "):
+            if change is not None:
+                yield change, hunks
+            match = DIFF_GIT_RE.match(line.rstrip("\r\n"))
+            old_path, new_path = match.groups() if match else (None, None)
+            change = {"old_path": old_path, "new_path": new_path, "new_file": False, "deleted_file": False, "renamed_file": False}
+            hunks, in_header = [], True
+        elif change is None:
+            continue
+        elif in_header and not line.startswith("@@"):
+            if line.startswith("--- "):
+                change["old_path"] = parse_diff_path(line[4:], "a/") or change["old_path"]
+            elif line.startswith("+++ "):
+                change["new_path"] = parse_diff_path(line[4:], "b/") or change["new_path"]
+            elif line.startswith("new file mode"):
+                change["new_file"] = True
+            elif line.startswith("deleted file mode"):
+                change["deleted_file"] = True
+            elif line.startswith("rename from "):
+                change["old_path"], change["renamed_file"] = parse_diff_path(line[12:], ""), True
+            elif line.startswith("rename to "):
+                change["new_path"], change["renamed_file"] = parse_diff_path(line[10:], ""), True
+        else:
+            in_header = False
+            hunks.append(line)
+    if change is not None:
+        yield change, hunks
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+
+#Long-running server for the downloader scripts: CI jobs and review bots send the command line they would have run
+#(--server on any script) and skip the Python startup, imports, token checks and TLS handshakes of a fresh process.
+#The HTTP session, response cache and verified tokens stay warm between jobs, identical jobs sent while one is
+#running share its run, and the output is streamed back as NDJSON events while the job prints it.
+#
+#   POST /jobs {"script": "gitlab", "argv": ["-mu", "<url>"], "cwd": "/ci/workspace", "env": {"GITLAB_API_TOKEN": "..."}}
+#   -> {"event": "output", "text": "..."} ... {"event": "exit", "code": 0}
+#   GET /status -> running/queued jobs and counters
+#
+#Over TCP every request carries "Authorization: Bearer <secret>", the secret shared through MR_DOWNLOADER_SERVER_SECRET
+
+import argparse
+import hashlib
+import hmac
+import http.client
+import importlib.util
+import io
+import json
+import os
+import re
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from termcolor import colored
+
+import http_cache
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS = {"gitlab": "gitlab-merge-commits-downloader.py", "github": "github-pr-commits-downloader.py", "jira": "jira-epic-mr-downloader.py"}
+DEFAULT_ADDRESS = os.path.join(http_cache.CACHE_DIR, "server.sock")
+FORWARDED_ENV = ["GITLAB_API_TOKEN", "GITHUB_API_TOKEN", "JIRA_API_TOKEN"]
+WARM_IMPORTS = ["jira", "aiohttp"]                  #Slow optional imports of the scripts, paid once at startup
+TCP_ADDRESS_RE = re.compile(r"^(?P<host>[\w.\-]*):(?P<port>\d+)$")
+TOKEN_FLAGS = {"-t", "--token", "-gt", "--gittoken", "-jt", "--jiratoken"}
+SECRET_ENV = "MR_DOWNLOADER_SERVER_SECRET"          #Shared secret of TCP servers and their clients, never on the command line
+CACHE_DIR = http_cache.CACHE_DIR                    #Cache of every job (-c/--cache-dir), whatever --cache-dir the client sent
+
+_JOBS = {}                                          #job key -> Job, only while the job is queued or running
+_JOBS_LOCK = threading.Lock()
+#Jobs run one at a time: the scripts chdir into their results folder and keep their settings in module globals,
+#the parallelism stays inside every job (worker pools, async engine)
+_RUN_LOCK = threading.Lock()
+STATS = {"started": time.time(), "completed": 0, "joined": 0}
+
+
+def parse_address(address):
+    #"host:port" or ":port" -> TCP (127.0.0.1 by default), anything else is the path of a Unix socket
+    match = TCP_ADDRESS_RE.match(address)
+    if match:
+        return match.group("host") or "127.0.0.1", int(match.group("port"))
+    return os.path.abspath(os.path.expanduser(address))
+
+
+def job_argv(argv):
+    #The command line without the --server that sent it, so the job does not send itself again
+    stripped, skip_value = [], False
+    for index, arg in enumerate(argv):
+        if skip_value:
+            skip_value = False
+        elif arg == "--server":
+            skip_value = index + 1 < len(argv) and not argv[index + 1].startswith("-")
+        elif not arg.startswith("--server="):
+            stripped.append(arg)
+    return stripped
+
+
+def server_argv(argv):
+    #The jobs share the server's cache: a --cache-dir of the client would be resolved against its own folder,
+    #giving every workspace a separate (cold) cache
+    stripped, skip_value = [], False
+    for arg in argv:
+        if skip_value:
+            skip_value = False
+        elif arg == "--cache-dir":
+            skip_value = True
+        elif not arg.startswith("--cache-dir="):
+            stripped.append(arg)
+    return stripped + ["--cache-dir", CACHE_DIR]
+
+
+def display_argv(argv):
+    #For the server log and /status, tokens given on the command line are masked
+    return " ".join("***" if index and argv[index - 1] in TOKEN_FLAGS else arg for index, arg in enumerate(argv))
+
+
+def job_key(request):
+    #Same script, arguments, folder and tokens -> same job
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+class Job:
+    def __init__(self, key, request):
+        self.key = key
+        self.request = request
+        self.state = "queued"
+        self.followers = 0
+        self.chunks = []                            #Everything the job printed, replayed to followers joining late
+        self.code = None
+        self.condition = threading.Condition()
+
+    def write(self, text):
+        with self.condition:
+            self.chunks.append(text)
+            self.condition.notify_all()
+
+    def finish(self, code):
+        with self.condition:
+            self.code = code
+            self.condition.notify_all()
+
+    def follow(self):
+        #Yields the events of the job from its start, blocks until there is more output or it exits
+        index = 0
+        while True:
+            with self.condition:
+                while index == len(self.chunks) and self.code is None:
+                    self.condition.wait()
+                chunks, code = self.chunks[index:], self.code
+                index += len(chunks)
+            if chunks:
+                yield {"event": "output", "text": "".join(chunks)}
+            if code is not None:
+                yield {"event": "exit", "code": code}
+                return
+
+
+class JobOutput(io.TextIOBase):
+    #sys.stdout/sys.stderr of a running job, also for the worker threads it starts
+    def __init__(self, job):
+        self.job = job
+
+    def write(self, text):
+        self.job.write(text)
+        return len(text)
+
+    def isatty(self):
+        return False
+
+
+def load_script(script):
+    #A fresh module per job so no global of an earlier job leaks in, the modules it imports (http_client,
+    #metadata_cache, jira...) are shared and keep their state
+    spec = importlib.util.spec_from_file_location(f"{script}_job", os.path.join(SCRIPT_DIR, SCRIPTS[script]))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def reset_run_state():
+    #Counters printed at the end of a run only cover that run
+    import graphql_batch
+    import http_client
+    import profiler
+    http_client.reset_stats()
+    graphql_batch.reset_stats()
+    profiler.reset()
+
+
+def execute(request, output):
+    #Runs the script's main() like the command line would, returns its exit code
+    saved_cwd, saved_argv, saved_stdout, saved_stderr = os.getcwd(), sys.argv, sys.stdout, sys.stderr
+    saved_env = {name: os.environ.get(name) for name in FORWARDED_ENV}
+    sys.stdout = sys.stderr = output
+    try:
+        module = load_script(request["script"])
+        os.chdir(request["cwd"])
+        for name in FORWARDED_ENV:
+            #Only the tokens of the client, never the server's own
+            if name in request["env"]:
+                os.environ[name] = request["env"][name]
+            else:
+                os.environ.pop(name, None)
+        sys.argv = [module.__file__] + request["argv"]
+        reset_run_state()
+        module.main()
+        return 0
+    except SystemExit as e:
+        if isinstance(e.code, str):
+            print(e.code)                           #exit(colored("[-] Error: ...")) of the scripts
+            return 1
+        return e.code or 0
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stdout, sys.stderr, sys.argv = saved_stdout, saved_stderr, saved_argv
+        os.chdir(saved_cwd)
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def run_job(job):
+    with _RUN_LOCK:
+        job.state = "running"
+        log(f"[-] Job {job.key[:12]}: {job.request['script']} {display_argv(job.request['argv'])}")
+        start = time.perf_counter()
+        code = execute(job.request, JobOutput(job))
+    with _JOBS_LOCK:
+        _JOBS.pop(job.key, None)
+        STATS["completed"] += 1
+    job.finish(code)
+    log(f"[-] Job {job.key[:12]} exited with {code} after {time.perf_counter() - start:.1f}s")
+
+
+def submit_job(request):
+    #Returns (job, joined), joined when an identical job was already queued or running
+    key = job_key(request)
+    with _JOBS_LOCK:
+        job = _JOBS.get(key)
+        joined = job is not None
+        if joined:
+            STATS["joined"] += 1
+        else:
+            job = _JOBS[key] = Job(key, request)
+            threading.Thread(target=run_job, args=(job,), daemon=True).start()
+        job.followers += 1
+    return job, joined
+
+
+def validate_request(request):
+    if not isinstance(request, dict) or request.get("script") not in SCRIPTS:
+        raise ValueError(f"script should be one of: {', '.join(SCRIPTS)}")
+    if not isinstance(request.get("argv"), list) or not all(isinstance(arg, str) for arg in request["argv"]):
+        raise ValueError("argv should be a list of strings")
+    if not isinstance(request.get("cwd"), str) or not os.path.isdir(request["cwd"]):
+        raise ValueError("cwd should be an existing folder")
+    env = request.get("env") or {}
+    if not isinstance(env, dict) or set(env) - set(FORWARDED_ENV) or not all(isinstance(value, str) for value in env.values()):
+        raise ValueError(f"env can only hold: {', '.join(FORWARDED_ENV)}")
+    return {"script": request["script"], "argv": server_argv(request["argv"]), "cwd": request["cwd"], "env": env}
+
+
+def status():
+    with _JOBS_LOCK:
+        jobs = [{"job": job.key[:12], "script": job.request["script"], "argv": display_argv(job.request["argv"]), "state": job.state,
+                 "followers": job.followers} for job in _JOBS.values()]
+    return {"pid": os.getpid(), "uptime": round(time.time() - STATS["started"]), "jobs": jobs,
+            "completed": STATS["completed"], "joined": STATS["joined"]}
+
+
+def log(message):
+    #The server's own messages, sys.stdout belongs to the running job
+    print(colored(message,"light_magenta"), file=sys.__stdout__, flush=True)
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        #Unix sockets are protected by their file mode, TCP servers ask for the shared secret
+        if self.server.secret is None:
+            return True
+        if hmac.compare_digest(self.headers.get("Authorization", "").encode(), f"Bearer {self.server.secret}".encode()):
+            return True
+        self.send_json({"error": f"Unauthorized, the client needs the server's secret in {SECRET_ENV}"}, status=401)
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path == "/status":
+            self.send_json(status())
+        else:
+            self.send_json({"error": "Not Found"}, status=404)
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.path != "/jobs":
+            self.send_json({"error": "Not Found"}, status=404)
+            return
+        try:
+            request = validate_request(json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0)))))
+        except ValueError as e:                     #json.JSONDecodeError included
+            self.send_json({"error": str(e)}, status=400)
+            return
+
+        job, joined = submit_job(request)
+        #HTTP/1.0 without Content-Length: the body is the stream of events until the connection closes
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        try:
+            if joined:
+                self.write_event({"event": "joined", "job": job.key[:12]})
+            for event in job.follow():
+                self.write_event(event)
+        except (BrokenPipeError, ConnectionResetError):
+            pass                                    #Client gone, the job still runs for the other followers
+        finally:
+            with _JOBS_LOCK:
+                job.followers -= 1
+
+    def write_event(self, event):
+        self.wfile.write((json.dumps(event) + "\n").encode())
+        self.wfile.flush()
+
+
+class TCPJobServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, secret):
+        super().__init__(address, handler)
+        self.secret = secret
+
+
+class UnixJobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    bound = False
+    secret = None
+
+    def server_bind(self):
+        #A socket file left by a server that did not shut down cleanly is replaced, a live server is not
+        if os.path.exists(self.server_address):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.server_address)
+                raise OSError(f"A server is already listening on {self.server_address}")
+            except ConnectionRefusedError:
+                os.remove(self.server_address)
+            finally:
+                probe.close()
+        os.makedirs(os.path.dirname(self.server_address), exist_ok=True)
+        #The jobs carry the tokens of the clients: the socket is created 0600, not chmod'ed after bind() when others could already connect
+        saved_umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(saved_umask)
+        self.bound = True
+
+    def server_close(self):
+        super().server_close()
+        if self.bound and os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def make_server(address, secret=None):
+    target = parse_address(address)
+    return TCPJobServer(target, JobHandler, secret) if isinstance(target, tuple) else UnixJobServer(target, JobHandler)
+
+
+def warm_up():
+    #Imports every script (and the slow optional libraries) once, so the first job does not pay for them
+    for script in SCRIPTS:
+        load_script(script)
+    for module_name in WARM_IMPORTS:
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def connect(address):
+    target = parse_address(address)
+    return http.client.HTTPConnection(*target) if isinstance(target, tuple) else UnixHTTPConnection(target)
+
+
+def submit(address, script, argv):
+    #Thin client behind --server: sends the command line, prints the job's output as it comes
+    #Returns the job's exit code, None when no server answers (the caller then runs the job itself)
+    request = {"script": script, "argv": job_argv(argv), "cwd": os.getcwd(),
+               "env": {name: os.environ[name] for name in FORWARDED_ENV if name in os.environ}}
+    headers = {"Content-Type": "application/json"}
+    if os.environ.get(SECRET_ENV):
+        headers["Authorization"] = f"Bearer {os.environ[SECRET_ENV]}"
+    connection = connect(address)
+    try:
+        connection.request("POST", "/jobs", body=json.dumps(request), headers=headers)
+        response = connection.getresponse()
+    except OSError:
+        connection.close()
+        return None
+
+    try:
+        if response.status != 200:
+            print(colored(f"[X] Download server refused the job: {response.status} {response.read().decode(errors='replace')}","red"))
+            return 1
+        for line in response:
+            event = json.loads(line)
+            if event["event"] == "output":
+                sys.stdout.write(event["text"])
+                sys.stdout.flush()
+            elif event["event"] == "joined":
+                print(colored(f"[-] Same job already running on the server ({event['job']}), following its output","light_magenta"))
+            elif event["event"] == "exit":
+                return event["code"]
+        print(colored("[X] Download server closed the connection before the job finished","red"))
+        return 1
+    finally:
+        connection.close()
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l','--listen',dest='address',default=DEFAULT_ADDRESS,help=f"Unix socket path, or host:port for TCP (Default: {DEFAULT_ADDRESS})")
+    parser.add_argument('-c','--cache-dir',dest='cache_dir',default=CACHE_DIR,help=f"HTTP response and metadata cache shared by all jobs (Default: {CACHE_DIR})")
+    parser.add_argument('--no-warm-up',action="store_false",dest='warm_up',help="Do not import the scripts and their libraries at startup",default=True)
+    return parser.parse_args()
+
+
+def main():
+    global CACHE_DIR
+    args = get_args()
+    CACHE_DIR = os.path.abspath(os.path.expanduser(args.cache_dir))
+    target = parse_address(args.address)
+    secret = None
+    if isinstance(target, tuple):
+        #Any local user (or anyone on the network) can reach a TCP port, and a job writes files wherever the server can
+        secret = os.environ.get(SECRET_ENV)
+        if not secret:
+            exit(colored(f"[X] A TCP server needs a shared secret in {SECRET_ENV} (clients send the same one), or use a Unix socket","red"))
+        if target[0] not in ("127.0.0.1", "localhost", "::1"):
+            print(colored(f"[!] Listening on {target[0]}: the jobs and their API tokens travel unencrypted","yellow"))
+    if args.warm_up:
+        warm_up()
+    try:
+        server = make_server(args.address, secret)
+    except OSError as e:
+        exit(colored(f"[X] Cannot listen on {args.address}: {e}","red"))
+    log(f"[-] Download server listening on {args.address} (pid {os.getpid()})")
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))        #Stopped by systemd/kill: the socket file is still removed
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+#Local blobless mirrors of Gitlab projects, used instead of the API for MRs/commits that are too large for it
+#A mirror is kept per project and reused, so later MRs from the same project only fetch the missing objects
+
+import base64
+import hashlib
+import os
+import threading
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import diff_utils
+import http_cache
+import profiler
+
+
+MIRROR_DIR = os.path.join(http_cache.CACHE_DIR, "mirrors")
+MIRROR_THRESHOLD = 500                          #Changed files above which the mirror is used instead of the API
+
+_MIRRORS = {}
+_MIRRORS_LOCK = threading.Lock()
+_FETCH_LOCKS = defaultdict(threading.Lock)      #git does not like two fetches into the same repo at once
+
+
+def needs_mirror_for_count(mr_json, threshold=MIRROR_THRESHOLD):
+    #Decided from the MR metadata alone, before any diff is fetched
+    #changes_count is a string, and "1000+" once Gitlab stops counting
+    changes_count = str(mr_json.get("changes_count") or "0")
+    return changes_count.endswith("+") or int(changes_count) >= threshold
+
+
+def get_project_path(web_url):
+    #https://gitlab.host.com/group/subgroup/project/-/merge_requests/177 -> group/subgroup/project
+    return urlparse(web_url).path.split("/-/")[0].strip("/")
+
+
+def get_mirror(web_url, token, mirror_dir=MIRROR_DIR):
+    parsed_url = urlparse(web_url)
+    base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    project_path = get_project_path(web_url)
+    with _MIRRORS_LOCK:
+        key = (mirror_dir, base_url, project_path)
+        if key not in _MIRRORS:
+            _MIRRORS[key] = GitMirror(base_url, project_path, token, mirror_dir)
+        return _MIRRORS[key]
+
+
+class GitMirror:
+    def __init__(self, base_url, project_path, token, mirror_dir=MIRROR_DIR):
+        import git                                  #GitPython is only needed when a mirror is actually used
+
+        self.path = os.path.join(mirror_dir, urlparse(base_url).netloc, f"{project_path}.git")
+        #The token is passed to every git command through GIT_CONFIG_* environment variables (git 2.31+),
+        #never on the command line where ps shows it, and never written into the mirror's config
+        basic_auth = base64.b64encode(f"oauth2:{token}".encode()).decode()
+        self.git_env = {"GIT_CONFIG_COUNT": "1", "GIT_CONFIG_KEY_0": "http.extraHeader", "GIT_CONFIG_VALUE_0": f"Authorization: Basic {basic_auth}"}
+        self.git_options = ["core.quotePath=false"]
+
+        if not os.path.exists(os.path.join(self.path, "HEAD")):
+            repo = git.Repo.init(self.path, bare=True, mkdir=True)
+            repo.create_remote("origin", f"{base_url}/{project_path}.git")
+            with repo.config_writer() as config:
+                #Partial clone setup, so blobs missing from the blobless fetch are pulled lazily by diff/cat-file
+                config.set_value("core", "repositoryformatversion", "1")
+                config.set_value("extensions", "partialClone", "origin")
+                config.set_value('remote "origin"', "promisor", "true")
+                config.set_value('remote "origin"', "partialclonefilter", "blob:none")
+        self.repo = git.Repo(self.path)
+        self.repo.git.update_environment(**self.git_env)      #Also for the blobs diff/cat-file fetch lazily
+
+    def git(self):
+        return self.repo.git(c=self.git_options)
+
+    def has_commit(self, sha):
+        #GIT_NO_LAZY_FETCH (git 2.45+): a missing commit is not pulled from the promisor remote with its whole history
+        try:
+            self.repo.git.cat_file("-e", f"{sha}^{{commit}}", env={"GIT_NO_LAZY_FETCH": "1"})
+            return True
+        except Exception:
+            return False
+
+    def fetch(self, *shas, depth=1):
+        with _FETCH_LOCKS[self.path]:
+            missing = [sha for sha in shas if not self.has_commit(sha)]
+            if missing:
+                with profiler.span("git", "git fetch", path=self.path, commits=len(missing)):
+                    self.git().fetch("--filter=blob:none", f"--depth={depth}", "--no-tags", "origin", *missing)
+
+    def parent_of(self, sha):
+        #A head fetched earlier with --depth=1 is a shallow boundary without its parent, the history is deepened by one commit
+        self.fetch(sha, depth=2)
+        with _FETCH_LOCKS[self.path]:
+            if not self.has_commit(f"{sha}^"):
+                with profiler.span("git", "git fetch --deepen", path=self.path, commits=1):
+                    self.git().fetch("--filter=blob:none", "--deepen=1", "--no-tags", "origin", sha)
+        return self.repo.git.rev_parse(f"{sha}^")
+
+    def iter_changes(self, base_sha, head_sha):
+        #Streams "git diff" instead of buffering it, every change carries its hunks as a list of lines in "diff"
+        process = self.git().diff("--no-color", "--no-ext-diff", "-M", base_sha, head_sha, as_process=True)
+        lines = (raw_line.decode("utf-8", errors="replace") for raw_line in process.stdout)
+        for change, hunks in diff_utils.iter_file_diffs(lines):
+            change["diff"] = hunks
+            yield change
+        process.wait()
+
+    def write_file(self, sha, path, filepath):
+        folder = os.path.dirname(filepath)
+        if folder != "":
+            os.makedirs(folder, exist_ok=True)
+        with profiler.span("write", "mirror file", path=filepath), open(filepath, "wb") as fileptr:
+            self.git().cat_file("blob", f"{sha}:{path}", output_stream=fileptr)
+
+        sha256 = hashlib.sha256()
+        with open(filepath, "rb") as fileptr:
+            for chunk in iter(lambda: fileptr.read(64 * 1024), b""):
+                sha256.update(chunk)
+        return {"path": filepath, "bytes": os.path.getsize(filepath), "sha256": sha256.hexdigest()}
@@ -1,12 +1,26 @@
 #!/usr/bin/env python3
 
 import os
-
-import requests
-from urllib.parse import urlparse, quote
+import sys
+
+import http_client
+import http_cache
+import diff_utils
+import batch_manifest
+import download_server
+import graphql_batch
+import metadata_cache
+import output_formats
+import profiler
+from urllib.parse import urlparse, parse_qs, quote
+from concurrent.futures import ThreadPoolExecutor
 from termcolor import colored
-import argparse,re
-import base64
+import argparse
+
+WORKERS = 8
+PER_PAGE = 100                                                  #Max page size for the Github files listing
+MAX_COMPARE_COMMITS = 250                                       #Compare lists at most this many commits without paging
+OUTPUT_WRITER = None                                            #output_formats writer for --format jsonl/tar/zip/patch
 
 
 def get_args():
@@ -16,7 +30,21 @@ def get_args():
     parser.add_argument('-cu','--commit-url',dest='commit_url', help="Commit Request URL")
     parser.add_argument('-cf','--commit-file',dest='commit_file', help="Commit Request File")
     parser.add_argument('-t','--token',dest='github_token',help="Github Token (Optional: Fetched from Env: GITHUB_API_TOKEN)")
+    parser.add_argument('--manifest',dest='manifest',help="Manifest file for -prf/-cf runs (Default: results/<url-file>.manifest.jsonl)")
+    parser.add_argument('--resume',action="store_true",dest='resume',help="Skip URLs already completed in the manifest and retry only failed/new ones",default=False)
+    parser.add_argument('-w','--workers',dest='workers',type=int,default=WORKERS,help=f"Number of parallel file downloads (Default: {WORKERS})")
+    parser.add_argument('--pool-size',dest='pool_size',type=int,default=http_client.POOL_SIZE,help=f"HTTP connections kept alive per host (Default: {http_client.POOL_SIZE})")
+    parser.add_argument('--retries',dest='retries',type=int,default=http_client.MAX_RETRIES,help=f"Retries on 429/5xx/connection errors (Default: {http_client.MAX_RETRIES})")
+    parser.add_argument('--cache-dir',dest='cache_dir',default=http_cache.CACHE_DIR,help=f"Directory for the HTTP response cache (Default: {http_cache.CACHE_DIR})")
+    parser.add_argument('--no-cache',action="store_true",dest='no_cache',help="Disable the HTTP response cache",default=False)
     parser.add_argument('-ff','--full-file',action="store_true",dest='full_file',help="Download Complete File (Default: Downloads only diff)",default=False)
+    parser.add_argument('-d','--diff',action="store_true",dest='pr_diff',help="With -pru/-prf, download the whole PR diff in one streamed request (split per file) instead of every changed file's blob",default=False)
+    parser.add_argument('--no-graphql',action="store_true",dest='no_graphql',help="With -prf, list every PR's files through REST instead of batched GraphQL queries",default=False)
+    parser.add_argument('--no-compare',action="store_true",dest='no_compare',help="With -cf, fetch every commit's diff on its own instead of one compare diff per run of contiguous commits",default=False)
+    parser.add_argument('--format',dest='output_format',choices=output_formats.FORMATS,default="files",help="Commit and PR (--diff) diffs only. files: one file per path (Default), jsonl/tar/zip: one compressed archive of lossless per-file records, patch: one git-apply-able .patch")
+    parser.add_argument('-o','--output',dest='output',help="Output file for --format jsonl/tar/zip/patch (Default: results/github-<time>.<ext>)")
+    parser.add_argument('--server',dest='server',nargs='?',const=download_server.DEFAULT_ADDRESS,metavar='ADDRESS',help=f"Run on a download_server.py (Unix socket path or host:port, Default: {download_server.DEFAULT_ADDRESS}) with its warm connections, cache and token checks, runs here if none answers")
+    parser.add_argument('--profile',dest='profile',nargs='?',const="",metavar='TRACE_FILE',help="Print per-endpoint timings (count, total, p50/p95/max) at the end, and also write a Chrome trace JSON if a file is given")
     args = parser.parse_args()
 
     if not args.github_token and not os.getenv("GITHUB_API_TOKEN"):
@@ -24,133 +52,281 @@ def get_args():
 
     if not args.commit_url and not args.commit_file and not args.pr_file and not args.pullrequest_url:
         exit(colored("[-] Error: Either commit_url or commit_file or pr_url or pr_file should be provided","red"))
-    
+
+    if args.output_format != "files" and (args.full_file or ((args.pullrequest_url or args.pr_file) and not args.pr_diff)):
+        exit(colored("[-] Error: --format only works for diffs (-cu/-cf without --full-file, -pru/-prf with --diff)","red"))
 
     return args
 
+def get_github_graphql_url(github_url):
+    parsed_url = urlparse(github_url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}/api/graphql"    #https://github.host.com/api/graphql
+
+
 def get_github_api_baseurl(github_url):
     parsed_url = urlparse(github_url)
     github_api_base_url = f"{parsed_url.scheme}://{parsed_url.netloc}/api/v3"  #https://github.host.com/api/v3
     return github_api_base_url
 
 
-#Example PR URL: https://github.host.com/ORGNAME/REPONAME/pulls/pullnumber
-def download_code_from_pr_url(pr_url):
-    global GITHUB_API_TOKEN
+def get_total_pages(response):
+    #Github only sends a "last" link when there is more than one page
+    last_link = response.links.get("last", {}).get("url")
+    if not last_link:
+        return 1
+    return int(parse_qs(urlparse(last_link).query).get("page", ["1"])[0])
 
-    #Create Results Folder
-    pr_url_dir = pr_url.split("/")
-    results_dir = f"{pr_url_dir[4]}_{pr_url_dir[5]}_{pr_url_dir[-1]}"     #org_repo_pullnumber
 
-    parent_dir = os.getcwd()
-    try:
-        os.mkdir(results_dir)
-    except Exception as e:
-        print(colored("[X] Directory Already Exists: ","red"),colored(f"{results_dir}","light_red"))
-        exit(1)
+def list_files_pages(files_api, headers, pool, get_files=lambda page: page):
+    #get_files picks the file list out of a page (PR listings are plain lists, commits have it under "files")
+    def get_page(page):
+        #An error body ({"message": ...}) must not be read as a page of files
+        response = http_client.get(f"{files_api}?per_page={PER_PAGE}&page={page}", headers=headers)
+        response.raise_for_status()
+        return response
+
+    first_page = get_page(1)
+
+    #Page count is known from the Link header, so the remaining pages are fetched in parallel
+    total_pages = get_total_pages(first_page)
+    other_pages = pool.map(lambda page: get_page(page).json(), range(2, total_pages + 1))
 
-    os.chdir(results_dir)
+    files = list(get_files(first_page.json()))
+    for page in other_pages:
+        files.extend(get_files(page))
+    return files
+
+
+def list_pr_files(base_url, org, repo, pull_number, headers, pool):
+    return list_files_pages(f"{base_url}/repos/{org}/{repo}/pulls/{pull_number}/files", headers, pool)
+
+
+def download_blobs(base_url, org, repo, files, results_dir, headers, pool):
+    #Raw media type skips the base64 JSON wrapper, the bytes are streamed straight to disk
+    #Items come from the REST listings (blob sha) or from a GraphQL plan (url of the file at the head commit)
+    def download_blob(item):
+        fetch_file_api = item.get("url") or f"{base_url}/repos/{org}/{repo}/git/blobs/{item['sha']}"
+        return http_client.download_to_file(fetch_file_api, os.path.join(results_dir, item["filename"]), headers=headers)
+
+    blob_futures = [(item["filename"], pool.submit(download_blob, item)) for item in files if item.get("sha") or item.get("url")]
+
+    downloaded, failed = [], 0
+    for file_name, future in blob_futures:
+        try:
+            downloaded.append(future.result())
+            print(colored("[File] ","light_grey"),colored(f"{file_name}","light_blue"))
+        except Exception as e:
+            failed += 1
+            print(colored("[Error]","red"),colored(f"Failed Downloading: {file_name} ({e})","light_red"))
+
+    print(colored("\n[Completed] ","yellow"),colored(f"Total Files Downloaded: {len(downloaded)}","light_cyan"))
+    if failed:
+        raise RuntimeError(f"{failed} file(s) failed to download")
+    return downloaded
+
+
+#Example PR URL: https://github.host.com/ORGNAME/REPONAME/pull/pullnumber
+def download_code_from_pr_url(pr_url, overwrite=False, plan=None):
+    global GITHUB_API_TOKEN
 
     #Get Base URL
     base_url = get_github_api_baseurl(pr_url)
     pr_uri_list = pr_url.split("/")[3:]
-    org,repo,pulls,pull_number = pr_uri_list[0],pr_uri_list[1],"pulls",pr_uri_list[3]  #URL has pull, but api requires pulls
+    org,repo,pull_number = pr_uri_list[0],pr_uri_list[1],pr_uri_list[3]  #URL has pull, but api requires pulls
 
-    #Git Default Returns 30 results, so loop to get all pages
-    page=0
-    completed = False
-    while True:
-        page +=1
-        fetch_pr_api = f"{base_url}/repos/{org}/{repo}/{pulls}/{pull_number}/files?page={page}"
-        headers = {"Authorization": f"token {GITHUB_API_TOKEN}", "Accept": "application/vnd.github.v3.diff"}
-        response = requests.get(fetch_pr_api, headers=headers).json()
-        res_content_len = len(response)
-        if len(response) == 0:
-            break
+    #Create Results Folder, an existing one is an error of this PR only (the batch runner records it and goes on)
+    results_dir = f"{org}_{repo}_{pull_number}"     #org_repo_pullnumber
+    if os.path.isdir(results_dir) and not overwrite:
+        raise FileExistsError(f"Directory Already Exists: {results_dir}")
+    os.makedirs(results_dir, exist_ok=True)
 
-        count = 0
-        for item in response:
-            count+=1
-            file_name = item.get("filename")
-            changed_file_sha = item.get("sha")
+    json_headers = {"Authorization": f"token {GITHUB_API_TOKEN}", "Accept": "application/vnd.github+json"}
+    raw_headers = {"Authorization": f"token {GITHUB_API_TOKEN}", "Accept": "application/vnd.github.raw"}
 
-            fetch_file_api = f"{base_url}/repos/vcf/mops/git/blobs/{changed_file_sha}"
-            response = requests.get(fetch_file_api, headers=headers).json()
-            file_content_base64 = response.get("content").replace("\n", "")
-            try:
-                file_content = base64.b64decode(file_content_base64).decode()
-                print(colored("[File] ","light_grey"),colored(f"{file_name}","light_blue"))
-            except UnicodeDecodeError as e:
-                file_content = base64.b64decode(file_content_base64).decode('utf-8', errors='replace')
-                print(colored("[Error]","red"),colored(f"Failed Decoding: {file_name} (Saved file without decoding)","light_red"))
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        if plan is None:
+            files = list_pr_files(base_url, org, repo, pull_number, json_headers, pool)
+        else:
+            #File list and head commit already known from the batched GraphQL query, deleted files have no content at head
+            files = [{"filename": item["path"], "url": f"{base_url}/repos/{org}/{repo}/contents/{quote(item['path'])}?ref={plan['head_sha']}"}
+                     for item in plan["files"] if item["change_type"] != "DELETED"]
+        return download_blobs(base_url, org, repo, files, results_dir, raw_headers, pool)
 
-            folder = os.path.dirname(file_name)
-            os.makedirs(folder, exist_ok=True)
-            with open(file_name, "w") as fp:
-                fp.write(file_content)
 
+def download_pr_file_urls(pr_urls, manifest_path, resume=False, use_graphql=True):
+    plans = {}
 
-    print(colored("\n[Completed] ","yellow"),colored(f"Total Files Downloaded: {count}","light_cyan"))
+    def plan_prs(pending_urls):
+        #Dozens of PRs per GraphQL query instead of one or more listing calls per PR
+        prs = {}
+        for pr_url in pending_urls:
+            pr_uri_list = pr_url.split("/")[3:]
+            prs[pr_url] = (get_github_graphql_url(pr_url), pr_uri_list[0], pr_uri_list[1], pr_uri_list[3])
+        plans.update(graphql_batch.plan_github_prs(prs, get_headers()))
 
-    os.chdir(parent_dir)
+    #A resumed PR may have a partially downloaded folder from the failed attempt
+    return batch_manifest.run_batch(pr_urls, lambda pr_url: download_code_from_pr_url(pr_url, overwrite=resume, plan=plans.get(pr_url)),
+                                    manifest_path, resume=resume, prepare=plan_prs if use_graphql else None)
 
 
-#Fetches all diff as a single response
+#Fetches all diff as a single response, one request per PR however many files and pages it has
 def download_diff_from_pr_url(pr_url):
-    global GITHUB_API_TOKEN
-
     #Get Base URL
     base_url = get_github_api_baseurl(pr_url)
     pr_uri_list = pr_url.split("/")[3:]
     org,repo,pulls,pull_number = pr_uri_list[0],pr_uri_list[1],"pulls",pr_uri_list[3]  #URL has pull, but api requires pulls
     final_api_url = f"{base_url}/repos/{org}/{repo}/{pulls}/{pull_number}"
-    headers = {"Authorization": f"token {GITHUB_API_TOKEN}", "Accept": "application/vnd.github.v3.diff"}
-    response = requests.get(final_api_url, headers=headers)
-    print(response.text)
 
+    results_dir = f"{org}_{repo}_{pull_number}"     #org_repo_pullnumber
+    source = output_formats.make_source(pr_url, f"{org}/{repo}", "pull_request", pull_number)
+    return save_streamed_diff(final_api_url, results_dir, source)
+
+
+#Example Commit URL: https://github.host.com/ORGNAME/REPONAME/commit/sha (also .../pull/pullnumber/commits/sha)
+def parse_commit_url(commit_url):
+    parts = urlparse(commit_url).path.strip("/").split("/")
+    sha_index = parts.index("commit" if "commit" in parts else "commits") + 1
+    return get_github_api_baseurl(commit_url), parts[0], parts[1], parts[sha_index]
+
+
+def get_headers(media_type="application/vnd.github+json"):
+    return {"Authorization": f"token {GITHUB_API_TOKEN}", "Accept": media_type}
 
 
 def download_code_from_commit_url(commit_url):
-    pass
+    base_url, org, repo, sha = parse_commit_url(commit_url)
+    results_dir = f"{org}_{repo}_{sha[:12]}"        #org_repo_sha
+
+    if DOWNLOAD_COMPLETE_FILE:
+        #Files at the commit, the file list is paginated for big commits so the pages are fetched in parallel
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            files = list_files_pages(f"{base_url}/repos/{org}/{repo}/commits/{sha}", get_headers(), pool, get_files=lambda page: page.get("files", []))
+            files = [item for item in files if item.get("status") != "removed"]
+            return download_blobs(base_url, org, repo, files, results_dir, get_headers("application/vnd.github.raw"), pool)
+
+    source = output_formats.make_source(commit_url, f"{org}/{repo}", "commit", sha)
+    return save_streamed_diff(f"{base_url}/repos/{org}/{repo}/commits/{sha}", results_dir, source)
+
+
+def save_streamed_diff(api_url, results_dir, source):
+    #The whole diff comes back as one streamed text response and is split per file while it arrives
+    files = []
+    response = http_client.get(api_url, headers=get_headers("application/vnd.github.v3.diff"), stream=True)
+    with response:
+        response.raise_for_status()
+        for change, hunks in diff_utils.iter_file_diffs(http_client.iter_lines(response)):
+            change["diff"] = hunks
+            files.append(save_change(change, results_dir, source))
+
+    print(colored("\n[Completed] ","yellow"),colored(f"Total Files Downloaded: {len(files)}","light_cyan"))
+    return files
+
+
+def find_contiguous_range(base_url, org, repo, shas):
+    #One compare call tells whether the commits form one linear run (Ex: a-b-c-d given as a, b, c, d in any order of a/d)
+    #Returns (parent of the first commit, last commit) so that compare/parent...last is the diff of all of them together
+    for first, last in ((shas[0], shas[-1]), (shas[-1], shas[0])):
+        response = http_client.get(f"{base_url}/repos/{org}/{repo}/compare/{first}...{last}", headers=get_headers())
+        if response.status_code != 200:
+            return None
+        compare = response.json()
+        if compare.get("status") != "behind":
+            break
+    else:
+        return None
+
+    base_commit, commits = compare.get("base_commit", {}), compare.get("commits", [])
+    others = [sha for sha in shas if sha != first]
+    if compare.get("status") != "ahead" or compare.get("total_commits") != len(others) or len(commits) != len(others):
+        return None
+    if not all(any(commit["sha"].startswith(sha) for commit in commits) for sha in others):
+        return None
+    #Merge commits would pull in the commits of the merged branch as well
+    if len(base_commit.get("parents", [])) != 1 or any(len(commit.get("parents", [])) != 1 for commit in commits):
+        return None
+    return base_commit["parents"][0]["sha"], commits[-1]["sha"]
+
+
+def plan_commit_ranges(commit_urls):
+    #Groups commit URLs by repo, every URL of a repo whose commits are contiguous maps to one shared compare download
+    repos = {}
+    for commit_url in commit_urls:
+        base_url, org, repo, sha = parse_commit_url(commit_url)
+        repos.setdefault((base_url, org, repo), []).append((commit_url, sha))
+
+    ranges = {}
+    for (base_url, org, repo), commits in repos.items():
+        if not 2 <= len(commits) <= MAX_COMPARE_COMMITS + 1:
+            continue
+        found = find_contiguous_range(base_url, org, repo, [sha for _, sha in commits])
+        if found is None:
+            continue
+        print(colored(f"[-] {len(commits)} contiguous commits in {org}/{repo}, downloading them as one compare diff","magenta"))
+        commit_range = {"base_url": base_url, "org": org, "repo": repo, "base": found[0], "head": found[1]}
+        for commit_url, _ in commits:
+            ranges[commit_url] = commit_range
+    return ranges
+
+
+def download_commit_range(commit_range):
+    #Downloaded once for the first of its URLs, the other URLs of the range get the same records (or the same error)
+    if "files" in commit_range:
+        print(colored("[-] Part of an already downloaded compare diff","light_grey"))
+        return commit_range["files"]
+    if "error" in commit_range:
+        raise commit_range["error"]
+
+    base_url, org, repo, base, head = (commit_range[key] for key in ("base_url", "org", "repo", "base", "head"))
+    results_dir = f"{org}_{repo}_{base[:12]}..{head[:12]}"
+    web_url = f"{base_url.rsplit('/api/v3', 1)[0]}/{org}/{repo}/compare/{base}...{head}"
+    source = output_formats.make_source(web_url, f"{org}/{repo}", "compare", f"{base}..{head}")
+    try:
+        commit_range["files"] = save_streamed_diff(f"{base_url}/repos/{org}/{repo}/compare/{base}...{head}", results_dir, source)
+    except Exception as e:
+        commit_range["error"] = e
+        raise
+    return commit_range["files"]
 
 
+def download_commit_file_urls(commit_urls, manifest_path, resume=False, use_compare=True):
+    ranges = plan_commit_ranges(commit_urls) if use_compare and not DOWNLOAD_COMPLETE_FILE else {}
 
-def save_diff_to_file(filepath, codediff):
-    filename = filepath.split("/")[-1]
-    folder = "/".join(filepath.split("/")[:-1])
-    if folder != "":
-        os.makedirs(folder, exist_ok=True)
-    with open (filepath, "w") as fileptr:
-        fileptr.write(codediff)
+    def download(commit_url):
+        if commit_url in ranges:
+            return download_commit_range(ranges[commit_url])
+        return download_code_from_commit_url(commit_url)
 
-    beautify_file(filepath)
+    return batch_manifest.run_batch(commit_urls, download, manifest_path, resume=resume)
 
 
-def beautify_file(filepath):
-    with open(filepath,"r") as diff_file:
-        processed_file_content = ""
-        for line in diff_file:
-            if line.startswith("+") or line.startswith("-"):
-                processed_file_content += line[1:]
-            else:
-                line = re.sub(r'@@ -\d+,\d+ \+\d+,\d+ @@ ', '', line)
-                processed_file_content += line
+def save_change(change, results_dir, source):
+    if OUTPUT_WRITER is None:
+        return save_diff_to_file(os.path.join(results_dir, change["new_path"] or change["old_path"]), change["diff"])
+    written = OUTPUT_WRITER.write(source, change)
+    print(colored(f"|--> Record: ","yellow"),colored(f"{written['path']}","white"))
+    return written
 
-    with open(filepath,"w") as diff_file:
-        diff_file.write(processed_file_content)
 
+def save_diff_to_file(filepath, codediff):
+    written = diff_utils.write_diff_file(filepath, codediff)
     print(colored(f"|--> File: ","yellow"),colored(f"{filepath}","white"))
+    return written
 
 
 def verify_github_token(github_url):
     global GITHUB_API_TOKEN
 
     github_base_url = get_github_api_baseurl(github_url)
+    cached = metadata_cache.get_verified_token("github", github_base_url, GITHUB_API_TOKEN)
+    if cached:
+        print(colored(f"[-] Github Token validated recently (cached): {cached['user']}","light_magenta"))
+        return
     git_verify_url = f"{github_base_url}/user"
     headers = {"Authorization" : f"token {GITHUB_API_TOKEN}"}
-    res = requests.get(git_verify_url,headers=headers)
+    res = http_client.get(git_verify_url,headers=headers)
     if res.status_code != 200:
         exit(colored(f"[X] Github Token is Invalid: {res.status_code}","red"))
+    metadata_cache.record_verified_token("github", github_base_url, GITHUB_API_TOKEN, user=res.json().get("login"))
     print(colored("[-] Github Token successfully validated","light_magenta"))
 
 
@@ -158,8 +334,16 @@ def verify_github_token(github_url):
 def main():
     global GITHUB_API_TOKEN
     global DOWNLOAD_COMPLETE_FILE
+    global WORKERS
+    global OUTPUT_WRITER
 
     args = get_args()
+    if args.server:
+        code = download_server.submit(args.server, "github", sys.argv[1:])
+        if code is not None:
+            exit(code)
+        print(colored(f"[!] No download server answering on {args.server}, running here","yellow"))
+    WORKERS = args.workers
     GITHUB_API_TOKEN = args.github_token or os.getenv("GITHUB_API_TOKEN")
 
     curr_dir = os.getcwd()
@@ -167,34 +351,61 @@ def main():
     os.chdir("results")
 
     DOWNLOAD_COMPLETE_FILE = args.full_file
+    http_client.configure(pool_size=max(args.pool_size, WORKERS), max_retries=args.retries, cache_dir=None if args.no_cache else os.path.join(curr_dir, args.cache_dir))
+    metadata_cache.configure(None if args.no_cache else os.path.join(curr_dir, args.cache_dir))
+    if args.profile is not None:
+        profiler.enable()
+
+    if args.output_format != "files":
+        output_path = os.path.join(curr_dir, args.output) if args.output else output_formats.default_output_path("", "github", args.output_format)
+        OUTPUT_WRITER = output_formats.open_writer(args.output_format, output_path)
+
+    try:
+        run_downloads(args, curr_dir)
+    finally:
+        if OUTPUT_WRITER is not None:
+            OUTPUT_WRITER.close()
+            print(colored(f"[*] {OUTPUT_WRITER.records} records ({OUTPUT_WRITER.bytes} bytes) written to {OUTPUT_WRITER.filepath}","cyan"))
+
+    http_client.print_stats()
+    graphql_batch.print_stats()
+    profiler.print_report()
+    if args.profile:
+        profiler.write_trace(os.path.join(curr_dir, args.profile))
 
+
+def run_downloads(args, curr_dir):
     if args.pullrequest_url:
         verify_github_token(args.pullrequest_url)
-        download_code_from_pr_url(args.pullrequest_url)
+        if args.pr_diff:
+            download_diff_from_pr_url(args.pullrequest_url)
+        else:
+            try:
+                download_code_from_pr_url(args.pullrequest_url)
+            except FileExistsError as e:
+                exit(colored(f"[X] {e}","red"))
         #Example_PullRequest_URL = "https://github.host.com/ORGNAME/REPONAME/pulls/pullnumber"
 
     if args.commit_url:
         verify_github_token(args.commit_url)
         download_code_from_commit_url(args.commit_url)
-        #Example_Commit_URL = "https://github.host.com/projectname/subproject/-/commit/commithash"
-
+        #Example_Commit_URL = "https://github.host.com/ORGNAME/REPONAME/commit/commithash"
 
     elif args.commit_file:
-        with open(os.path.join(curr_dir, args.commit_file), "r") as fileptr:
-            urls = fileptr.readlines()
-            verify_github_token(urls[0].strip())
-            for commit_url in urls:
-                commit_url = commit_url.strip()
-                print(colored(f"\n[-] {commit_url}","cyan"))
-                download_code_from_commit_url(commit_url)
+        urls = batch_manifest.read_url_file(os.path.join(curr_dir, args.commit_file))
+        verify_github_token(urls[0])
+        manifest_path = os.path.join(curr_dir, args.manifest) if args.manifest else f"{os.path.basename(args.commit_file)}.manifest.jsonl"
+        download_commit_file_urls(urls, manifest_path, resume=args.resume, use_compare=not args.no_compare)
 
     elif args.pr_file:
-        with open(os.path.join(curr_dir, args.pr_file), "r") as fileptr:
-            urls = fileptr.readlines()
-            verify_github_token(urls[0].strip())
-            for merge_url in urls:
-                merge_url = merge_url.strip()
-                print(colored(f"\n[-] {merge_url}","cyan"))
-                download_code_from_pr_url(merge_url)
-
-main()
+        urls = batch_manifest.read_url_file(os.path.join(curr_dir, args.pr_file))
+        verify_github_token(urls[0])
+        manifest_path = os.path.join(curr_dir, args.manifest) if args.manifest else f"{os.path.basename(args.pr_file)}.manifest.jsonl"
+        if args.pr_diff:
+            batch_manifest.run_batch(urls, download_diff_from_pr_url, manifest_path, resume=args.resume)
+        else:
+            download_pr_file_urls(urls, manifest_path, resume=args.resume, use_graphql=not args.no_graphql)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,29 @@
 #!/usr/bin/env python3
 
 import os
-from heapq import merge
-
-import requests
+import sys
+
+import http_client
+import http_cache
+import diff_utils
+import batch_manifest
+import download_server
+import git_mirror
+import gitlab_diffs
+import graphql_batch
+import metadata_cache
+import profiler
+import output_formats
+import url_utils
 from urllib.parse import urlparse, quote
+from concurrent.futures import ThreadPoolExecutor
 from termcolor import colored
-import argparse,re
-import pdb
+import argparse
 
+WORKERS = 8
+MIRROR_THRESHOLD = git_mirror.MIRROR_THRESHOLD
+MIRROR_DIR = git_mirror.MIRROR_DIR
+OUTPUT_WRITER = None                    #output_formats writer for --format jsonl/tar/zip/patch, None for one file per path
 MR_OUTPUT_FOLDER = "MR-Download-Results"
 COMMIT_OUTPUT_FOLDER = "Commit-Download-Results"
 
@@ -20,7 +35,22 @@ def get_args():
     parser.add_argument('-mu','--merge-url',dest='mr_url', help="Merge Request URL")
     parser.add_argument('-mf','--merge-file',dest='mr_file', help="Merge Request File")
     parser.add_argument('-t','--token',dest='gitlab_token',help="Gitlab Token (Optional: Fetched from Env: GITLAB_API_TOKEN)")
+    parser.add_argument('-w','--workers',dest='workers',type=int,default=WORKERS,help=f"Number of parallel file downloads for --full-file (Default: {WORKERS})")
+    parser.add_argument('--mirror-threshold',dest='mirror_threshold',type=int,default=MIRROR_THRESHOLD,help=f"Changed files above which a local blobless git mirror is used instead of the API (Default: {MIRROR_THRESHOLD})")
+    parser.add_argument('--mirror-dir',dest='mirror_dir',default=MIRROR_DIR,help=f"Directory for the local git mirrors (Default: {MIRROR_DIR})")
+    parser.add_argument('--manifest',dest='manifest',help="Manifest file for -mf/-cf runs (Default: results/<url-file>.manifest.jsonl)")
+    parser.add_argument('--resume',action="store_true",dest='resume',help="Skip URLs already completed in the manifest and retry only failed/new ones",default=False)
+    parser.add_argument('--pool-size',dest='pool_size',type=int,default=http_client.POOL_SIZE,help=f"HTTP connections kept alive per host (Default: {http_client.POOL_SIZE})")
+    parser.add_argument('--retries',dest='retries',type=int,default=http_client.MAX_RETRIES,help=f"Retries on 429/5xx/connection errors (Default: {http_client.MAX_RETRIES})")
+    parser.add_argument('--cache-dir',dest='cache_dir',default=http_cache.CACHE_DIR,help=f"Directory for the HTTP response cache (Default: {http_cache.CACHE_DIR})")
+    parser.add_argument('--no-cache',action="store_true",dest='no_cache',help="Disable the HTTP response cache",default=False)
     parser.add_argument('-ff','--full-file',action="store_true",dest='full_file',help="Download Complete File (Default: Downloads only diff)",default=False)
+    parser.add_argument('-d','--diff',action="store_true",dest='mr_diff',help="With -mu/-mf, download the whole MR diff in one streamed request (split per file) instead of the JSON changes",default=False)
+    parser.add_argument('--no-graphql',action="store_true",dest='no_graphql',help="With -mf, fetch every MR's metadata through REST instead of batched GraphQL queries",default=False)
+    parser.add_argument('--format',dest='output_format',choices=output_formats.FORMATS,default="files",help="files: one file per path (Default), jsonl/tar/zip: one compressed archive of lossless per-file records, patch: one git-apply-able .patch")
+    parser.add_argument('-o','--output',dest='output',help="Output file for --format jsonl/tar/zip/patch (Default: results/gitlab-<time>.<ext>)")
+    parser.add_argument('--server',dest='server',nargs='?',const=download_server.DEFAULT_ADDRESS,metavar='ADDRESS',help=f"Run on a download_server.py (Unix socket path or host:port, Default: {download_server.DEFAULT_ADDRESS}) with its warm connections, cache and token checks, runs here if none answers")
+    parser.add_argument('--profile',dest='profile',nargs='?',const="",metavar='TRACE_FILE',help="Print per-endpoint timings (count, total, p50/p95/max) at the end, and also write a Chrome trace JSON if a file is given")
     args = parser.parse_args()
 
     if not args.gitlab_token and not os.getenv("GITLAB_API_TOKEN"):
@@ -28,106 +58,204 @@ def get_args():
 
     if not args.commit_url and not args.commit_file and not args.mr_url and not args.mr_file:
         exit(colored("[-] Error: Either commit_url or commit_file or mr_url or mr_file should be provided","red"))
-    
+
+    if args.full_file and args.output_format != "files":
+        exit(colored("[-] Error: --full-file downloads whole files and only works with --format files","red"))
+
+    if args.full_file and args.mr_diff:
+        exit(colored("[-] Error: --diff downloads diffs, it cannot be combined with --full-file","red"))
 
     return args
 
 
-def Download_Code_From_MR(mr_url):
+def Download_Code_From_MR(mr_url, mr_json=None):
+    #mr_json: the MR's metadata when a batched GraphQL query already fetched it
     global GITLAB_API_TOKEN, DOWNLOAD_COMPLETE_FILE
-    parsed_url = urlparse(mr_url)
-    gitlab_api = f"{parsed_url.scheme}://{parsed_url.netloc}/api/v4"
-                  #https://gitlab.host.com/api/v4"
-
     # url = "https://gitlab.gg.com/projectname/subproject/-/merge_requests/177"
-    url_parts = mr_url.split("/")
-    project_id = url_parts[3] + "%2F" + url_parts[4]
-    merge_request_id = url_parts[7]
+    base_url, project_path, _, merge_request_id = url_utils.parse_gitlab_url(mr_url)
+    gitlab_api = f"{base_url}/api/v4"       #https://gitlab.host.com/api/v4"
+    project_id = metadata_cache.project_ref(base_url, project_path)
 
-    # Build API URL for merge request changes
-    api_url = f"{gitlab_api}/projects/{project_id}/merge_requests/{merge_request_id}/changes"
+    # Build API URL for the merge request, its diffs are fetched page by page from .../diffs
+    api_url = f"{gitlab_api}/projects/{project_id}/merge_requests/{merge_request_id}"
 
     headers = {"PRIVATE-TOKEN": GITLAB_API_TOKEN}
-    response = requests.get(api_url, headers=headers)
-    response_json = response.json()
+    response_json = mr_json
+    if response_json is None:
+        response = http_client.get(api_url, headers=headers)
+        response.raise_for_status()
+        response_json = response.json()
+        if response_json.get("state") == "merged":
+            http_client.mark_immutable(response, headers)         #Merged MRs never change, skip revalidation on re-runs
+    metadata_cache.record_project_id(base_url, project_path, response_json.get("project_id"))   #Free with every MR
+    merged = response_json.get("state") == "merged"
+
+    source = output_formats.make_source(mr_url, project_path, "merge_request", merge_request_id)
+    if git_mirror.needs_mirror_for_count(response_json, MIRROR_THRESHOLD):
+        diff_refs = response_json["diff_refs"]
+        return Download_From_Mirror(mr_url, diff_refs["base_sha"], diff_refs["head_sha"], source)
+
+    #Every record is written as soon as it is parsed, memory is bounded by a few pages whatever the MR size
+    changes = gitlab_diffs.iter_mr_diffs(api_url, headers, immutable=merged)
+    if DOWNLOAD_COMPLETE_FILE:
+        #head_sha pins the exact MR version, source_branch may have moved on (or been deleted after merge)
+        #The numeric project id keeps the cached raw file URLs the same whether the project was given by path or id
+        head_sha = response_json["diff_refs"]["head_sha"]
+        changes = [{"new_path": change["new_path"], "deleted_file": change.get("deleted_file")} for change in changes]
+        return download_full_files(gitlab_api, response_json.get("project_id", project_id), head_sha, changes, headers)
+
+    files = []
+    for change in changes:
+        files.append(save_change(change, source))
 
-    source_branch = response_json["source_branch"]
+    return files
 
-    changes = response_json["changes"]
-    for change in changes:
-        filepath = change['new_path']
 
-        #TODO: Download Complete File (Not Working)
-        # if DOWNLOAD_COMPLETE_FILE:
-        #     encoded_filepath = quote(filepath, safe='')       #filepath=/src/something/gg.java
-        #     raw_file_url = f'{gitlab_api}/projects/{project_id}/repository/files/{encoded_filepath}/raw?ref={source_branch}'
-        #     print(raw_file_url)
-        #     codediff = requests.get(raw_file_url,headers=headers).text
-        # else:
-            # codediff = change["diff"]
+def Download_MR_File_Urls(mr_urls, manifest_path, resume=False, use_graphql=True):
+    plans = {}
 
-        codediff = change["diff"]
-        save_diff_to_file(filepath, codediff)
+    def Plan_MRs(pending_urls):
+        #Dozens of MRs per GraphQL query instead of one metadata call per MR
+        mrs = {}
+        for mr_url in pending_urls:
+            base_url, project_path, _, merge_request_id = url_utils.parse_gitlab_url(mr_url)
+            mrs[mr_url] = (f"{base_url}/api/graphql", project_path, merge_request_id)
+        plans.update(graphql_batch.plan_gitlab_mrs(mrs, {"PRIVATE-TOKEN": GITLAB_API_TOKEN}))
+        for mr_url, mr_json in plans.items():
+            base_url, project_path, _, _ = url_utils.parse_gitlab_url(mr_url)
+            metadata_cache.record_project_id(base_url, project_path, mr_json["project_id"])
+
+    return batch_manifest.run_batch(mr_urls, lambda mr_url: Download_Code_From_MR(mr_url, plans.get(mr_url)), manifest_path,
+                                    resume=resume, prepare=Plan_MRs if use_graphql else None)
 
 
 def Download_Code_From_Commit_Url(commit_url):
     global GITLAB_API_TOKEN, DOWNLOAD_COMPLETE_FILE
-    parsed_url = urlparse(commit_url)
-    gitlab_api = f"{parsed_url.scheme}://{parsed_url.netloc}/api/v4"
-                  #https://gitlab.host.com/api/v4"
-
     # url = "https://gitlab.gg.com/projectname/subproject/-/commit/commithash"
-    url_parts = commit_url.split("/")
-    project_id = url_parts[3] + "%2F" + url_parts[4]
-    commit_hash= url_parts[7].split("?")[0]
-
-    api_url = f"{gitlab_api}/projects/{project_id}/repository/commits/{commit_hash}/diff"
-    # print(api_url)
+    base_url, project_path, _, commit_hash = url_utils.parse_gitlab_url(commit_url)
+    gitlab_api = f"{base_url}/api/v4"       #https://gitlab.host.com/api/v4"
 
     headers = {"PRIVATE-TOKEN": GITLAB_API_TOKEN}
-    response = requests.get(api_url, headers=headers)
-    response_json = response.json()
-
-    for item in response_json:
-        filepath = item["new_path"]
-
-        if DOWNLOAD_COMPLETE_FILE:
-            encoded_filepath = quote(filepath, safe='')       #filepath=/src/something/gg.java
-            raw_file_url = f'{gitlab_api}/projects/{project_id}/repository/files/{encoded_filepath}/raw?ref={commit_hash}'
-            print(raw_file_url)
-            codediff = requests.get(raw_file_url,headers=headers).text
-
-        else:
-            codediff = item["diff"]
-
-        save_diff_to_file(filepath, codediff)
+    #Commit diffs do not carry the project id, so it is looked up once per project and cached across runs
+    project_id = metadata_cache.resolve_project_id(base_url, project_path, headers)
+    commit_api = f"{gitlab_api}/projects/{project_id}/repository/commits/{commit_hash}"
+
+    #The diff is paginated (20 files per page by default), the first page's X-Total tells whether the mirror is needed
+    #before any other page is downloaded
+    first_page = http_client.get(gitlab_diffs.commit_diff_page_url(commit_api, 1), headers=headers, stream=True)
+    first_page.raise_for_status()
+    source = output_formats.make_source(commit_url, project_path, "commit", commit_hash)
+    total = gitlab_diffs.total_records(first_page)
+    if total is None or total >= MIRROR_THRESHOLD:
+        first_page.close()
+        return Download_From_Mirror(commit_url, None, commit_hash, source)
+
+    changes = gitlab_diffs.iter_pages(first_page, lambda page: gitlab_diffs.commit_diff_page_url(commit_api, page), headers)
+    if DOWNLOAD_COMPLETE_FILE:
+        changes = [{"new_path": change["new_path"], "deleted_file": change.get("deleted_file")} for change in changes]
+        return download_full_files(gitlab_api, project_id, full_commit_sha(gitlab_api, project_id, commit_hash, headers), changes, headers)
+
+    files = []
+    for item in changes:
+        files.append(save_change(item, source))
+
+    return files
+
+
+#Same content as the MR's web .diff page, which only accepts browser sessions, so the API raw_diffs (Gitlab 17.9+) is used
+def Download_Diff_From_MR(mr_url):
+    global GITLAB_API_TOKEN
+    base_url, project_path, _, merge_request_id = url_utils.parse_gitlab_url(mr_url)
+    gitlab_api = f"{base_url}/api/v4"
+    project_id = metadata_cache.project_ref(base_url, project_path)
+    api_url = f"{gitlab_api}/projects/{project_id}/merge_requests/{merge_request_id}/raw_diffs"
+
+    #One streamed text response for the whole MR, split per file while it arrives so memory stays flat for any MR size
+    response = http_client.get(api_url, headers={"PRIVATE-TOKEN": GITLAB_API_TOKEN}, stream=True)
+    with response:
+        if response.status_code == 404:
+            print(colored("[-] raw_diffs not available on this Gitlab, falling back to the changes API","light_grey"))
+            return Download_Code_From_MR(mr_url)
+        response.raise_for_status()
+
+        source = output_formats.make_source(mr_url, project_path, "merge_request", merge_request_id)
+        files = []
+        for change, hunks in diff_utils.iter_file_diffs(http_client.iter_lines(response)):
+            change["diff"] = hunks
+            files.append(save_change(change, source))
+
+    return files
+
+
+#Used when the change set is too large for the API (truncated diffs, or too many per-file raw fetches)
+def Download_From_Mirror(web_url, base_sha, head_sha, source):
+    global GITLAB_API_TOKEN, DOWNLOAD_COMPLETE_FILE
+    mirror = git_mirror.get_mirror(web_url, GITLAB_API_TOKEN, MIRROR_DIR)
+    print(colored(f"[*] Large change set, using local mirror: {mirror.path}","yellow"))
+
+    if base_sha is None:
+        base_sha = mirror.parent_of(head_sha)            #Commit: diff against its first parent
+    mirror.fetch(base_sha, head_sha)
+
+    files = []
+    for change in mirror.iter_changes(base_sha, head_sha):
+        filepath = change["new_path"]
+        if not DOWNLOAD_COMPLETE_FILE:
+            files.append(save_change(change, source))
+        elif not change["deleted_file"]:
+            files.append(mirror.write_file(head_sha, filepath, filepath))
+            print(colored(f"|--> File: ","yellow"),colored(f"{filepath}","white"))
+
+    return files
+
+
+def full_commit_sha(gitlab_api, project_id, commit_hash, headers):
+    #raw?ref=<sha> files are only cached without revalidation for a full SHA, a short one from the URL is resolved once
+    if len(commit_hash) == 40:
+        return commit_hash
+    response = http_client.get(f"{gitlab_api}/projects/{project_id}/repository/commits/{commit_hash}", headers=headers)
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+def download_full_files(gitlab_api, project_id, ref, changes, headers):
+    #Deleted files do not exist at ref, so there is nothing to download for them
+    filepaths = [change["new_path"] for change in changes if not change.get("deleted_file")]
+
+    #ref is a full commit SHA, so every raw file is an immutable cache entry and re-runs make no request for it
+    def download_raw_file(filepath):
+        encoded_filepath = quote(filepath, safe='')       #filepath=/src/something/gg.java
+        raw_file_url = f'{gitlab_api}/projects/{project_id}/repository/files/{encoded_filepath}/raw?ref={ref}'
+        return http_client.download_to_file(raw_file_url, filepath, headers=headers)
+
+    files, failed = [], 0
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        futures = [(filepath, pool.submit(download_raw_file, filepath)) for filepath in filepaths]
+        for filepath, future in futures:
+            try:
+                files.append(future.result())
+                print(colored(f"|--> File: ","yellow"),colored(f"{filepath}","white"))
+            except Exception as e:
+                failed += 1
+                print(colored(f"|--> Failed: ","red"),colored(f"{filepath} ({e})","light_red"))
+
+    if failed:
+        raise RuntimeError(f"{failed} file(s) failed to download")
+    return files
+
+
+def save_change(change, source):
+    if OUTPUT_WRITER is None:
+        return save_diff_to_file(change["new_path"], change["diff"])
+    written = OUTPUT_WRITER.write(source, change)
+    print(colored(f"|--> Record: ","yellow"),colored(f"{written['path']}","white"))
+    return written
 
 
 def save_diff_to_file(filepath, codediff):
-    filename = filepath.split("/")[-1]
-    folder = "/".join(filepath.split("/")[:-1])
-    if folder != "":
-        os.makedirs(folder, exist_ok=True)
-    with open (filepath, "w") as fileptr:
-        fileptr.write(codediff)
-
-    beautify_file(filepath)
-
-
-def beautify_file(filepath):
-    with open(filepath,"r") as diff_file:
-        processed_file_content = ""
-        for line in diff_file:
-            if line.startswith("+") or line.startswith("-"):
-                processed_file_content += line[1:]
-            else:
-                line = re.sub(r'@@ -\d+,\d+ \+\d+,\d+ @@ ', '', line)
-                processed_file_content += line
-
-    with open(filepath,"w") as diff_file:
-        diff_file.write(processed_file_content)
-
+    written = diff_utils.write_diff_file(filepath, codediff)
     print(colored(f"|--> File: ","yellow"),colored(f"{filepath}","white"))
+    return written
 
 
 def verify_gitlab_token(gitlab_url):
@@ -136,12 +264,16 @@ def verify_gitlab_token(gitlab_url):
     #Get Base URL
     parsed_url = urlparse(gitlab_url)
     GITLAB_BASE_URL = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    if metadata_cache.get_verified_token("gitlab", GITLAB_BASE_URL, GITLAB_API_TOKEN):
+        print(colored("[-] Gitlab Token validated recently (cached)","light_magenta"))
+        return
 
     git_verify_url = f"{GITLAB_BASE_URL}/api/v4/personal_access_tokens/self"
     headers = {"PRIVATE-TOKEN" : GITLAB_API_TOKEN}
-    res = requests.get(git_verify_url,headers=headers)
+    res = http_client.get(git_verify_url,headers=headers)
     if res.status_code != 200:
         exit(colored(f"[X] Gitlab Token is Invalid: {res.status_code}","red"))
+    metadata_cache.record_verified_token("gitlab", GITLAB_BASE_URL, GITLAB_API_TOKEN)
     print(colored("[-] Gitlab Token successfully validated","light_magenta"))
 
 
@@ -149,16 +281,49 @@ def verify_gitlab_token(gitlab_url):
 def main():
     global GITLAB_API_TOKEN
     global DOWNLOAD_COMPLETE_FILE
+    global WORKERS
+    global MIRROR_THRESHOLD, MIRROR_DIR
+    global OUTPUT_WRITER
 
     args = get_args()
+    if args.server:
+        code = download_server.submit(args.server, "gitlab", sys.argv[1:])
+        if code is not None:
+            exit(code)
+        print(colored(f"[!] No download server answering on {args.server}, running here","yellow"))
+    WORKERS = args.workers
+    MIRROR_THRESHOLD = args.mirror_threshold
     GITLAB_API_TOKEN = args.gitlab_token or os.getenv("GITLAB_API_TOKEN")
 
     curr_dir = os.getcwd()
     os.makedirs("results", exist_ok=True)
+    MIRROR_DIR = os.path.join(curr_dir, args.mirror_dir)
     os.chdir("results")
 
     DOWNLOAD_COMPLETE_FILE = args.full_file
-
+    http_client.configure(pool_size=max(args.pool_size, WORKERS), max_retries=args.retries, cache_dir=None if args.no_cache else os.path.join(curr_dir, args.cache_dir))
+    metadata_cache.configure(None if args.no_cache else os.path.join(curr_dir, args.cache_dir))
+    if args.profile is not None:
+        profiler.enable()
+    if args.output_format != "files":
+        output_path = os.path.join(curr_dir, args.output) if args.output else output_formats.default_output_path("", "gitlab", args.output_format)
+        OUTPUT_WRITER = output_formats.open_writer(args.output_format, output_path)
+
+    try:
+        Run_Downloads(args, curr_dir)
+    finally:
+        if OUTPUT_WRITER is not None:
+            OUTPUT_WRITER.close()
+            print(colored(f"[*] {OUTPUT_WRITER.records} records ({OUTPUT_WRITER.bytes} bytes) written to {OUTPUT_WRITER.filepath}","cyan"))
+
+    http_client.print_stats()
+    graphql_batch.print_stats()
+    profiler.print_report()
+    if args.profile:
+        profiler.write_trace(os.path.join(curr_dir, args.profile))
+
+
+def Run_Downloads(args, curr_dir):
     if args.commit_url:
         verify_gitlab_token(args.commit_url)
         Download_Code_From_Commit_Url(args.commit_url)
@@ -166,32 +331,30 @@ def main():
 
     elif args.mr_url:
         verify_gitlab_token(args.mr_url)
-        Download_Code_From_MR(args.mr_url)
+        (Download_Diff_From_MR if args.mr_diff else Download_Code_From_MR)(args.mr_url)
         #Example_MR_URL = "https://gitlab.gg.com/projectname/subproject/-/merge_requests/177"
 
     elif args.commit_file:
-        with open(os.path.join(curr_dir, args.commit_file), "r") as fileptr:
-            urls = fileptr.readlines()
-            verify_gitlab_token(urls[0].strip())
-            for commit_url in urls:
-                commit_url = commit_url.strip()
-                print(colored(f"\n[-] {commit_url}","cyan"))
-                Download_Code_From_Commit_Url(commit_url)
+        urls = batch_manifest.read_url_file(os.path.join(curr_dir, args.commit_file))
+        verify_gitlab_token(urls[0])
+        manifest_path = os.path.join(curr_dir, args.manifest) if args.manifest else f"{os.path.basename(args.commit_file)}.manifest.jsonl"
+        batch_manifest.run_batch(urls, Download_Code_From_Commit_Url, manifest_path, resume=args.resume)
 
     elif args.mr_file:
-        with open(os.path.join(curr_dir, args.mr_file), "r") as fileptr:
-            urls = fileptr.readlines()
-            verify_gitlab_token(urls[0].strip())
-            for merge_url in urls:
-                merge_url = merge_url.strip()
-                print(colored(f"\n[-] {merge_url}","cyan"))
-                Download_Code_From_MR(merge_url)
+        urls = batch_manifest.read_url_file(os.path.join(curr_dir, args.mr_file))
+        verify_gitlab_token(urls[0])
+        manifest_path = os.path.join(curr_dir, args.manifest) if args.manifest else f"{os.path.basename(args.mr_file)}.manifest.jsonl"
+        if args.mr_diff:
+            batch_manifest.run_batch(urls, Download_Diff_From_MR, manifest_path, resume=args.resume)
+        else:
+            Download_MR_File_Urls(urls, manifest_path, resume=args.resume, use_graphql=not args.no_graphql)
+
 
-main()
+if __name__ == '__main__':
+    main()
 
 
 '''
 #TODO
-1)Add support for full file download even in MergeRequests
-2)Test with multiple Commit requests, as last time it was given empty response for few files
+1)Test with multiple Commit requests, as last time it was given empty response for few files
 '''
\ No newline at end of file
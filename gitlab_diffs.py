@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+#Gitlab MR diffs through the paginated GET /merge_requests/:iid/diffs (Gitlab 15.7+) instead of /changes,
+#which returns every diff in one JSON body and truncates it on large MRs
+
+import json
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import http_cache
+import http_client
+
+
+DIFFS_PER_PAGE = 100                            #Gitlab's max page size
+PAGE_WINDOW = 4                                 #Pages downloaded ahead of the one being written, spooled to disk above http_cache.SPOOL_BYTES
+
+
+def diffs_page_url(mr_api_url, page, per_page=DIFFS_PER_PAGE):
+    #mr_api_url: https://gitlab.host.com/api/v4/projects/:id/merge_requests/:iid
+    return f"{mr_api_url}/diffs?page={page}&per_page={per_page}"
+
+
+def commit_diff_page_url(commit_api_url, page, per_page=DIFFS_PER_PAGE):
+    #commit_api_url: https://gitlab.host.com/api/v4/projects/:id/repository/commits/:sha, 20 files per page by default
+    return f"{commit_api_url}/diff?page={page}&per_page={per_page}"
+
+
+def total_records(first_page):
+    #Change count from the first page's X-Total, None above 10000 records where Gitlab stops counting
+    total = first_page.headers.get("X-Total")
+    return int(total) if total else None
+
+
+def iter_mr_diffs(mr_api_url, headers, immutable=False, per_page=DIFFS_PER_PAGE, window=PAGE_WINDOW, get=http_client.get):
+    #Yields the MR's change records (old_path, new_path, diff, new_file, ...) in order, one at a time
+    #immutable (merged MRs): the pages are cached without revalidation, like /changes was
+    first_page = get(diffs_page_url(mr_api_url, 1, per_page), headers=headers, stream=True, immutable=immutable)
+    if first_page.status_code == 404:
+        #Older Gitlab without /diffs: the whole change list from /changes (truncated by Gitlab on large MRs)
+        first_page.close()
+        response = get(f"{mr_api_url}/changes", headers=headers)
+        response.raise_for_status()
+        if immutable:
+            http_client.mark_immutable(response, headers)
+        yield from response.json()["changes"]
+        return
+    first_page.raise_for_status()
+    yield from iter_pages(first_page, lambda page: diffs_page_url(mr_api_url, page, per_page), headers, immutable, window, get)
+
+
+def iter_pages(first_page, page_url, headers, immutable=False, window=PAGE_WINDOW, get=http_client.get):
+    #Records of a paginated diff listing (MR /diffs, commit /diff) after its first page, page_url(page) gives the URL of a page
+    #Page 1 gives the page count, the other pages are then fetched concurrently, at most `window` ahead of the writer
+    #The pages are streamed and parsed element by element, the cache stores them after they were read to the end
+    def get_page(page, spool=False):
+        response = get(page_url(page), headers=headers, stream=True, immutable=immutable)
+        response.raise_for_status()
+        #Pages read ahead by the workers wait in temp files, not in memory
+        return http_client.spool_body(response) if spool else response
+
+    #Gitlab leaves out X-Total-Pages above 10000 records, those are walked page by page through X-Next-Page
+    total_pages = first_page.headers.get("X-Total-Pages")
+    if not total_pages:
+        page = first_page
+        while True:
+            yield from http_client.iter_json_array(page)
+            next_page = page.headers.get("X-Next-Page")
+            if not next_page:
+                return
+            page = get_page(int(next_page))
+
+    with ThreadPoolExecutor(max_workers=window) as pool:
+        pending, next_page = deque(), 2
+
+        def fill_window():
+            nonlocal next_page
+            while next_page <= int(total_pages) and len(pending) < window:
+                pending.append(pool.submit(get_page, next_page, True))
+                next_page += 1
+
+        fill_window()
+        yield from http_client.iter_json_array(first_page)
+        while pending:
+            page = pending.popleft().result()
+            fill_window()
+            yield from http_client.iter_json_array(page)
+
+
+class ChangeSpool:
+    #Change records kept in a temp file (on disk above http_cache.SPOOL_BYTES), one JSON line each,
+    #so an MR fetched ahead and waiting to be written does not hold its diffs in memory
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=http_cache.SPOOL_BYTES, mode="w+", encoding="utf-8")
+
+    def extend(self, changes):
+        for change in changes:
+            self.file.write(json.dumps(change) + "\n")
+
+    def __iter__(self):
+        #Read back once, the temp file is gone afterwards
+        self.file.seek(0)
+        with self.file:
+            for line in self.file:
+                yield json.loads(line)
+
+
+def spool_changes(changes):
+    #Reads all the change records now (Ex: in a worker thread) and returns an iterator over the spooled copies
+    spool = ChangeSpool()
+    spool.extend(changes)
+    return iter(spool)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+#Batch planner for -prf/-mf runs: the per-URL metadata/listing REST calls are replaced by aliased GraphQL queries
+#covering dozens of PRs/MRs each, REST is then only used for the file contents/diff bodies
+
+import json
+import math
+import threading
+from collections import defaultdict
+
+from termcolor import colored
+
+import http_client
+
+
+GRAPHQL_BATCH = 50                              #PRs/MRs per query
+GITHUB_FILES_PAGE = 100                         #Max page size of pullRequest.files, same as the REST listing
+STATS = {"queries": 0, "replaced": 0}           #GraphQL queries sent, REST calls they stand in for
+_STATS_LOCK = threading.Lock()
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def run_query(graphql_url, headers, query):
+    #Returns the "data" of the answer, aliases that failed (Ex: PR not found) are null in it
+    response = http_client.post(graphql_url, headers=headers, json={"query": query})
+    response.raise_for_status()
+    body = response.json()
+    with _STATS_LOCK:
+        STATS["queries"] += 1
+    if not body.get("data"):
+        raise RuntimeError("; ".join(error.get("message", str(error)) for error in body.get("errors", [])) or "Empty GraphQL response")
+    return body["data"]
+
+
+def record_replaced(count):
+    with _STATS_LOCK:
+        STATS["replaced"] += count
+
+
+def plan_github_prs(prs, headers):
+    #prs: {pr_url: (graphql_url, owner, repo, number)}
+    #Returns {pr_url: {"head_sha", "files": [{"path", "change_type"}]}}, PRs missing from it go through REST as before
+    plans = {}
+    pending = {pr_url: None for pr_url in prs}              #pr_url -> files cursor, the next page of files to ask for
+    while pending:
+        by_host = defaultdict(list)
+        for pr_url in pending:
+            by_host[prs[pr_url][0]].append(pr_url)
+        next_pending = {}
+        for graphql_url, pr_urls in by_host.items():
+            for batch in chunks(pr_urls, GRAPHQL_BATCH):
+                try:
+                    data = run_query(graphql_url, headers, github_query([(prs[pr_url][1:], pending[pr_url]) for pr_url in batch]))
+                except Exception as e:
+                    print(colored(f"[!] GraphQL batch of {len(batch)} PRs failed, using REST for them: {e}","yellow"))
+                    for pr_url in batch:
+                        plans.pop(pr_url, None)
+                    continue
+                for index, pr_url in enumerate(batch):
+                    pull_request = (data.get(f"r{index}") or {}).get("pr")
+                    if pull_request is None:
+                        plans.pop(pr_url, None)
+                        continue
+                    plan = plans.setdefault(pr_url, {"head_sha": pull_request["headRefOid"], "files": []})
+                    files = pull_request["files"]
+                    plan["files"].extend({"path": node["path"], "change_type": node["changeType"]} for node in files["nodes"])
+                    if files["pageInfo"]["hasNextPage"]:
+                        next_pending[pr_url] = files["pageInfo"]["endCursor"]
+        pending = next_pending
+
+    #The REST listing needs one call per 100 files, and at least one
+    record_replaced(sum(max(math.ceil(len(plan["files"]) / GITHUB_FILES_PAGE), 1) for plan in plans.values()))
+    return plans
+
+
+def github_query(items):
+    #One aliased repository/pullRequest per PR, Ex: r0: repository(owner: "org", name: "repo") { pr: pullRequest(number: 12) {...} }
+    parts = []
+    for index, ((owner, repo, number), cursor) in enumerate(items):
+        after = f", after: {json.dumps(cursor)}" if cursor else ""
+        parts.append(f"r{index}: repository(owner: {json.dumps(owner)}, name: {json.dumps(repo)}) "
+                     f"{{ pr: pullRequest(number: {int(number)}) {{ headRefOid files(first: {GITHUB_FILES_PAGE}{after}) "
+                     f"{{ nodes {{ path changeType }} pageInfo {{ hasNextPage endCursor }} }} }} }}")
+    return "query { " + " ".join(parts) + " }"
+
+
+def plan_gitlab_mrs(mrs, headers):
+    #mrs: {mr_url: (graphql_url, project_path, iid)}
+    #Returns {mr_url: MR fields shaped like GET /merge_requests/:iid}, MRs missing from it go through REST as before
+    plans = {}
+    by_host = defaultdict(list)
+    for mr_url, (graphql_url, _, _) in mrs.items():
+        by_host[graphql_url].append(mr_url)
+
+    for graphql_url, mr_urls in by_host.items():
+        for batch in chunks(mr_urls, GRAPHQL_BATCH):
+            projects = defaultdict(list)
+            for mr_url in batch:
+                projects[mrs[mr_url][1]].append(mr_url)
+            project_paths = list(projects)
+            try:
+                data = run_query(graphql_url, headers, gitlab_query([(path, [mrs[mr_url][2] for mr_url in projects[path]]) for path in project_paths]))
+            except Exception as e:
+                print(colored(f"[!] GraphQL batch of {len(batch)} MRs failed, using REST for them: {e}","yellow"))
+                continue
+            for index, project_path in enumerate(project_paths):
+                project = data.get(f"p{index}")
+                if project is None:
+                    continue
+                project_id = int(project["id"].rsplit("/", 1)[-1])         #gid://gitlab/Project/42
+                nodes = {node["iid"]: node for node in project["mergeRequests"]["nodes"]}
+                for mr_url in projects[project_path]:
+                    node = nodes.get(str(mrs[mr_url][2]))
+                    if node is not None:
+                        plans[mr_url] = gitlab_mr_fields(project_id, node)
+
+    record_replaced(len(plans))                                          #One GET /merge_requests/:iid each
+    return plans
+
+
+def gitlab_query(projects):
+    #One aliased project per project path, with all of its MRs from the batch, Ex: p0: project(fullPath: "group/project") {...}
+    parts = []
+    for index, (project_path, iids) in enumerate(projects):
+        parts.append(f"p{index}: project(fullPath: {json.dumps(project_path)}) {{ id mergeRequests(iids: {json.dumps([str(iid) for iid in iids])}) "
+                     f"{{ nodes {{ iid state diffHeadSha updatedAt diffRefs {{ baseSha headSha startSha }} diffStatsSummary {{ fileCount }} }} }} }}")
+    return "query { " + " ".join(parts) + " }"
+
+
+def gitlab_mr_fields(project_id, node):
+    diff_refs = node.get("diffRefs") or {}
+    return {
+        "iid": int(node["iid"]),
+        "project_id": project_id,
+        "state": node["state"],
+        "sha": node.get("diffHeadSha"),
+        "updated_at": node.get("updatedAt"),
+        "changes_count": str((node.get("diffStatsSummary") or {}).get("fileCount", 0)),
+        "diff_refs": {"base_sha": diff_refs.get("baseSha"), "head_sha": diff_refs.get("headSha"), "start_sha": diff_refs.get("startSha")},
+    }
+
+
+def reset_stats():
+    with _STATS_LOCK:
+        STATS.update(queries=0, replaced=0)
+
+
+def print_stats():
+    if not STATS["queries"]:
+        return
+    print(colored(f"[*] GraphQL: {STATS['queries']} queries replaced {STATS['replaced']} REST calls ({STATS['replaced'] - STATS['queries']} saved)","cyan"))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+#Persistent SQLite cache for GET responses, used by http_client
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mr-downloader")
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+SPOOL_BYTES = 1024 * 1024                        #Streamed bodies above this go through a temp file instead of memory
+COPY_CHUNK = 64 * 1024
+
+#Responses addressed by a full commit/blob SHA can never change, so they are served without revalidation
+IMMUTABLE_URL_PATTERNS = [
+    re.compile(r"/repository/commits/[0-9a-f]{40}$"),                      #Gitlab commit
+    re.compile(r"/repository/commits/[0-9a-f]{40}/diff\?page=\d+&per_page=\d+$"),   #Gitlab commit diff, one page (query sorted by normalize_url)
+    re.compile(r"/repository/files/[^/]+/raw\?(.*&)?ref=[0-9a-f]{40}(&|$)"),  #Gitlab raw file at a commit
+    re.compile(r"/repository/blobs/[0-9a-f]{40}(/raw)?$"),                 #Gitlab blob
+    re.compile(r"/commits/[0-9a-f]{40}$"),                                 #Github commit
+    re.compile(r"/git/blobs/[0-9a-f]{40}$"),                               #Github blob
+    re.compile(r"/contents/[^?]+\?(.*&)?ref=[0-9a-f]{40}(&|$)"),             #Github file at a commit
+    re.compile(r"/compare/[0-9a-f]{40}\.\.\.[0-9a-f]{40}$"),               #Github compare between two SHAs
+]
+
+
+def normalize_url(url):
+    parsed = urlparse(url)
+    query = urlencode(sorted(parse_qsl(parsed.query, keep_blank_values=True)))
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), parsed.path.rstrip("/"), "", query, ""))
+
+
+def is_immutable_url(url):
+    parsed = urlparse(normalize_url(url))
+    target = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+    return any(pattern.search(target) for pattern in IMMUTABLE_URL_PATTERNS)
+
+
+class ResponseCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(cache_dir, "responses.sqlite3"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                               key TEXT PRIMARY KEY,
+                               url TEXT NOT NULL,
+                               headers TEXT NOT NULL,
+                               body BLOB NOT NULL,
+                               size INTEGER NOT NULL,
+                               etag TEXT,
+                               immutable INTEGER NOT NULL DEFAULT 0,
+                               last_access REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self.db.commit()
+
+    @staticmethod
+    def make_key(url, headers):
+        #Different tokens/media types can get different answers for the same URL, so they are part of the key
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        variant = "|".join(headers.get(name, "") for name in ("accept", "authorization", "private-token"))
+        return hashlib.sha256(f"{normalize_url(url)}|{variant}".encode()).hexdigest()
+
+    def get(self, key, stream=False):
+        #stream: the body is a (spooled) temp file copied out of the database in chunks instead of one bytes object
+        with self.lock:
+            row = self.db.execute(f"SELECT headers, {'rowid' if stream else 'body'}, size, etag, immutable FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            headers, body, size, etag, immutable = row
+            if stream:
+                spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+                with self.db.blobopen("responses", "body", body, readonly=True) as blob:
+                    while chunk := blob.read(COPY_CHUNK):
+                        spool.write(chunk)
+                spool.seek(0)
+                body = spool
+            self.db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+        return {"headers": json.loads(headers), "body": body, "size": size, "etag": etag, "immutable": bool(immutable)}
+
+    def put(self, key, url, headers, body, etag=None, immutable=False):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO responses (key, url, headers, body, size, etag, immutable, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (key, normalize_url(url), json.dumps(headers), body, len(body), etag, int(immutable), time.time()))
+            self.db.commit()
+            self._evict()
+
+    def put_file(self, key, url, headers, fileobj, size, etag=None, immutable=False):
+        #Body read from a file in chunks (Ex: a streamed download spooled to disk), never held in memory whole
+        if size > self.max_bytes // 4:
+            return                                  #One huge body would evict everything else
+        with self.lock:
+            cursor = self.db.execute("INSERT OR REPLACE INTO responses (key, url, headers, body, size, etag, immutable, last_access) VALUES (?, ?, ?, zeroblob(?), ?, ?, ?, ?)",
+                                     (key, normalize_url(url), json.dumps(headers), size, size, etag, int(immutable), time.time()))
+            with self.db.blobopen("responses", "body", cursor.lastrowid) as blob:
+                while chunk := fileobj.read(COPY_CHUNK):
+                    blob.write(chunk)
+            self.db.commit()
+            self._evict()
+
+    def _evict(self):
+        #Least recently used entries go first until the cache is back under its size limit
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
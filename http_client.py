@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+#Shared HTTP layer for the downloader scripts: one pooled keep-alive session, retries with backoff and per-host stats
+
+import asyncio
+import codecs
+import hashlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from termcolor import colored
+
+import http_cache
+import profiler
+
+
+POOL_SIZE = 10                                   #Connections kept alive per host
+MAX_RETRIES = 5
+BACKOFF_BASE = 1                                 #Seconds, doubled on every retry
+BACKOFF_MAX = 60                                 #Cap for the computed exponential backoff
+RATE_LIMIT_MAX_WAIT = 900                        #Cap for waits asked for by Retry-After/RateLimit-Reset headers
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+TIMEOUT = (10, 60)                               #Seconds to connect, and without a byte read, before a request is retried
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+_STATS_LOCK = threading.Lock()
+HOST_STATS = defaultdict(lambda: {"requests": 0, "retries": 0, "errors": 0, "latency": 0.0, "cache_hits": 0})
+CACHE = None                                     #http_cache.ResponseCache, enabled through configure()
+CACHED_RESPONSE_HEADERS = ("Content-Type", "ETag", "Last-Modified", "Link", "X-Total", "X-Total-Pages", "X-Next-Page")
+JSON_SEPARATORS = " \t\r\n,"
+JSON_DELIMITERS = JSON_SEPARATORS + "]"
+_JSON_DECODER = json.JSONDecoder()
+
+
+def configure(pool_size=POOL_SIZE, max_retries=MAX_RETRIES, cache_dir=None, cache_max_bytes=http_cache.CACHE_MAX_BYTES):
+    global POOL_SIZE, MAX_RETRIES, _SESSION, CACHE
+    with _SESSION_LOCK:
+        MAX_RETRIES = max_retries
+        #Called again with the same settings (the next job of download_server): the warm connections and cache are kept
+        if _SESSION is not None and pool_size != POOL_SIZE:
+            _SESSION.close()
+            _SESSION = None
+        POOL_SIZE = pool_size
+        if CACHE is not None and cache_dir and (CACHE.cache_dir, CACHE.max_bytes) == (os.path.abspath(cache_dir), cache_max_bytes):
+            return
+        if CACHE is not None:
+            CACHE.close()
+        CACHE = http_cache.ResponseCache(cache_dir, cache_max_bytes) if cache_dir else None
+
+
+def get_session():
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            #Retries are handled in request() so that rate limit headers can be honoured, not by urllib3
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=0)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _SESSION = session
+        return _SESSION
+
+
+def is_rate_limited(status, headers):
+    if status == 429:
+        return True
+    #Github signals primary/secondary rate limits with a 403
+    if status == 403:
+        return headers.get("X-RateLimit-Remaining") == "0" or "Retry-After" in headers
+    return False
+
+
+def should_retry(status, headers):
+    return status in RETRY_STATUS_CODES or is_rate_limited(status, headers)
+
+
+def retry_delay(status, headers, attempt):
+    #Server provided hints win over the computed backoff
+    if headers is not None:
+        retry_after = headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(float(retry_after), RATE_LIMIT_MAX_WAIT)
+            except ValueError:
+                try:
+                    return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0), RATE_LIMIT_MAX_WAIT)
+                except (TypeError, ValueError):
+                    pass
+
+        #Github: X-RateLimit-Reset, Gitlab: RateLimit-Reset (both epoch seconds)
+        reset = headers.get("X-RateLimit-Reset") or headers.get("RateLimit-Reset")
+        if reset and is_rate_limited(status, headers):
+            try:
+                return min(max(float(reset) - time.time(), 0) + 1, RATE_LIMIT_MAX_WAIT)
+            except ValueError:
+                pass
+
+    #Full jitter exponential backoff
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def record(host, latency, retried=False, failed=False):
+    with _STATS_LOCK:
+        stats = HOST_STATS[host]
+        stats["requests"] += 1
+        stats["latency"] += latency
+        if retried:
+            stats["retries"] += 1
+        if failed:
+            stats["errors"] += 1
+
+
+def request(method, url, headers=None, **kwargs):
+    #A stalled connection would otherwise hang its worker (and the whole epic) forever
+    kwargs.setdefault("timeout", TIMEOUT)
+    session = get_session()
+    host = urlparse(url).netloc
+    attempt = 0
+    call_start = time.perf_counter()
+    while True:
+        start = time.perf_counter()
+        try:
+            response = session.request(method, url, headers=headers, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record(host, time.perf_counter() - start, retried=attempt < MAX_RETRIES, failed=True)
+            if attempt >= MAX_RETRIES:
+                profiler.record_http(method, url, call_start, None, retries=attempt)
+                raise
+            delay = retry_delay(None, None, attempt)
+            print(colored(f"[!] {host}: {e.__class__.__name__}, retrying in {delay:.1f}s","yellow"))
+        else:
+            retry = should_retry(response.status_code, response.headers) and attempt < MAX_RETRIES
+            record(host, time.perf_counter() - start, retried=retry, failed=response.status_code >= 400)
+            if not retry:
+                #Streamed bodies are read later, Content-Length is the best guess for their size
+                nbytes = int(response.headers.get("Content-Length", 0) or 0) if kwargs.get("stream") else len(response.content)
+                profiler.record_http(method, url, call_start, response.status_code, nbytes, retries=attempt)
+                return response
+            delay = retry_delay(response.status_code, response.headers, attempt)
+            print(colored(f"[!] {host}: HTTP {response.status_code}, retrying in {delay:.1f}s","yellow"))
+            response.close()
+        time.sleep(delay)
+        attempt += 1
+
+
+def post(url, headers=None, **kwargs):
+    #Only used for read-only queries (GraphQL), so they are retried like GETs and never cached
+    return request("POST", url, headers=headers, **kwargs)
+
+
+def cached_response(url, entry):
+    #entry["body"] is bytes, or a file for streamed requests (read in chunks by iter_content like a network body)
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = CaseInsensitiveDict(entry["headers"])
+    response.encoding = get_encoding_from_headers(response.headers)
+    if isinstance(entry["body"], bytes):
+        response._content = entry["body"]
+        response._content_consumed = True
+    else:
+        response.raw = entry["body"]
+    response.from_cache = True
+    return response
+
+
+class CachingBody:
+    #Raw body of a streamed response: the chunks read by the caller are also spooled (to disk above SPOOL_BYTES)
+    #and stored in the cache once the body was read to its end, so streaming never holds the whole body in memory
+    def __init__(self, raw, store):
+        self.raw = raw
+        self.store = store
+        self.spool = tempfile.SpooledTemporaryFile(max_size=http_cache.SPOOL_BYTES)
+
+    def stream(self, amt=64 * 1024, decode_content=None):
+        for chunk in self.raw.stream(amt, decode_content=decode_content):
+            self.spool.write(chunk)
+            yield chunk
+        size = self.spool.tell()
+        self.spool.seek(0)
+        self.store(self.spool, size)
+        self.spool.close()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+def get(url, headers=None, immutable=False, **kwargs):
+    #immutable: the caller knows the answer is final (Ex: pages of a merged MR), it is cached without revalidation
+    #Streamed bodies (stream=True) are cached too, through a temp file once they have been read to the end
+    if CACHE is None:
+        return request("GET", url, headers=headers, **kwargs)
+
+    stream = kwargs.get("stream", False)
+    start = time.perf_counter()
+    key = CACHE.make_key(url, headers)
+    entry = CACHE.get(key, stream=stream)
+    if entry is not None and entry["immutable"]:
+        record_cache_hit(url)
+        profiler.record_http("GET", url, start, 200, entry["size"], cached=True)
+        return cached_response(url, entry)
+
+    request_headers = dict(headers or {})
+    if entry is not None and entry["etag"]:
+        request_headers["If-None-Match"] = entry["etag"]
+
+    response = request("GET", url, headers=request_headers, **kwargs)
+    if response.status_code == 304 and entry is not None:
+        response.close()
+        record_cache_hit(url)
+        return cached_response(url, entry)
+    if stream and entry is not None:
+        entry["body"].close()
+
+    if response.status_code == 200:
+        etag = response.headers.get("ETag")
+        immutable = immutable or http_cache.is_immutable_url(url)
+        if etag or immutable:
+            stored_headers = {name: response.headers[name] for name in CACHED_RESPONSE_HEADERS if name in response.headers}
+            if stream:
+                response.raw = CachingBody(response.raw, lambda fileobj, size: CACHE.put_file(key, url, stored_headers, fileobj, size, etag=etag, immutable=immutable))
+            else:
+                CACHE.put(key, url, stored_headers, response.content, etag=etag, immutable=immutable)
+    return response
+
+
+def spool_body(response, chunk_size=64 * 1024):
+    #Reads a streamed body now (Ex: a page prefetched by a worker thread) into a temp file, on disk above SPOOL_BYTES,
+    #the response is then read again by iter_content/iter_text like a streamed one
+    if isinstance(response.raw, tempfile.SpooledTemporaryFile) and response.raw.tell() == 0:
+        return response                             #Already spooled (Ex: by a concurrency-limited get), or a cache hit
+    spool = tempfile.SpooledTemporaryFile(max_size=http_cache.SPOOL_BYTES)
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        spool.write(chunk)
+    spool.seek(0)
+    response.raw = spool
+    response._content, response._content_consumed = False, False
+    return response
+
+
+def download_to_file(url, filepath, headers=None, chunk_size=64 * 1024):
+    #Streams the body to disk in chunks so large files never sit in memory
+    #Blobs/files addressed by a SHA are cached like any GET, a re-run copies them out of the cache without a request
+    response = get(url, headers=headers, stream=True)
+    with response, profiler.span("write", "download to file", path=filepath) as span_args:
+        response.raise_for_status()
+        folder = os.path.dirname(filepath)
+        if folder != "":
+            os.makedirs(folder, exist_ok=True)
+        sha256 = hashlib.sha256()
+        written = 0
+        with open(filepath, "wb") as fileptr:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                sha256.update(chunk)
+                fileptr.write(chunk)
+                written += len(chunk)
+        span_args["bytes"] = written
+    return {"path": filepath, "bytes": written, "sha256": sha256.hexdigest()}
+
+
+def iter_text(response, chunk_size=64 * 1024):
+    #Decoded chunks of a (streamed or already read) body
+    #requests assumes ISO-8859-1 for text/* without a charset, diffs and JSON are UTF-8 unless the server says otherwise
+    encoding = response.encoding if "charset" in response.headers.get("Content-Type", "") else "utf-8"
+    decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def iter_lines(response, chunk_size=64 * 1024):
+    #Lines of a streamed text body with their "\n" kept, requests' iter_lines drops them and also splits on a lone "\r"
+    pending = ""
+    for text in iter_text(response, chunk_size):
+        lines = (pending + text).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if pending:
+        yield pending
+
+
+def iter_json_array(response, chunk_size=64 * 1024):
+    #Elements of a top-level JSON array body, each one decoded and yielded as soon as it is complete,
+    #so a page of 100 diffs never exists as 100 parsed dicts at once
+    chunks = iter_text(response, chunk_size)
+    buffer, pos, started, finished = "", 0, False, False
+    retry_at = 0                                    #After an incomplete element, wait for twice the data before decoding again
+    while True:
+        while pos < len(buffer) and buffer[pos] in JSON_SEPARATORS:
+            pos += 1
+        if pos < len(buffer) and not started:
+            if buffer[pos] != "[":
+                raise ValueError(f"Expected a JSON array, got {buffer[pos:pos + 20]!r}")
+            started = True
+            pos += 1
+            continue
+        if pos < len(buffer) and buffer[pos] == "]":
+            for _ in chunks:
+                pass                                #Read to the end, so a streamed body gets cached
+            return
+        if pos < len(buffer) and (len(buffer) >= retry_at or finished):
+            try:
+                element, end = _JSON_DECODER.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if finished:
+                    raise
+                retry_at = 2 * len(buffer)
+            else:
+                #A number/literal only ends at a delimiter, "1.5e10" cut after "1.5" still decodes as 1.5
+                if finished or (end < len(buffer) and buffer[end] in JSON_DELIMITERS):
+                    yield element
+                    pos = end
+                    continue
+        if finished:
+            raise ValueError("JSON array ended before its closing bracket")
+        chunk = next(chunks, None)
+        if chunk is None:
+            finished = True
+        else:
+            retry_at -= pos
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+
+def mark_immutable(response, headers=None):
+    #For responses that only turn out to be final after reading them (Ex: merged MRs)
+    if getattr(response, "from_cache", False) or response.status_code != 200:
+        return
+    url = response.request.url if response.request is not None else response.url
+    store_immutable(url, headers, response.headers, response.content)
+
+
+def store_immutable(url, headers, response_headers, body):
+    if CACHE is None:
+        return
+    stored_headers = {name: response_headers[name] for name in CACHED_RESPONSE_HEADERS if name in response_headers}
+    CACHE.put(CACHE.make_key(url, headers), url, stored_headers, body, etag=response_headers.get("ETag"), immutable=True)
+
+
+async def async_get(session, url, headers=None):
+    #asyncio counterpart of get() for an aiohttp session: same retries, cache and stats, returns (status, headers, body)
+    import aiohttp
+
+    key, entry = None, None
+    request_headers = dict(headers or {})
+    call_start = time.perf_counter()
+    if CACHE is not None:
+        key = CACHE.make_key(url, headers)
+        entry = CACHE.get(key)
+        if entry is not None and entry["immutable"]:
+            record_cache_hit(url)
+            profiler.record_http("GET", url, call_start, 200, len(entry["body"]), cached=True)
+            return 200, CaseInsensitiveDict(entry["headers"]), entry["body"]
+        if entry is not None and entry["etag"]:
+            request_headers["If-None-Match"] = entry["etag"]
+
+    host = urlparse(url).netloc
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            async with session.get(url, headers=request_headers) as response:
+                status, response_headers, body = response.status, CaseInsensitiveDict(response.headers), await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            record(host, time.perf_counter() - start, retried=attempt < MAX_RETRIES, failed=True)
+            if attempt >= MAX_RETRIES:
+                profiler.record_http("GET", url, call_start, None, retries=attempt)
+                raise
+            delay = retry_delay(None, None, attempt)
+            print(colored(f"[!] {host}: {e.__class__.__name__}, retrying in {delay:.1f}s","yellow"))
+        else:
+            retry = should_retry(status, response_headers) and attempt < MAX_RETRIES
+            record(host, time.perf_counter() - start, retried=retry, failed=status >= 400)
+            if not retry:
+                profiler.record_http("GET", url, call_start, status, len(body), retries=attempt)
+                break
+            delay = retry_delay(status, response_headers, attempt)
+            print(colored(f"[!] {host}: HTTP {status}, retrying in {delay:.1f}s","yellow"))
+        await asyncio.sleep(delay)
+        attempt += 1
+
+    if status == 304 and entry is not None:
+        record_cache_hit(url)
+        return 200, CaseInsensitiveDict(entry["headers"]), entry["body"]
+
+    if CACHE is not None and status == 200:
+        etag = response_headers.get("ETag")
+        immutable = http_cache.is_immutable_url(url)
+        if etag or immutable:
+            stored_headers = {name: response_headers[name] for name in CACHED_RESPONSE_HEADERS if name in response_headers}
+            CACHE.put(key, url, stored_headers, body, etag=etag, immutable=immutable)
+    return status, response_headers, body
+
+
+def record_cache_hit(url):
+    with _STATS_LOCK:
+        HOST_STATS[urlparse(url).netloc]["cache_hits"] += 1
+
+
+def reset_stats():
+    with _STATS_LOCK:
+        HOST_STATS.clear()
+
+
+def print_stats():
+    with _STATS_LOCK:
+        if not HOST_STATS:
+            return
+        print(colored("\n[*] HTTP Requests per Host","cyan"))
+        for host, stats in sorted(HOST_STATS.items()):
+            avg_ms = stats["latency"] / stats["requests"] * 1000 if stats["requests"] else 0
+            print(colored(f"  {host}: ","yellow") + f"{stats['requests']} requests, {stats['cache_hits']} cache hits, {stats['retries']} retries, {stats['errors']} errors, avg {avg_ms:.0f}ms")
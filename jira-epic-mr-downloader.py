@@ -1,23 +1,50 @@
 #!/usr/bin/env python3
 
-import git
-import os,json,argparse
-import jira
-from jira import JIRA
-import requests
-from bs4 import BeautifulSoup as bs
-from lxml import etree
+import os,sys,json,argparse
+import http_client
+import http_cache
+import diff_utils
+import git_mirror
+import gitlab_diffs
+import jira_links
+import content_store
+import sync_state
+import url_utils
+import metadata_cache
+import batch_manifest
+import download_server
+import output_formats
+import profiler
 import re
 from termcolor import colored
 import urllib.parse
-import gitlab
-import urllib.request
 import threading,time
+import asyncio
 from urllib.parse import urlparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 
 
 OUTPUT_FOLDER = "jira-007-output"
 FUNC_COMPLETED = False
+WORKERS = 8
+EPIC_WORKERS = 4                                          #Epics processed at the same time with -uf/-jql
+PAGE_SIZE = 100
+MIRROR_THRESHOLD = git_mirror.MIRROR_THRESHOLD
+MIRROR_DIR = git_mirror.MIRROR_DIR
+EPIC_ISSUE_FIELDS = ["comment"]                           #Comments come back inline with the search, no per-issue fetch needed
+INLINE_COMMENTS = True
+LINK_SOURCE = "comments"                                  #Where MR links are read from, see jira_links.LINK_SOURCES
+DEV_STATUS_MISSING = False                                #Set once Jira answers 404 for the development panel, it is not asked again
+USE_CAS = False
+OUTPUT_WRITER = None                                      #output_formats writer shared by all epics (--format jsonl/tar/zip/patch)
+REQUESTS_SAVED = 0                                        #Per-issue Jira requests avoided by reading comments from the search
+LINK_REQUESTS = 0                                         #Per-issue Jira requests for remote links and the development panel
+SYNC_STATE = None                                         #sync_state.SyncState for incremental runs (--state-file)
+SYNC_SINCE = None                                         #Only issues updated since then are listed (--since, or the state file)
+COUNTERS_LOCK = threading.Lock()                          #Epics run in parallel threads with -uf/-jql
+JIRA_SEMAPHORE = threading.BoundedSemaphore(WORKERS)      #Max in-flight requests against Jira
+GITLAB_SEMAPHORE = threading.BoundedSemaphore(WORKERS)    #Max in-flight requests against Gitlab
 
 def print_progress(string):
     global FUNC_COMPLETED
@@ -31,10 +58,35 @@ def print_progress(string):
 
 def get_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-u','--url',dest='epic_url', help="Jira EPIC URL", required=True)
+    epic_group = parser.add_mutually_exclusive_group(required=True)
+    epic_group.add_argument('-u','--url',dest='epic_url', help="Jira EPIC URL")
+    epic_group.add_argument('-uf','--urlfile',dest='epic_url_file', help="File with one Jira EPIC URL per line (all on the same Jira host)")
+    epic_group.add_argument('-jql','--jql',dest='epic_jql', help='JQL selecting the epics to download (Ex: issuetype = Epic AND fixVersion = "1.2"), needs -jh')
+    parser.add_argument('-jh','--jirahost',dest='jira_host',help="Jira Host URL (needed with -jql)")
+    parser.add_argument('--epic-workers',dest='epic_workers',type=int,default=EPIC_WORKERS,help=f"Epics processed at the same time with -uf/-jql (Default: {EPIC_WORKERS})")
     parser.add_argument('-gt','--gittoken',dest='gitlab_token',help="Gitlab Token (Optional: Fetched from Env: GITLAB_API_TOKEN)")
     parser.add_argument('-jt','--jiratoken',dest='jira_token',help="Jira Token (Optional: Fetched from Env: JIRA_API_TOKEN)")
     parser.add_argument('-gh','--gitlabhost',dest='gitlab_host',help="Gitlab Host URL (If provided,it verifies if GITLAB_TOKEN is valid initially else proceeds directly)")
+    parser.add_argument('-w','--workers',dest='workers',type=int,default=WORKERS,help=f"Number of parallel workers for issue/MR fetches (Default: {WORKERS})")
+    parser.add_argument('--jira-limit',dest='jira_limit',type=int,help="Max concurrent requests to Jira (Default: same as --workers)")
+    parser.add_argument('--mirror-threshold',dest='mirror_threshold',type=int,default=MIRROR_THRESHOLD,help=f"Changed files above which a local blobless git mirror is used instead of the API (Default: {MIRROR_THRESHOLD})")
+    parser.add_argument('--mirror-dir',dest='mirror_dir',default=MIRROR_DIR,help=f"Directory for the local git mirrors (Default: {MIRROR_DIR})")
+    parser.add_argument('--pool-size',dest='pool_size',type=int,default=http_client.POOL_SIZE,help=f"HTTP connections kept alive per host (Default: {http_client.POOL_SIZE})")
+    parser.add_argument('--retries',dest='retries',type=int,default=http_client.MAX_RETRIES,help=f"Retries on 429/5xx/connection errors (Default: {http_client.MAX_RETRIES})")
+    parser.add_argument('--cache-dir',dest='cache_dir',default=http_cache.CACHE_DIR,help=f"Directory for the HTTP response cache (Default: {http_cache.CACHE_DIR})")
+    parser.add_argument('--no-cache',action="store_true",dest='no_cache',help="Disable the HTTP response cache",default=False)
+    parser.add_argument('--cas',action="store_true",dest='use_cas',help="Write a content-addressed store (objects/ + index/ per MR and issue) instead of one file per path",default=False)
+    parser.add_argument('--format',dest='output_format',choices=output_formats.FORMATS,default="files",help="files: one file per path (Default), jsonl/tar/zip: one compressed archive of lossless per-file records, patch: one git-apply-able .patch")
+    parser.add_argument('-o','--output',dest='output',help=f"Output file for --format jsonl/tar/zip/patch (Default: {OUTPUT_FOLDER}/jira-<time>.<ext>)")
+    parser.add_argument('--async',action="store_true",dest='use_async',help="Use the asyncio engine (single thread, streaming Jira -> MR -> file pipeline, needs aiohttp)",default=False)
+    parser.add_argument('--queue-size',dest='queue_size',type=int,default=100,help="Max items buffered between stages of the --async engine (Default: 100)")
+    parser.add_argument('--link-source',dest='link_source',choices=jira_links.LINK_SOURCES,default=LINK_SOURCE,help="comments: scan the comments, read with the search (Default), links: issue remote links + development panel (2-3 more Jira requests per issue), comments only when those cannot be read, all: both")
+    parser.add_argument('--per-issue-fetch',action="store_true",dest='per_issue_fetch',help="Fetch comments with one request per issue instead of inline in the search",default=False)
+    parser.add_argument('--gitlab-limit',dest='gitlab_limit',type=int,help="Max concurrent requests to Gitlab (Default: same as --workers)")
+    parser.add_argument('--state-file',dest='state_file',help="Incremental sync: remember the last sync time and MR head SHAs here, later runs only fetch issues updated since and skip unchanged MRs")
+    parser.add_argument('--since',dest='since',help="Only look at issues updated since this date (YYYY-MM-DD[ HH:MM]), overrides the time from --state-file")
+    parser.add_argument('--server',dest='server',nargs='?',const=download_server.DEFAULT_ADDRESS,metavar='ADDRESS',help=f"Run on a download_server.py (Unix socket path or host:port, Default: {download_server.DEFAULT_ADDRESS}) with its warm connections, cache and token checks, runs here if none answers")
+    parser.add_argument('--profile',dest='profile',nargs='?',const="",metavar='TRACE_FILE',help="Print per-endpoint timings (count, total, p50/p95/max) at the end, and also write a Chrome trace JSON if a file is given")
     args = parser.parse_args()
 
     if not args.gitlab_token and not os.getenv("GITLAB_API_TOKEN"):
@@ -43,160 +95,843 @@ def get_args():
     if not args.jira_token and not os.getenv("JIRA_API_TOKEN"):
         exit(colored("[-] Error: Could not fetch Env Variable JIRA_API_TOKEN. Please set it or provide argument -jt <token>","red"))
 
+    if args.workers < 1 or args.epic_workers < 1:
+        exit(colored("[-] Error: --workers and --epic-workers should be at least 1","red"))
+
+    if args.use_cas and args.output_format != "files":
+        exit(colored("[-] Error: --cas and --format jsonl/tar/zip/patch cannot be combined","red"))
+
+    if args.epic_jql and not args.jira_host:
+        exit(colored("[-] Error: -jql needs the Jira host (-jh <url>)","red"))
+
+    if args.since:
+        try:
+            args.since = sync_state.parse_since(args.since)
+        except ValueError as e:
+            exit(colored(f"[-] Error: --since: {e}","red"))
 
     return args
 
 # Jira authentication details
 def Get_Jira_Object(jira_url):
+    from jira import JIRA                                        #Slow import, only paid by the threaded engine and -jql
     global JIRA_API_TOKEN
     headers = JIRA.DEFAULT_OPTIONS["headers"].copy()
     headers["Authorization"] = f"Bearer {JIRA_API_TOKEN}"
     jira=JIRA(server=jira_url, options={"headers": headers})
+    if profiler.ENABLED:
+        jira._session.hooks["response"].append(profiler.response_hook)   #The jira library has its own session
     return jira
 
 
-def Get_All_Issues_From_Epic(jira,jira_epic_link):
-    global FUNC_COMPLETED
-    print_progress_thread = threading.Thread(target=print_progress, args=("[*] Fetching All Jira Issues",))
-    print_progress_thread.start()
-
-    epic_name = jira_epic_link.split('/')[-1]
-    jql_query = f'"Epic Link" = {epic_name}'
-
-    #Get all issues in the epic
-    issues = jira.search_issues(jql_query, maxResults=100)
-    FUNC_COMPLETED = True                                    #This will make the while loop false in the print_progress
+def Get_Epic_JQL(epic_name, since=None, retry_keys=()):
+    #Ex: "Epic Link" = PROJ-123 AND (updated >= "2024/05/01 08:30" OR key in (PROJ-7))
+    return f'"Epic Link" = {epic_name}' + sync_state.jql_since_clause(since, retry_keys)
+
+
+def Check_Retry_Keys(epic_name, output):
+    #Issues that failed on the last sync are looked up one by one before they go into the epic query (see sync_state.split_retry_keys),
+    #the ones that could not be looked up are kept in the state for the next sync
+    if SYNC_STATE is None or SYNC_SINCE is None:
+        return []
+    keys, statuses = SYNC_STATE.failed_issues(epic_name), {}
+    for key in keys:
+        try:
+            statuses[key] = Jira_Get(f"{JIRA_BASE_URL}/rest/api/2/issue/{key}?fields=key").status_code
+        except Exception:
+            statuses[key] = None
+    retry_keys, unchecked, dropped = sync_state.split_retry_keys(keys, statuses)
+    output.failed_issues.update(unchecked)
+    if dropped:
+        print(colored(f"[!] {epic_name}: issues that failed on the last sync no longer exist or are not readable, not retried: {', '.join(dropped)}","yellow"))
+    return retry_keys
+
+
+def Iter_Epic_Issue_Pages(jira, jql_query, fields=EPIC_ISSUE_FIELDS, page_size=PAGE_SIZE):
+    #Yields one page (list of raw issue dicts) at a time, so processing can start before the whole epic is listed
+    if jira._is_cloud:
+        #Jira Cloud only supports token based pagination on the new search API
+        next_page_token = None
+        while True:
+            page = jira.enhanced_search_issues(jql_query, nextPageToken=next_page_token, maxResults=page_size, fields=fields, json_result=True)
+            issues = page.get("issues", [])
+            if issues:
+                yield issues
+            next_page_token = page.get("nextPageToken")
+            if not issues or not next_page_token or page.get("isLast", False):
+                return
+    else:
+        start_at = 0
+        while True:
+            page = jira.search_issues(jql_query, startAt=start_at, maxResults=page_size, fields=fields, json_result=True)
+            issues = page.get("issues", [])
+            if issues:
+                yield issues
+            start_at += len(issues)
+            if not issues or start_at >= page.get("total", 0):
+                return
+
+
+def Has_Inline_Comments(issue):
+    #Search results may hold only the first N comments of chatty issues, those still need the full issue fetch
+    comment_field = issue.get("fields", {}).get("comment")
+    if not comment_field:
+        return False
+    return len(comment_field.get("comments", [])) >= comment_field.get("total", 0)
+
+
+def Get_Search_Fields():
+    #Comments are only worth listing with the search when they are going to be scanned
+    return EPIC_ISSUE_FIELDS if INLINE_COMMENTS and LINK_SOURCE != "links" else ["key"]
+
+
+def Submit_Issue_Lookup(issue_pool, issue):
+    if LINK_SOURCE != "comments":
+        return issue_pool.submit(Get_Issue_Links, issue)
+    inline_links = Get_Inline_Comment_Links(issue)
+    if inline_links is None:
+        return issue_pool.submit(Get_Git_Commit_Link_From_Issue, issue["key"])
+    issue_future = Future()
+    issue_future.set_result(inline_links)
+    return issue_future
+
+
+def Get_Inline_Comment_Links(issue):
+    #None when the comments did not come (complete) with the search and need the issue fetch
+    global REQUESTS_SAVED
+    if not (INLINE_COMMENTS and Has_Inline_Comments(issue)):
+        return None
+    with COUNTERS_LOCK:
+        REQUESTS_SAVED += 1
+    return Get_MR_Urls_From_Comments(issue["fields"])
+
+
+def Jira_Get(url):
+    with JIRA_SEMAPHORE:
+        return http_client.get(url, headers={"Authorization": f"Bearer {JIRA_API_TOKEN}", "Accept": "application/json"})
+
+
+def Count_Link_Requests(count=1):
+    global LINK_REQUESTS
+    with COUNTERS_LOCK:
+        LINK_REQUESTS += count
+
+
+def Get_Issue_Links(issue):
+    #Remote links and development panel are a few hundred bytes per issue, but 2-3 requests each,
+    #the comments are only scanned when the remote links could not be read (or with --link-source all)
+    links, errors = [], []
+    remote_links_read = False
+    try:
+        Count_Link_Requests()
+        response = Jira_Get(jira_links.remote_links_url(JIRA_BASE_URL, issue["key"]))
+        response.raise_for_status()
+        links = jira_links.links_from_remote_links(response.json())
+        remote_links_read = True
+    except Exception as e:
+        errors.append(e)
+    try:
+        links = jira_links.merge_links(links, Get_Dev_Status_Links(issue["id"]))
+    except Exception as e:
+        errors.append(e)
+
+    if LINK_SOURCE == "all" or not remote_links_read:
+        comment_links, comment_errors = Get_Inline_Comment_Links(issue) or Get_Git_Commit_Link_From_Issue(issue["key"])
+        links = jira_links.merge_links(links, comment_links)
+        errors.extend(comment_errors)
+    return links, errors
+
+
+def Get_Dev_Status_Links(issue_id):
+    #The summary says which integrations (Gitlab, Github...) have pull/merge requests, only those are asked for the links
+    global DEV_STATUS_MISSING
+    if DEV_STATUS_MISSING:
+        return []
+    Count_Link_Requests()
+    response = Jira_Get(jira_links.dev_status_summary_url(JIRA_BASE_URL, issue_id))
+    if response.status_code == 404:
+        DEV_STATUS_MISSING = True
+        return []
+    response.raise_for_status()
+    links = []
+    for application in jira_links.dev_status_applications(response.json()):
+        Count_Link_Requests()
+        response = Jira_Get(jira_links.dev_status_detail_url(JIRA_BASE_URL, issue_id, application))
+        response.raise_for_status()
+        links = jira_links.merge_links(links, jira_links.links_from_dev_status(response.json()))
+    return links
+
+
+class EpicOutput:
+    #Deduplicates MR links across the whole epic and writes their files (tree layout, content-addressed store with --cas,
+    #or records appended to a shared output_formats writer with --format)
+    def __init__(self, epic_name, use_cas=False, writer=None):
+        self.epic_name = epic_name
+        self.writer = writer
+        self.store = content_store.ContentStore(os.path.join(OUTPUT_FOLDER, epic_name)) if use_cas else None
+        self.issue_mrs = {}                                      #issue key -> normalized MR URLs
+        self.mr_issues = {}                                      #normalized MR URL -> issue keys linking it
+        self.mr_files = {}                                       #normalized MR URL -> {path: sha256} (content store only)
+        self.other_links = set()                                 #Github PRs and commits, found but not downloaded
+        self.failed_issues = set()                               #Issues whose links could not be (fully) read
+        self.failed_mrs = set()                                  #MRs that could not be fetched
+        self.duplicates = 0
+
+    def add_link(self, issue_key, mr_url):
+        #Returns the MR URL to fetch, or None when another issue/comment already queued the same MR
+        mr_url = url_utils.normalize_url(mr_url)
+        if jira_links.link_kind(mr_url) != "merge_request":
+            self.other_links.add(mr_url)
+            return None
+        issue_links = self.issue_mrs.setdefault(issue_key, [])
+        if mr_url not in issue_links:
+            issue_links.append(mr_url)
+        if mr_url in self.mr_issues:
+            if issue_key not in self.mr_issues[mr_url]:
+                self.mr_issues[mr_url].append(issue_key)
+            self.duplicates += 1
+            return None
+        self.mr_issues[mr_url] = [issue_key]
+        return mr_url
+
+    def failed_issue_keys(self):
+        #An incremental sync lists these issues again next time, so their MRs are retried
+        keys = set(self.failed_issues)
+        for mr_url in self.failed_mrs:
+            keys.update(self.mr_issues.get(mr_url, []))
+        return keys
+
+    def write_changes(self, mr_url, changes, log=print):
+        written = []
+        if self.writer is not None:
+            source = output_formats.make_source(mr_url, git_mirror.get_project_path(mr_url), "merge_request", mr_url.split("/")[-1], epic=self.epic_name)
+            for change in changes:
+                item = self.writer.write(source, change)
+                log(colored(f"  --> {item['path']}","white"))
+                written.append(item)
+            return written
+
+        if self.store is None:
+            #One folder per MR, MRs of the epic touching the same path would overwrite each other's files otherwise
+            mr_folder = Get_MR_Folder(mr_url)
+            for change in changes:
+                written.append(create_diff_file(os.path.join(mr_folder, change['new_path']), change['diff'], self.epic_name, log=log))
+            return written
+
+        mr_files = self.mr_files.setdefault(mr_url, {})
+        for change in changes:
+            item = self.store.put_diff(change['diff'], keep_removed=False)
+            mr_files[change['new_path']] = item["sha256"]
+            log(colored(f"  --> {change['new_path']} ","white") + colored(f"({item['sha256'][:12]})","light_grey"))
+            written.append(item)
+        return written
+
+    def finish(self, log=print):
+        log(colored(f"[*] Duplicate MR links skipped in {self.epic_name}: {self.duplicates}","cyan"))
+        if self.other_links:
+            log(colored(f"[*] PR/commit links found in {self.epic_name} but not downloaded (only Gitlab MRs are): {len(self.other_links)}","cyan"))
+        if self.store is not None:
+            self.store.write_indexes(self.issue_mrs, self.mr_issues, self.mr_files)
+            log(colored(f"[*] Content store: {self.store.objects_written} objects written, {self.store.objects_reused} identical versions reused ({self.store.root})","cyan"))
+
+
+def Get_Epic_Urls_From_JQL(jira, jql_query):
+    epic_urls = []
+    for issues in Iter_Epic_Issue_Pages(jira, jql_query, fields=["key"]):
+        epic_urls.extend(f"{JIRA_BASE_URL}/browse/{issue['key']}" for issue in issues)
+    return epic_urls
+
+
+def Get_All_Epics(jira, jira_epic_links):
+    #Returns the epic URLs that failed, the epics share the JIRA object, HTTP session, cache and request limits
+    if len(jira_epic_links) == 1:
+        Get_All_Issues_From_Epic(jira, jira_epic_links[0])
+        return []
+
+    print(colored(f"[*] Downloading {len(jira_epic_links)} epics, {EPIC_WORKERS} at a time","cyan"))
+    failed = []
+    with ThreadPoolExecutor(max_workers=EPIC_WORKERS) as epic_pool:
+        epic_futures = [(link, epic_pool.submit(Get_All_Issues_From_Epic, jira, link, show_progress=False)) for link in jira_epic_links]
+        for link, epic_future in epic_futures:
+            try:
+                epic_future.result()
+            except Exception as e:
+                failed.append(link)
+                print(colored(f"ERROR: {link}: {e}","red"))
+    print(colored(f"\n[*] Epics: {len(jira_epic_links) - len(failed)} completed, {len(failed)} failed","cyan"))
+    return failed
 
-    print(issues)
-    for issue in issues:
-        # print(f"{issue.key}: {issue.fields.summary}")      #Print Issue Summary
-        # print(f"{issue.key}: {issue.permalink()}")          #Print Issue URL
-        Get_Git_Commit_Link_From_Issue(issue.key, epic_name)
 
+def Get_All_Issues_From_Epic(jira,jira_epic_link,show_progress=True):
+    global FUNC_COMPLETED
+    #The spinner is only drawn for a single epic, parallel epics would fight over the line
+    if show_progress:
+        print_progress_thread = threading.Thread(target=print_progress, args=("[*] Fetching All Jira Issues",))
+        print_progress_thread.start()
 
-def Get_Git_Commit_Link_From_Issue(issueKey, epic_name):
+    epic_name = jira_epic_link.split('/')[-1]
+    output = EpicOutput(epic_name, use_cas=USE_CAS, writer=OUTPUT_WRITER)
+    jql_query = Get_Epic_JQL(epic_name, SYNC_SINCE, Check_Retry_Keys(epic_name, output))
+
+    #Issue lookups and MR fetches run in the pools, but results are consumed (printed/written) in issue order
+    with ThreadPoolExecutor(max_workers=WORKERS) as issue_pool, ThreadPoolExecutor(max_workers=WORKERS) as mr_pool:
+        pending_mrs = deque()
+        total_issues = 0
+
+        try:
+            #Get all issues in the epic, page by page
+            for issues in Iter_Epic_Issue_Pages(jira, jql_query, fields=Get_Search_Fields()):
+                if show_progress and not FUNC_COMPLETED:
+                    FUNC_COMPLETED = True                        #This will make the while loop false in the print_progress
+                    print_progress_thread.join()
+
+                print(colored(f"\n[*] {epic_name}: Fetched Issues {total_issues + 1}-{total_issues + len(issues)}: ","cyan") + ", ".join(issue["key"] for issue in issues))
+                total_issues += len(issues)
+
+                issue_futures = [Submit_Issue_Lookup(issue_pool, issue) for issue in issues]
+                for issue, issue_future in zip(issues, issue_futures):
+                    try:
+                        mr_urls, errors = issue_future.result()
+                    except Exception as e:
+                        output.failed_issues.add(issue["key"])
+                        print(colored(f"ERROR: {issue['key']}: {e}","red"))
+                        continue
+
+                    for error in errors:
+                        output.failed_issues.add(issue["key"])
+                        print(colored(f"ERROR: {error}","red"))
+
+                    for mr_url in mr_urls:
+                        mr_url = output.add_link(issue["key"], mr_url)
+                        if mr_url is not None:
+                            pending_mrs.append((mr_url, mr_pool.submit(Fetch_MR_Changes, mr_url, epic_name)))
+
+                    #Write out whatever is already finished at the head of the queue
+                    while pending_mrs and pending_mrs[0][1].done():
+                        Write_MR_Changes(*pending_mrs.popleft(), output)
+        finally:
+            if show_progress and not FUNC_COMPLETED:
+                FUNC_COMPLETED = True
+                print_progress_thread.join()
+
+        while pending_mrs:
+            Write_MR_Changes(*pending_mrs.popleft(), output)
+
+    print(colored(f"\n[*] Total Issues in {epic_name}: {total_issues}","cyan"))
+    output.finish()
+    if SYNC_STATE is not None:
+        SYNC_STATE.set_failed_issues(epic_name, output.failed_issue_keys())
+
+
+def Get_Git_Commit_Link_From_Issue(issueKey):
     global JIRA_API_TOKEN
     global JIRA_BASE_URL
 
     api_url = f"{JIRA_BASE_URL}/rest/api/latest/issue/{issueKey}"
     headers =  {"Authorization" : f"Bearer {JIRA_API_TOKEN}"}
 
-    response = requests.get(api_url,headers=headers)
+    with JIRA_SEMAPHORE:
+        response = http_client.get(api_url,headers=headers)
     json_data = json.loads(response.text)
 
+    return Get_MR_Urls_From_Comments(json_data.get("fields", {}))
+
 
+def Get_MR_Urls_From_Comments(issue_fields):
+    #Runs in a worker thread, so errors are returned to the caller instead of being printed here
+    #Every MR/PR/commit link of every comment, not only the Gitlab integration's "[a merge request|<url>]"
+    mr_urls, errors = [], []
     try:
-        for item in json_data["fields"]["comment"]["comments"]:
-            mergeReqBody = item["body"]
-            try:
-                if "merge_requests" in mergeReqBody:
-                    pattern = r"a merge request\|([^]]+)"
-                    result = re.search(pattern, mergeReqBody)
-                    mr_url = result.group(1)
-                    print(colored(f"\n[-] {mr_url}","magenta"))
-                    Download_Code_From_MR(mr_url,epic_name)
-            except Exception as e:
-                print(colored(f"ERROR: {e}","red"))
+        mr_urls = jira_links.links_from_comments(issue_fields)
     except Exception as e:
-        print(colored(f"ERROR: {e}","red"))
+        errors.append(e)
 
+    return mr_urls, errors
 
-def Download_Code_From_MR(mr_url,epic_name):
-    global GITLAB_API_TOKEN    
 
-    parsed_url = urlparse(mr_url)
-    GITLAB_BASE_URL = f"{parsed_url.scheme}://{parsed_url.netloc}"   #Uncomment this and delete below line later
+def Get_MR_Folder(mr_url):
+    # url = "https://gitlab.host.com/group/subgroup/project/-/merge_requests/177" -> group_subgroup_project_177
+    _, project_path, _, merge_request_id = url_utils.parse_gitlab_url(mr_url)
+    return f"{project_path.replace('/', '_')}_{merge_request_id}"
+
+
+def Get_MR_Api_Url(mr_url):
+    # url = "https://gitlab.sickuritywizard.com/baseproject/subgroup/projectName/-/merge_requests/177"
+    GITLAB_BASE_URL, project_path, _, merge_request_id = url_utils.parse_gitlab_url(mr_url)
     GITLAB_API = f"{GITLAB_BASE_URL}/api/v4/"
+    project_id = metadata_cache.project_ref(GITLAB_BASE_URL, project_path)    #Numeric id once an MR of the project was fetched
+
+    return f"{GITLAB_API}projects/{project_id}/merge_requests/{merge_request_id}"
+
 
-    # url = "https://gitlab.sickuritywizard.com/baseproject/projectName/-/merge_requests/177"
-    url_parts = mr_url.split("/")
-    project_id = url_parts[3] + "%2F" + url_parts[4]
-    merge_request_id = url_parts[7]
+def Record_Project_Id(mr_url, response_json):
+    #Every MR response carries its numeric project id, remembered across runs without an extra lookup
+    GITLAB_BASE_URL, project_path, _, _ = url_utils.parse_gitlab_url(mr_url)
+    metadata_cache.record_project_id(GITLAB_BASE_URL, project_path, response_json.get("project_id"))
 
-    # Build API URL for merge request changes
-    api_url = f"{GITLAB_API}projects/{project_id}/merge_requests/{merge_request_id}/changes"
+
+def Gitlab_Get(url, **kwargs):
+    #A streamed body (Ex: /diffs pages) is read into a temp file before the slot is released,
+    #so --workers limits the transfers and not only the wait for the headers
+    with GITLAB_SEMAPHORE:
+        response = http_client.get(url, **kwargs)
+        return http_client.spool_body(response) if kwargs.get("stream") else response
+
+
+def Fetch_MR_Changes(mr_url, epic_name=None, stream=False):
+    #Returns (changes, MR info), changes is None when the MR is unchanged since the last sync
+    #stream: changes is an iterator fetching the diff pages while it is consumed, instead of a list
+    global GITLAB_API_TOKEN
+
+    #Merged MRs can never change again, so they are skipped without even asking Gitlab
+    if SYNC_STATE is not None and SYNC_STATE.is_merged(epic_name, mr_url):
+        return None, SYNC_STATE.get(epic_name, mr_url)
 
     # Add GitLab API access token to request headers
     headers = {"PRIVATE-TOKEN": GITLAB_API_TOKEN}
 
-    # Send GET request to GitLab API
-    response = requests.get(api_url, headers=headers)
-
-    # Parse and return changes from response
+    #The cheap MR metadata call gives the head SHA for incremental syncs and the change count, the diffs come page by page
+    api_url = Get_MR_Api_Url(mr_url)
+    response = Gitlab_Get(api_url, headers=headers)
+    response.raise_for_status()
     response_json = response.json()
+    Record_Project_Id(mr_url, response_json)
+    info = sync_state.mr_info(response_json)
+    if SYNC_STATE is not None and SYNC_STATE.is_unchanged(epic_name, mr_url, info):
+        return None, info
 
-    changes = response_json["changes"]
-    for change in changes:
-        filepath = change['new_path']
-        diff = change['diff']
-        create_diff_file(filepath,diff,epic_name)
+    merged = response_json.get("state") == "merged"
+    if merged:
+        http_client.mark_immutable(response, headers)             #Merged MRs never change, skip revalidation on re-runs
 
-    # return response_json["changes"]
+    if git_mirror.needs_mirror_for_count(response_json, MIRROR_THRESHOLD):
+        return Get_MR_Changes_From_Mirror(mr_url, response_json["diff_refs"], GITLAB_API_TOKEN), info
+    changes = gitlab_diffs.iter_mr_diffs(api_url, headers, immutable=merged, get=Gitlab_Get)
+    #The epic writes MRs in issue order after they were fetched in the pool, meanwhile they wait in temp files
+    return (changes if stream else gitlab_diffs.spool_changes(changes)), info
 
-def create_diff_file(filepath,diff,epic_name):
-    filepath    = os.path.join(OUTPUT_FOLDER,epic_name,filepath)    #To create file   (Ex: jira-007-output/EPIC_ID/api/xxx/myfile.text)
-    folder_path = "/".join(filepath.split("/")[:-1])                #To create folder (Ex: jira-007-output/EPIC_ID/api/xxx)
 
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
+def Get_MR_Changes_From_Mirror(mr_url, diff_refs, gitlab_token):
+    #Truncated or huge MR: rebuild the change list from a local blobless mirror instead
+    mirror = git_mirror.get_mirror(mr_url, gitlab_token, MIRROR_DIR)
+    mirror.fetch(diff_refs["base_sha"], diff_refs["head_sha"])
+    return gitlab_diffs.spool_changes(mirror.iter_changes(diff_refs["base_sha"], diff_refs["head_sha"]))
 
-    with open(filepath,"w") as diff_file:
-        diff_file.write(diff)
 
-    beautify_file(filepath)
+def Write_MR_Changes(mr_url, changes_future, output):
+    print(colored(f"\n[-] {mr_url}","magenta"))
+    try:
+        changes, info = changes_future.result()
+    except Exception as e:
+        output.failed_mrs.add(mr_url)
+        print(colored(f"ERROR: {e}","red"))
+        return
 
+    if changes is None:
+        with COUNTERS_LOCK:
+            SYNC_STATE.skipped += 1
+        print(colored("  --> Unchanged since the last sync, skipped","light_grey"))
+        return
 
-def beautify_file(filepath):
-    with open(filepath,"r") as diff_file:
-        processed_file_content = ""
-        for line in diff_file:
-            if line.startswith("+"):
-                processed_file_content += line[1:]
-            elif line.startswith("-"):
-                continue
-            else:
-                line = re.sub(r'@@ -\d+,\d+ \+\d+,\d+ @@ ', '', line)
-                processed_file_content += line
+    output.write_changes(mr_url, changes)
+    if SYNC_STATE is not None:
+        SYNC_STATE.record(output.epic_name, mr_url, info)
 
-    with open(filepath,"w") as diff_file:
-        diff_file.write(processed_file_content)
 
-    print(colored(f"  --> {filepath}","white"))
+def Download_Code_From_MR(mr_url,epic_name):
+    changes, _ = Fetch_MR_Changes(mr_url, epic_name, stream=True)
+    for change in changes or []:
+        create_diff_file(os.path.join(Get_MR_Folder(mr_url),change['new_path']),change['diff'],epic_name)
+
+def create_diff_file(filepath,diff,epic_name,log=print):
+    filepath    = os.path.join(OUTPUT_FOLDER,epic_name,filepath)    #To create file   (Ex: jira-007-output/EPIC_ID/group_project_177/api/xxx/myfile.text)
+    written = diff_utils.write_diff_file(filepath, diff, keep_removed=False)
+    log(colored(f"  --> {filepath}","white"))
+    return written
+
+
+class Progress:
+    #Live counters for the async engine, redrawn in place on one status line instead of the spinner thread
+    def __init__(self):
+        self.issues_scanned = 0
+        self.mrs_found = 0
+        self.files_written = 0
+        self.bytes_written = 0
+        self.requests_saved = 0
+        self.link_requests = 0
+        self.failed_epics = []
+        self.start = time.perf_counter()
+
+    def render(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-6)
+        return (f"[*] Issues scanned: {self.issues_scanned} | MRs found: {self.mrs_found} | "
+                f"Files written: {self.files_written} | {self.bytes_written / elapsed / 1024:.1f} KB/s")
+
+    def draw(self):
+        print(colored(f"\r\033[K{self.render()}","red"), end="", flush=True)
+
+    def log(self, text):
+        #Regular output goes above the status line
+        print(f"\r\033[K{text}")
+        self.draw()
+
+    async def run(self, interval=0.5):
+        while True:
+            self.draw()
+            await asyncio.sleep(interval)
+
+
+async def Fan_Out(in_queue, pending_queue, coroutine_func):
+    #Starts coroutine_func(item) as soon as an item arrives but hands the (item, task) pairs on in arrival order
+    #pending_queue is bounded, so at most its maxsize tasks are in flight (backpressure on the previous stage)
+    while True:
+        item = await in_queue.get()
+        if item is None:
+            await pending_queue.put(None)
+            return
+        await pending_queue.put((item, asyncio.ensure_future(coroutine_func(item))))
+
+
+async def Async_Get_All_Issues_From_Epic(jira_base_url, jira_token, gitlab_token, jira_epic_link, **kwargs):
+    return await Async_Get_All_Epics(jira_base_url, jira_token, gitlab_token, [jira_epic_link], **kwargs)
+
+
+async def Async_Get_All_Epics(jira_base_url, jira_token, gitlab_token, jira_epic_links,
+                              jira_limit=WORKERS, gitlab_limit=WORKERS, queue_size=100, inline_comments=True, link_source=LINK_SOURCE,
+                              use_cas=False, since=None, state=None, epic_limit=EPIC_WORKERS, writer=None):
+    import aiohttp                                               #Only needed for --async
+
+    #One session, cache and set of limits for every epic, each epic runs its own pipeline:
+    #Stage 1: Jira page fetch -> Stage 2: MR URL extraction -> Stage 3: Gitlab change fetch + file write
+    jira_headers = {"Authorization": f"Bearer {jira_token}", "Accept": "application/json"}
+    gitlab_headers = {"PRIVATE-TOKEN": gitlab_token}
+    jira_semaphore = asyncio.Semaphore(jira_limit)
+    gitlab_semaphore = asyncio.Semaphore(gitlab_limit)
+    epic_semaphore = asyncio.Semaphore(epic_limit)
+    progress = Progress()
+
+    connector = aiohttp.TCPConnector(limit=jira_limit + gitlab_limit, limit_per_host=max(jira_limit, gitlab_limit))
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        async def get_json(url, headers, semaphore):
+            async with semaphore:
+                status, _, body = await http_client.async_get(session, url, headers)
+            if status >= 400:
+                raise RuntimeError(f"HTTP {status} from {url}")
+            return json.loads(body)
+
+        server_info = await get_json(f"{jira_base_url}/rest/api/2/serverInfo", jira_headers, jira_semaphore)
+
+        dev_status_missing = False
+
+        async def get_comment_links(issue):
+            if inline_comments and Has_Inline_Comments(issue):
+                progress.requests_saved += 1
+                return Get_MR_Urls_From_Comments(issue["fields"])
+            json_data = await get_json(f"{jira_base_url}/rest/api/latest/issue/{issue['key']}", jira_headers, jira_semaphore)
+            return Get_MR_Urls_From_Comments(json_data.get("fields", {}))
+
+        async def get_dev_status_links(issue_id):
+            #Same steps as Get_Dev_Status_Links
+            nonlocal dev_status_missing
+            if dev_status_missing:
+                return []
+            progress.link_requests += 1
+            async with jira_semaphore:
+                status, _, body = await http_client.async_get(session, jira_links.dev_status_summary_url(jira_base_url, issue_id), jira_headers)
+            if status == 404:
+                dev_status_missing = True
+                return []
+            if status >= 400:
+                raise RuntimeError(f"HTTP {status} from the development panel of issue {issue_id}")
+            applications = jira_links.dev_status_applications(json.loads(body))
+            progress.link_requests += len(applications)
+            details = await asyncio.gather(*(get_json(jira_links.dev_status_detail_url(jira_base_url, issue_id, application), jira_headers, jira_semaphore)
+                                             for application in applications))
+            return jira_links.merge_links(*(jira_links.links_from_dev_status(detail) for detail in details))
+
+        async def resolve_issue(issue):
+            #Same steps as Get_Issue_Links, the remote links and the development panel are asked at once
+            if link_source == "comments":
+                return await get_comment_links(issue)
+            progress.link_requests += 1
+            remote_links, dev_status_links = await asyncio.gather(get_json(jira_links.remote_links_url(jira_base_url, issue["key"]), jira_headers, jira_semaphore),
+                                                                  get_dev_status_links(issue["id"]), return_exceptions=True)
+            links, errors = [], [result for result in (remote_links, dev_status_links) if isinstance(result, Exception)]
+            if not isinstance(remote_links, Exception):
+                links = jira_links.links_from_remote_links(remote_links)
+            if not isinstance(dev_status_links, Exception):
+                links = jira_links.merge_links(links, dev_status_links)
+            if link_source == "all" or isinstance(remote_links, Exception):
+                comment_links, comment_errors = await get_comment_links(issue)
+                links = jira_links.merge_links(links, comment_links)
+                errors.extend(comment_errors)
+            return links, errors
+
+        async def get_mr_diffs(api_url, immutable):
+            #Same pages as gitlab_diffs.iter_mr_diffs, fetched PAGE_WINDOW at a time and spooled to a temp file
+            async def get_page(url, allow_missing=False):
+                async with gitlab_semaphore:
+                    status, response_headers, body = await http_client.async_get(session, url, gitlab_headers)
+                if status == 404 and allow_missing:
+                    return status, response_headers, None
+                if status >= 400:
+                    raise RuntimeError(f"HTTP {status} from {url}")
+                if immutable and status == 200:
+                    http_client.store_immutable(url, gitlab_headers, response_headers, body)
+                return status, response_headers, json.loads(body)
+
+            status, response_headers, changes = await get_page(gitlab_diffs.diffs_page_url(api_url, 1), allow_missing=True)
+            if status == 404:
+                #Older Gitlab without /diffs
+                return (await get_page(f"{api_url}/changes"))[2]["changes"]
+            spool = gitlab_diffs.ChangeSpool()
+            spool.extend(changes)
+            total_pages = response_headers.get("X-Total-Pages")
+            if total_pages:
+                for start in range(2, int(total_pages) + 1, gitlab_diffs.PAGE_WINDOW):
+                    window = range(start, min(start + gitlab_diffs.PAGE_WINDOW, int(total_pages) + 1))
+                    for _, _, page in await asyncio.gather(*(get_page(gitlab_diffs.diffs_page_url(api_url, page)) for page in window)):
+                        spool.extend(page)
+            else:
+                while response_headers.get("X-Next-Page"):
+                    _, response_headers, page = await get_page(gitlab_diffs.diffs_page_url(api_url, int(response_headers["X-Next-Page"])))
+                    spool.extend(page)
+            return iter(spool)
+
+        async def fetch_changes(epic_name, mr_url):
+            #Same steps as Fetch_MR_Changes
+            if state is not None and state.is_merged(epic_name, mr_url):
+                return None, state.get(epic_name, mr_url)
+            api_url = Get_MR_Api_Url(mr_url)
+            async with gitlab_semaphore:
+                status, response_headers, body = await http_client.async_get(session, api_url, gitlab_headers)
+            if status >= 400:
+                raise RuntimeError(f"HTTP {status} from {api_url}")
+            response_json = json.loads(body)
+            Record_Project_Id(mr_url, response_json)
+            info = sync_state.mr_info(response_json)
+            if state is not None and state.is_unchanged(epic_name, mr_url, info):
+                return None, info
+
+            merged = response_json.get("state") == "merged"
+            if merged:
+                http_client.store_immutable(api_url, gitlab_headers, response_headers, body)
+            if git_mirror.needs_mirror_for_count(response_json, MIRROR_THRESHOLD):
+                return await asyncio.to_thread(Get_MR_Changes_From_Mirror, mr_url, response_json["diff_refs"], gitlab_token), info
+            return await get_mr_diffs(api_url, merged), info
+
+        async def issue_status(key):
+            try:
+                async with jira_semaphore:
+                    status, _, _ = await http_client.async_get(session, f"{jira_base_url}/rest/api/2/issue/{key}?fields=key", jira_headers)
+                return status
+            except Exception:
+                return None
+
+        async def check_retry_keys(epic_name, output):
+            #Same steps as Check_Retry_Keys
+            if state is None or since is None:
+                return []
+            keys = state.failed_issues(epic_name)
+            statuses = dict(zip(keys, await asyncio.gather(*(issue_status(key) for key in keys))))
+            retry_keys, unchecked, dropped = sync_state.split_retry_keys(keys, statuses)
+            output.failed_issues.update(unchecked)
+            if dropped:
+                progress.log(colored(f"[!] {epic_name}: issues that failed on the last sync no longer exist or are not readable, not retried: {', '.join(dropped)}","yellow"))
+            return retry_keys
+
+        async def run_epic(jira_epic_link):
+            epic_name = jira_epic_link.split('/')[-1]
+            output = EpicOutput(epic_name, use_cas=use_cas, writer=writer)
+            jql_query = Get_Epic_JQL(epic_name, since, await check_retry_keys(epic_name, output))
+            issue_queue = asyncio.Queue(maxsize=queue_size)
+            pending_issues = asyncio.Queue(maxsize=queue_size)
+            mr_queue = asyncio.Queue(maxsize=queue_size)
+            pending_mrs = asyncio.Queue(maxsize=queue_size)
+            total_issues = 0
+
+            async def produce_issues():
+                try:
+                    fields = ",".join(EPIC_ISSUE_FIELDS if inline_comments and link_source != "links" else ["key"])
+                    start_at, next_page_token = 0, None
+                    while True:
+                        if server_info.get("deploymentType") == "Cloud":
+                            params = {"jql": jql_query, "maxResults": PAGE_SIZE, "fields": fields}
+                            if next_page_token:
+                                params["nextPageToken"] = next_page_token
+                            #API v2 like the jira library, v3 returns the comment bodies as ADF documents instead of text
+                            page = await get_json(f"{jira_base_url}/rest/api/2/search/jql?{urllib.parse.urlencode(params)}", jira_headers, jira_semaphore)
+                        else:
+                            params = {"jql": jql_query, "startAt": start_at, "maxResults": PAGE_SIZE, "fields": fields}
+                            page = await get_json(f"{jira_base_url}/rest/api/2/search?{urllib.parse.urlencode(params)}", jira_headers, jira_semaphore)
+
+                        issues = page.get("issues", [])
+                        for issue in issues:
+                            await issue_queue.put(issue)
+                        start_at += len(issues)
+                        next_page_token = page.get("nextPageToken")
+                        if not issues or (next_page_token is None and start_at >= page.get("total", 0)) or page.get("isLast", False):
+                            break
+                finally:
+                    await issue_queue.put(None)
+
+            async def extract_mr_urls():
+                nonlocal total_issues
+                try:
+                    while True:
+                        pending = await pending_issues.get()
+                        if pending is None:
+                            return
+                        issue, task = pending
+                        progress.issues_scanned += 1
+                        total_issues += 1
+                        try:
+                            mr_urls, errors = await task
+                        except Exception as e:
+                            output.failed_issues.add(issue["key"])
+                            progress.log(colored(f"ERROR: {issue['key']}: {e}","red"))
+                            continue
+                        for error in errors:
+                            output.failed_issues.add(issue["key"])
+                            progress.log(colored(f"ERROR: {error}","red"))
+                        for mr_url in mr_urls:
+                            mr_url = output.add_link(issue["key"], mr_url)
+                            if mr_url is not None:
+                                progress.mrs_found += 1
+                                await mr_queue.put(mr_url)
+                finally:
+                    await mr_queue.put(None)
+
+            async def write_changes():
+                while True:
+                    pending = await pending_mrs.get()
+                    if pending is None:
+                        return
+                    mr_url, task = pending
+                    progress.log(colored(f"\n[-] {mr_url}","magenta"))
+                    try:
+                        changes, info = await task
+                    except Exception as e:
+                        output.failed_mrs.add(mr_url)
+                        progress.log(colored(f"ERROR: {e}","red"))
+                        continue
+                    if changes is None:
+                        state.skipped += 1
+                        progress.log(colored("  --> Unchanged since the last sync, skipped","light_grey"))
+                        continue
+                    for written in output.write_changes(mr_url, changes, log=progress.log):
+                        progress.files_written += 1
+                        progress.bytes_written += written["bytes"]
+                    if state is not None:
+                        state.record(epic_name, mr_url, info)
+
+            async with epic_semaphore:
+                try:
+                    await asyncio.gather(
+                        produce_issues(),
+                        Fan_Out(issue_queue, pending_issues, resolve_issue),
+                        extract_mr_urls(),
+                        Fan_Out(mr_queue, pending_mrs, lambda mr_url: fetch_changes(epic_name, mr_url)),
+                        write_changes(),
+                    )
+                except Exception as e:
+                    progress.failed_epics.append(jira_epic_link)
+                    progress.log(colored(f"ERROR: {epic_name}: {e}","red"))
+                    return
+            progress.log(colored(f"\n[*] Total Issues in {epic_name}: {total_issues}","cyan"))
+            output.finish(log=progress.log)
+            if state is not None:
+                state.set_failed_issues(epic_name, output.failed_issue_keys())
+
+        reporter = asyncio.ensure_future(progress.run())
+        try:
+            await asyncio.gather(*(run_epic(jira_epic_link) for jira_epic_link in jira_epic_links))
+        finally:
+            reporter.cancel()
+            progress.draw()
+            print()
+
+    if len(jira_epic_links) > 1:
+        print(colored(f"\n[*] Epics: {len(jira_epic_links) - len(progress.failed_epics)} completed, {len(progress.failed_epics)} failed | Total Issues: {progress.issues_scanned}","cyan"))
+    if state is not None:
+        print(colored(f"[*] Unchanged MRs skipped: {state.skipped}","cyan"))
+    return progress
 
 
 def prechecks(GITLAB_BASE_URL, JIRA_BASE_URL,GITLAB_API_TOKEN,JIRA_API_TOKEN):
     #GIT TOKEN VERIFY
-    if GITLAB_BASE_URL:
+    if GITLAB_BASE_URL and metadata_cache.get_verified_token("gitlab", GITLAB_BASE_URL, GITLAB_API_TOKEN):
+        print(colored("[-] Gitlab Token validated recently (cached)","magenta"))
+    elif GITLAB_BASE_URL:
         gitVerifyURL = f"{GITLAB_BASE_URL}/api/v4/personal_access_tokens/self"
         headers = {"PRIVATE-TOKEN" : GITLAB_API_TOKEN}
-        res = requests.get(gitVerifyURL,headers=headers)
+        res = http_client.get(gitVerifyURL,headers=headers)
         if res.status_code != 200:
             exit(colored(f"[X] Gitlab Token is invalid: {res.status_code}","red"))
+        metadata_cache.record_verified_token("gitlab", GITLAB_BASE_URL, GITLAB_API_TOKEN)
         print(colored("[-] Gitlab Token successfully validated","magenta"))
     else:
         print(colored("[-] Gitlab Token verification Skipped as Gitlab Host (-gh) not provided","red"))
 
     #JIRA TOKEN VERIFY
+    cached = metadata_cache.get_verified_token("jira", JIRA_BASE_URL, JIRA_API_TOKEN)
+    if cached:
+        print(colored(f"[-] Jira Token validated recently (cached): {cached['user']}","magenta"))
+        return
     git_verify_url = f"{JIRA_BASE_URL}/rest/api/3/myself"
     headers = {"Authorization" : f"Bearer {JIRA_API_TOKEN}", "Accept": "application/json"}
-    res = requests.get(git_verify_url,headers=headers)
+    res = http_client.get(git_verify_url,headers=headers)
     if "X-AUSERNAME" in res.headers and res.headers["X-AUSERNAME"] == "anonymous":
         exit(colored(f"[X] Jira Token is invalid: {res.headers['X-AUSERNAME']}","red"))
+    metadata_cache.record_verified_token("jira", JIRA_BASE_URL, JIRA_API_TOKEN, user=res.headers['X-AUSERNAME'])
     print(colored(f"[-] Jira Token successfully validated: {res.headers['X-AUSERNAME']}","magenta"))
 
 def main():
     global GITLAB_API_TOKEN
     global JIRA_API_TOKEN
     global JIRA_BASE_URL
+    global WORKERS, EPIC_WORKERS, JIRA_SEMAPHORE, GITLAB_SEMAPHORE
+    global INLINE_COMMENTS, USE_CAS, LINK_SOURCE
+    global MIRROR_THRESHOLD, MIRROR_DIR
+    global SYNC_STATE, SYNC_SINCE
+    global OUTPUT_WRITER
 
     args = get_args()
-    JIRA_EPIC_URL = args.epic_url
+    if args.server:
+        code = download_server.submit(args.server, "jira", sys.argv[1:])
+        if code is not None:
+            exit(code)
+        print(colored(f"[!] No download server answering on {args.server}, running here","yellow"))
+    WORKERS = args.workers
+    EPIC_WORKERS = args.epic_workers
+    JIRA_SEMAPHORE = threading.BoundedSemaphore(args.jira_limit or WORKERS)
+    GITLAB_SEMAPHORE = threading.BoundedSemaphore(args.gitlab_limit or WORKERS)
+    INLINE_COMMENTS = not args.per_issue_fetch
+    LINK_SOURCE = args.link_source
+    USE_CAS = args.use_cas
+    MIRROR_THRESHOLD = args.mirror_threshold
+    MIRROR_DIR = args.mirror_dir
+    if args.state_file:
+        SYNC_STATE = sync_state.SyncState(args.state_file)
+    SYNC_SINCE = args.since or (SYNC_STATE.since() if SYNC_STATE is not None else None)
+    http_client.configure(pool_size=max(args.pool_size, WORKERS), max_retries=args.retries, cache_dir=None if args.no_cache else args.cache_dir)
+    metadata_cache.configure(None if args.no_cache else args.cache_dir)
+    if args.profile is not None:
+        profiler.enable()
     GITLAB_API_TOKEN = args.gitlab_token or os.getenv("GITLAB_API_TOKEN")
     JIRA_API_TOKEN =  args.jira_token or os.getenv("JIRA_API_TOKEN")
 
     #Jira Base URL
-    parsed_url = urlparse(JIRA_EPIC_URL)
-    JIRA_BASE_URL = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    if args.epic_jql:
+        JIRA_EPIC_URLS = []                                       #Filled from the JQL once the tokens are verified
+        JIRA_BASE_URL = args.jira_host.rstrip("/")
+    else:
+        JIRA_EPIC_URLS = [args.epic_url] if args.epic_url else batch_manifest.read_url_file(args.epic_url_file)
+        jira_base_urls = {f"{urlparse(url).scheme}://{urlparse(url).netloc}" for url in JIRA_EPIC_URLS}
+        if len(jira_base_urls) != 1:
+            exit(colored(f"[-] Error: Expected epic URLs from exactly one Jira host, got: {', '.join(sorted(jira_base_urls)) or 'none'}","red"))
+        JIRA_BASE_URL = jira_base_urls.pop()
 
     #Gitlab Base URL
     GITLAB_BASE_URL = None
@@ -205,8 +940,54 @@ def main():
 
     print("[-] " + colored("GET MERGE REQUESTS FROM JIRA EPIC",attrs=['bold','underline']) + " [-]",end="\n\n")
     prechecks(GITLAB_BASE_URL, JIRA_BASE_URL, GITLAB_API_TOKEN, JIRA_API_TOKEN)
-    jira_obj = Get_Jira_Object(JIRA_BASE_URL)
-    Get_All_Issues_From_Epic(jira_obj, JIRA_EPIC_URL)
+    if SYNC_SINCE is not None:
+        print(colored(f"[-] Incremental sync: only issues updated since {SYNC_SINCE.strftime(sync_state.JQL_TIME_FORMAT)}","magenta"))
+
+    jira_obj = None
+    if args.epic_jql:
+        jira_obj = Get_Jira_Object(JIRA_BASE_URL)
+        JIRA_EPIC_URLS = Get_Epic_Urls_From_JQL(jira_obj, args.epic_jql)
+        print(colored(f"[-] JQL matched {len(JIRA_EPIC_URLS)} epics","magenta"))
+
+    if args.output_format != "files":
+        OUTPUT_WRITER = output_formats.open_writer(args.output_format, args.output or output_formats.default_output_path(OUTPUT_FOLDER, "jira", args.output_format))
+
+    try:
+        if args.use_async:
+            progress = asyncio.run(Async_Get_All_Epics(JIRA_BASE_URL, JIRA_API_TOKEN, GITLAB_API_TOKEN, JIRA_EPIC_URLS,
+                                                       jira_limit=args.jira_limit or WORKERS, gitlab_limit=args.gitlab_limit or WORKERS,
+                                                       queue_size=args.queue_size, inline_comments=INLINE_COMMENTS, link_source=LINK_SOURCE, use_cas=USE_CAS,
+                                                       since=SYNC_SINCE, state=SYNC_STATE, epic_limit=EPIC_WORKERS, writer=OUTPUT_WRITER))
+            requests_saved, link_requests = progress.requests_saved, progress.link_requests
+            failed_epics = progress.failed_epics
+        else:
+            jira_obj = jira_obj or Get_Jira_Object(JIRA_BASE_URL)
+            failed_epics = Get_All_Epics(jira_obj, JIRA_EPIC_URLS)
+            requests_saved, link_requests = REQUESTS_SAVED, LINK_REQUESTS
+    finally:
+        if OUTPUT_WRITER is not None:
+            OUTPUT_WRITER.close()
+            print(colored(f"[*] {OUTPUT_WRITER.records} records ({OUTPUT_WRITER.bytes} bytes) written to {OUTPUT_WRITER.filepath}","cyan"))
+        if SYNC_STATE is not None:
+            print(colored(f"[*] Unchanged MRs skipped: {SYNC_STATE.skipped}","cyan"))
+    if SYNC_STATE is not None:
+        #A failed epic has to be looked at again from the old sync time
+        if failed_epics:
+            print(colored(f"[X] Sync state not saved, {len(failed_epics)} epics failed","red"))
+        else:
+            SYNC_STATE.save()
+            print(colored(f"[*] Sync state saved to {SYNC_STATE.filepath}","cyan"))
+            retries = sum(len(keys) for keys in SYNC_STATE.failed.values())
+            if retries:
+                print(colored(f"[!] {retries} issues with failed links/MRs will be retried on the next sync","yellow"))
+    if INLINE_COMMENTS and LINK_SOURCE != "links":
+        print(colored(f"[*] Jira Requests Saved (comments read inline from search): {requests_saved}","cyan"))
+    if LINK_SOURCE != "comments":
+        print(colored(f"[*] Jira Requests for remote links/development panel: {link_requests} (none with --link-source comments)","cyan"))
+    http_client.print_stats()
+    profiler.print_report()
+    if args.profile:
+        profiler.write_trace(args.profile)
     print("\n[+] " + colored("COMPLETED",attrs=['bold','underline']) + " [+]")
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+#Repository links of a Jira issue (Gitlab MRs, Github PRs, commits): read from the issue's remote links and the
+#development panel (dev-status), with a scan of the comment bodies as the fallback
+
+import re
+
+import url_utils
+
+
+#Any host, every match in a text, Ex: https://gitlab.host.com/group/sub/project/-/merge_requests/177,
+#https://github.host.com/org/repo/pull/12, .../-/commit/<sha>, .../commit/<sha>
+LINK_RE = re.compile(r"https?://[^\s|\[\]<>\"'()]+?/(?:-/)?(?:merge_requests/\d+|pull/\d+|commits?/[0-9a-f]{7,40})(?![0-9A-Za-z])")
+KIND_RE = re.compile(r"/(merge_requests|pull|commits?)/[^/]+$")
+KINDS = {"merge_requests": "merge_request", "pull": "pull_request", "commit": "commit", "commits": "commit"}
+
+LINK_SOURCES = ["links", "comments", "all"]
+DEV_STATUS_DATA_TYPE = "pullrequest"
+
+
+def scan_text(text):
+    #Every link in the text, in order, without duplicates
+    links = []
+    for match in LINK_RE.finditer(text or ""):
+        link = url_utils.normalize_url(match.group(0))
+        if link not in links:
+            links.append(link)
+    return links
+
+
+def link_kind(link):
+    #merge_request, pull_request or commit
+    match = KIND_RE.search(link)
+    return KINDS[match.group(1)] if match else None
+
+
+def merge_links(*link_lists):
+    links = []
+    for link_list in link_lists:
+        links.extend(link for link in link_list if link not in links)
+    return links
+
+
+def adf_text(node):
+    #Comment bodies of API v3 are ADF documents, their text and link targets, Ex: {"type": "text", "text": "...", "marks": [{"type": "link", "attrs": {"href": ...}}]}
+    if isinstance(node, str):
+        return node
+    if isinstance(node, list):
+        return " ".join(adf_text(child) for child in node)
+    if not isinstance(node, dict):
+        return ""
+    parts = [node.get("text") or ""]
+    parts.extend((mark.get("attrs") or {}).get("href") or "" for mark in node.get("marks") or [])
+    parts.append((node.get("attrs") or {}).get("url") or "")                  #inlineCard/blockCard
+    parts.append(adf_text(node.get("content") or []))
+    return " ".join(part for part in parts if part)
+
+
+def links_from_comments(issue_fields):
+    comments = ((issue_fields or {}).get("comment") or {}).get("comments", [])
+    return merge_links(*(scan_text(adf_text(comment.get("body"))) for comment in comments))
+
+
+def remote_links_url(jira_base_url, issue_key):
+    return f"{jira_base_url}/rest/api/2/issue/{issue_key}/remotelink"
+
+
+def links_from_remote_links(remote_links):
+    #[{"object": {"url": ..., "title": "GitLab: Mentioned on merge request !177"}, ...}]
+    return merge_links(*(scan_text((remote_link.get("object") or {}).get("url")) for remote_link in remote_links or []))
+
+
+def dev_status_summary_url(jira_base_url, issue_id):
+    return f"{jira_base_url}/rest/dev-status/latest/issue/summary?issueId={issue_id}"
+
+
+def dev_status_applications(summary):
+    #Integrations (Ex: GitLab, GitHub) with at least one pull/merge request on the issue, so only those are asked for details
+    by_instance = (((summary.get("summary") or {}).get(DEV_STATUS_DATA_TYPE) or {}).get("byInstanceType") or {})
+    return [application for application, details in by_instance.items() if (details or {}).get("count")]
+
+
+def dev_status_detail_url(jira_base_url, issue_id, application):
+    return f"{jira_base_url}/rest/dev-status/latest/issue/detail?issueId={issue_id}&applicationType={application}&dataType={DEV_STATUS_DATA_TYPE}"
+
+
+def links_from_dev_status(detail):
+    #{"detail": [{"pullRequests": [{"url": ..., "status": "MERGED"}, ...]}]}
+    return merge_links(*(scan_text(pull_request.get("url")) for item in detail.get("detail", []) for pull_request in item.get("pullRequests", [])))
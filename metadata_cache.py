@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+#Small persistent cache for per-host metadata that every run would otherwise ask for again:
+#which tokens were verified (for TOKEN_TTL) and the numeric ids of Gitlab projects
+
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import quote
+
+import http_client
+import http_cache
+
+
+TOKEN_TTL = 4 * 60 * 60                         #Seconds a verified token is trusted without asking the server again
+METADATA_FILE = "metadata.json"
+
+_LOCK = threading.Lock()
+_FILEPATH = None                                #None keeps the cache in memory for this run only (--no-cache)
+_DATA = {"tokens": {}, "projects": {}}
+
+
+def configure(cache_dir=http_cache.CACHE_DIR):
+    global _FILEPATH, _DATA
+    with _LOCK:
+        filepath = os.path.abspath(os.path.join(cache_dir, METADATA_FILE)) if cache_dir else None
+        if filepath == _FILEPATH and (_DATA["tokens"] or _DATA["projects"]):
+            return                              #Same cache again (the next job of download_server), what is in memory is current
+        _FILEPATH = filepath
+        _DATA = {"tokens": {}, "projects": {}}
+        if _FILEPATH and os.path.exists(_FILEPATH):
+            try:
+                with open(_FILEPATH, "r") as fileptr:
+                    _DATA.update(json.load(fileptr))
+            except (OSError, ValueError):
+                pass                            #A broken cache file is rebuilt on the next save
+
+
+def _save():
+    #Called with _LOCK held, through a temp file so concurrent runs never read half a file
+    if _FILEPATH is None:
+        return
+    os.makedirs(os.path.dirname(_FILEPATH), exist_ok=True)
+    tmp_path = f"{_FILEPATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fileptr:
+        json.dump(_DATA, fileptr, indent=2, sort_keys=True)
+    os.replace(tmp_path, _FILEPATH)
+
+
+def token_key(kind, base_url, token):
+    #Only a hash of the token is stored, Ex: gitlab|https://gitlab.host.com|3f1a...
+    return f"{kind}|{base_url}|{hashlib.sha256((token or '').encode()).hexdigest()[:32]}"
+
+
+def get_verified_token(kind, base_url, token):
+    #Returns what was recorded for a token verified less than TOKEN_TTL ago (Ex: {"user": "jdoe"}), else None
+    with _LOCK:
+        entry = _DATA["tokens"].get(token_key(kind, base_url, token))
+    if entry is None or entry["verified_at"] + TOKEN_TTL < time.time():
+        return None
+    return entry
+
+
+def record_verified_token(kind, base_url, token, **details):
+    #Only valid tokens are cached, a rejected token is checked again on every run
+    with _LOCK:
+        _DATA["tokens"][token_key(kind, base_url, token)] = dict(details, verified_at=time.time())
+        _save()
+
+
+def get_project_id(base_url, project_path):
+    with _LOCK:
+        return _DATA["projects"].get(f"{base_url}|{project_path}")
+
+
+def record_project_id(base_url, project_path, project_id):
+    if project_id is None:
+        return
+    key = f"{base_url}|{project_path}"
+    with _LOCK:
+        if _DATA["projects"].get(key) == project_id:
+            return
+        _DATA["projects"][key] = project_id
+        _save()
+
+
+def project_ref(base_url, project_path):
+    #Numeric id when known, else the URL-encoded path, both are accepted wherever the Gitlab API takes :id
+    return str(get_project_id(base_url, project_path) or quote(project_path, safe=""))
+
+
+def resolve_project_id(base_url, project_path, headers):
+    #One GET /projects/:path per project, later runs (and URLs of the same project) reuse the cached id
+    project_id = get_project_id(base_url, project_path)
+    if project_id is None:
+        response = http_client.get(f"{base_url}/api/v4/projects/{quote(project_path, safe='')}", headers=headers)
+        response.raise_for_status()
+        project_id = response.json()["id"]
+        record_project_id(base_url, project_path, project_id)
+    return project_id
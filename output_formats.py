@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+#Single-file output backends (--format): every changed file becomes one record appended to one JSONL/tar/zip/patch per run
+#Unlike the default "files" layout the +/- markers and removed lines are kept, so the output is lossless
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+import zipfile
+
+import profiler
+
+
+FORMATS = ["files", "jsonl", "tar", "zip", "patch"]
+EXTENSIONS = {"jsonl": ".jsonl.gz", "tar": ".tar.gz", "zip": ".zip", "patch": ".patch"}
+DEFAULT_MODE = "100644"
+
+
+def default_output_path(folder, name, output_format):
+    #Ex: results/gitlab-20240501-083000.jsonl.gz
+    return os.path.join(folder, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}{EXTENSIONS[output_format]}")
+
+
+def make_source(url, project, kind, ref, **extra):
+    #Where a change came from, Ex: (https://gitlab.host.com/group/project/-/merge_requests/177, group/project, merge_request, 177)
+    return dict({"source": url, "project": project, "type": kind, "id": str(ref)}, **extra)
+
+
+def get_hunks(change):
+    #Gitlab gives the diff as one string, the mirror and "diff --git" splitting give a list of lines
+    diff = change.get("diff") or ""
+    return diff if isinstance(diff, str) else "".join(diff)
+
+
+def count_lines(hunks):
+    added, removed = 0, 0
+    for line in hunks.splitlines():
+        if line.startswith("+"):
+            added += 1
+        elif line.startswith("-"):
+            removed += 1
+    return added, removed
+
+
+def make_record(source, change, hunks):
+    added, removed = count_lines(hunks)
+    return dict(source, **{
+        "old_path": change.get("old_path"),
+        "new_path": change.get("new_path"),
+        "new_file": bool(change.get("new_file")),
+        "deleted_file": bool(change.get("deleted_file")),
+        "renamed_file": bool(change.get("renamed_file")),
+        "hunks": hunks,
+        "added": added,
+        "removed": removed,
+    })
+
+
+def format_patch(change, hunks):
+    #One "diff --git" section, so a whole .patch file can be fed to "git apply"
+    old_path = change.get("old_path") or change.get("new_path")
+    new_path = change.get("new_path") or old_path
+    a_mode, b_mode = change.get("a_mode"), change.get("b_mode")
+    lines = [f"diff --git a/{old_path} b/{new_path}\n"]
+    if change.get("new_file"):
+        lines.append(f"new file mode {b_mode or DEFAULT_MODE}\n")
+    elif change.get("deleted_file"):
+        lines.append(f"deleted file mode {a_mode or DEFAULT_MODE}\n")
+    elif a_mode and b_mode and a_mode != b_mode:
+        lines.append(f"old mode {a_mode}\nnew mode {b_mode}\n")
+    if change.get("renamed_file") and old_path != new_path:
+        lines.append(f"rename from {old_path}\nrename to {new_path}\n")
+    if hunks:
+        lines.append("--- /dev/null\n" if change.get("new_file") else f"--- a/{old_path}\n")
+        lines.append("+++ /dev/null\n" if change.get("deleted_file") else f"+++ b/{new_path}\n")
+        lines.append(hunks if hunks.endswith("\n") else hunks + "\n")
+    return "".join(lines)
+
+
+class OutputWriter:
+    #Writes are appended under a lock, so one writer can be shared by parallel MR/epic workers
+    #Every format opens self.fileptr and implements append(name, data)
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.records = 0
+        self.bytes = 0
+        folder = os.path.dirname(filepath)
+        if folder != "":
+            os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def entry_name(source, change):
+        #Ex: group/project/merge_request-177/src/app.py.diff
+        path = change.get("new_path") or change.get("old_path")
+        return f"{source['project']}/{source['type']}-{source['id']}/{path}.diff"
+
+    def encode(self, source, change, hunks):
+        return format_patch(change, hunks).encode("utf-8")
+
+    def write(self, source, change):
+        #Returns the same {path, bytes, sha256} record as diff_utils.write_diff_file, path is "<output file>:<entry>"
+        name = self.entry_name(source, change)
+        data = self.encode(source, change, get_hunks(change))
+        with self.lock, profiler.span("write", f"{self.__class__.__name__} record", path=name, bytes=len(data)):
+            self.append(name, data)
+            self.records += 1
+            self.bytes += len(data)
+        return {"path": f"{self.filepath}:{name}", "bytes": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+
+    def close(self):
+        self.fileptr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class JsonlWriter(OutputWriter):
+    def __init__(self, filepath):
+        super().__init__(filepath)
+        self.fileptr = gzip.open(filepath, "wb")
+
+    def encode(self, source, change, hunks):
+        return (json.dumps(make_record(source, change, hunks), ensure_ascii=False) + "\n").encode("utf-8")
+
+    def append(self, name, data):
+        self.fileptr.write(data)
+
+
+class TarWriter(OutputWriter):
+    def __init__(self, filepath):
+        super().__init__(filepath)
+        self.fileptr = tarfile.open(filepath, "w|gz")             #Stream mode, the archive is only ever appended to
+
+    def append(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.fileptr.addfile(info, io.BytesIO(data))
+
+
+class ZipWriter(OutputWriter):
+    def __init__(self, filepath):
+        super().__init__(filepath)
+        self.fileptr = zipfile.ZipFile(filepath, "w", compression=zipfile.ZIP_DEFLATED)
+
+    def append(self, name, data):
+        self.fileptr.writestr(zipfile.ZipInfo(name, time.localtime()[:6]), data, compress_type=zipfile.ZIP_DEFLATED)
+
+
+class PatchWriter(OutputWriter):
+    def __init__(self, filepath):
+        super().__init__(filepath)
+        self.fileptr = open(filepath, "wb")
+
+    def append(self, name, data):
+        self.fileptr.write(data)
+
+
+WRITERS = {"jsonl": JsonlWriter, "tar": TarWriter, "zip": ZipWriter, "patch": PatchWriter}
+
+
+def open_writer(output_format, filepath):
+    #None for the default "files" layout
+    if output_format == "files":
+        return None
+    return WRITERS[output_format](filepath)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+#Opt-in (--profile) timing of every HTTP call and file write, reported per endpoint at the end of a run
+#and optionally exported as a Chrome trace (chrome://tracing, https://ui.perfetto.dev)
+
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from termcolor import colored
+
+
+ENABLED = False
+_EVENTS = []
+_EVENTS_LOCK = threading.Lock()
+_START = time.perf_counter()
+
+SHA_RE = re.compile(r'^[0-9a-f]{7,64}$')
+ISSUE_KEY_RE = re.compile(r'^[A-Z][A-Z0-9_]+-\d+$')
+COMPARE_RE = re.compile(r'^[0-9a-f]{7,64}\.{2,3}[0-9a-f]{7,64}$')        #Ex: /compare/<base>...<head>
+#Segments that are always followed by identifiers, Ex: /projects/group%2Fproject, /repos/org/repo
+PLACEHOLDERS_AFTER = {"projects": (":project",), "files": (":path",), "issue": (":key",), "repos": (":owner", ":repo")}
+
+
+def enable():
+    global ENABLED, _START
+    ENABLED = True
+    _START = time.perf_counter()
+
+
+def reset():
+    #Profiling off and no events, for the next run in the same process (download_server jobs)
+    global ENABLED
+    ENABLED = False
+    with _EVENTS_LOCK:
+        _EVENTS.clear()
+
+
+def endpoint_template(method, url):
+    #GET https://gitlab.host.com/api/v4/projects/group%2Fproject/merge_requests/177/changes?x=1
+    # -> GET gitlab.host.com/api/v4/projects/:project/merge_requests/:id/changes
+    parsed_url = urlparse(url)
+    template, pending = [], []
+    for segment in parsed_url.path.split("/"):
+        if pending and segment:
+            template.append(pending.pop(0))
+        elif segment.isdigit():
+            template.append(":id")
+        elif SHA_RE.match(segment) and any(char.isdigit() for char in segment):
+            template.append(":sha")
+        elif ISSUE_KEY_RE.match(segment):
+            template.append(":key")
+        elif COMPARE_RE.match(segment):
+            template.append(":base...:head")
+        else:
+            template.append(segment)
+            pending = list(PLACEHOLDERS_AFTER.get(segment, ()))
+    return f"{method} {parsed_url.netloc}{'/'.join(template)}"
+
+
+def add_event(category, name, start, duration, args):
+    with _EVENTS_LOCK:
+        _EVENTS.append({"cat": category, "name": name, "start": start - _START, "dur": duration,
+                        "tid": threading.get_ident(), "args": args})
+
+
+def record_http(method, url, start, status, nbytes=0, retries=0, cached=False):
+    #status is None for calls that failed without a response (connection errors after the last retry)
+    if not ENABLED:
+        return
+    name = endpoint_template(method, url) + (" [cache]" if cached else "")
+    add_event("http", name, start, time.perf_counter() - start,
+              {"url": url, "status": status, "bytes": nbytes, "retries": retries})
+
+
+def response_hook(response, *args, **kwargs):
+    #requests session hook, for sessions not owned by http_client (Ex: the jira library's)
+    #Only the time to the response headers is known here
+    latency = response.elapsed.total_seconds()
+    record_http(response.request.method, response.url, time.perf_counter() - latency, response.status_code,
+                int(response.headers.get("Content-Length", 0) or 0))
+
+
+@contextlib.contextmanager
+def span(category, name, **args):
+    #Ex: with profiler.span("write", "diff file", path=filepath) as args: ...; args["bytes"] = written
+    if not ENABLED:
+        yield args
+        return
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        add_event(category, name, start, time.perf_counter() - start, args)
+
+
+def percentile(values, pct):
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def print_report():
+    if not ENABLED:
+        return
+    with _EVENTS_LOCK:
+        events = list(_EVENTS)
+
+    groups = defaultdict(list)
+    for event in events:
+        groups[(event["cat"], event["name"])].append(event)
+
+    print(colored("\n[*] Profile (times in ms, sorted by total)","cyan"))
+    header = f"{'endpoint / operation':<84}{'count':>7}{'total':>10}{'p50':>8}{'p95':>8}{'max':>8}{'MB':>8}{'retries':>8}{'errors':>7}"
+    print(colored(header,"yellow"))
+    rows = sorted(groups.items(), key=lambda item: -sum(event["dur"] for event in item[1]))
+    for (category, name), group in rows:
+        durations = sorted(event["dur"] * 1000 for event in group)
+        megabytes = sum(event["args"].get("bytes", 0) or 0 for event in group) / 1024 / 1024
+        retries = sum(event["args"].get("retries", 0) for event in group)
+        errors = sum(1 for event in group if event["cat"] == "http" and (event["args"]["status"] is None or event["args"]["status"] >= 400))
+        label = name if len(name) <= 82 else name[:name.index(" ") + 1] + "..." + name[-(78 - name.index(" ")):]
+        print(f"{label:<84}{len(group):>7}{sum(durations):>10.0f}{percentile(durations, 50):>8.1f}{percentile(durations, 95):>8.1f}"
+              f"{durations[-1]:>8.1f}{megabytes:>8.2f}{retries:>8}{errors:>7}")
+
+
+def write_trace(filepath):
+    #Chrome trace event format, one complete ("X") event per HTTP call/file write, one row per thread
+    with _EVENTS_LOCK:
+        events = list(_EVENTS)
+    pid = os.getpid()
+    trace_events = [{"name": event["name"], "cat": event["cat"], "ph": "X", "pid": pid, "tid": event["tid"],
+                     "ts": round(event["start"] * 1e6), "dur": round(event["dur"] * 1e6), "args": event["args"]} for event in events]
+    folder = os.path.dirname(filepath)
+    if folder != "":
+        os.makedirs(folder, exist_ok=True)
+    with open(filepath, "w") as fileptr:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, fileptr)
+    print(colored(f"[*] Trace with {len(trace_events)} events written to {filepath}","cyan"))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+#State file for incremental epic syncs: when the epics were last synced and the head SHA of every MR written so far
+
+import json
+import os
+from datetime import datetime, timedelta
+
+
+JQL_TIME_FORMAT = "%Y/%m/%d %H:%M"
+#Jira compares "updated" in the Jira user's timezone, not ours, so the stored sync time is moved back by this much
+SYNC_OVERLAP = timedelta(days=1)
+
+
+def parse_since(value):
+    #"2024-05-01", "2024-05-01 08:30" or "2024-05-01T08:30:00+02:00"
+    try:
+        return datetime.fromisoformat(value.replace("/", "-"))
+    except ValueError:
+        raise ValueError(f"Invalid date {value!r}, expected YYYY-MM-DD or YYYY-MM-DD HH:MM")
+
+
+def jql_since_clause(since, retry_keys=()):
+    #Issues that failed on the last sync are listed again even if they were not updated since
+    if since is None:
+        return ""
+    clause = f'updated >= "{since.strftime(JQL_TIME_FORMAT)}"'
+    if retry_keys:
+        clause = f'({clause} OR key in ({", ".join(sorted(retry_keys))}))'
+    return f" AND {clause}"
+
+
+def split_retry_keys(keys, statuses):
+    #statuses: issue key -> HTTP status of GET /issue/<key>, None when it could not be asked
+    #Returns (issues to list again, issues left for the next sync, issues dropped): a deleted or no longer readable issue
+    #would make Jira reject the whole "key in (...)" query, so those are dropped instead of failing every later sync
+    retry, unchecked, dropped = [], [], []
+    for key in keys:
+        status = statuses.get(key)
+        if status in (401, 403, 404):
+            dropped.append(key)
+        elif status is not None and status < 400:
+            retry.append(key)
+        else:
+            unchecked.append(key)
+    return retry, unchecked, dropped
+
+
+def mr_info(response_json):
+    #The fields of a Gitlab MR (GET /merge_requests/:iid or /changes) that tell whether it changed
+    return {"sha": response_json.get("sha"), "updated_at": response_json.get("updated_at"), "state": response_json.get("state")}
+
+
+class SyncState:
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.started = datetime.now().astimezone()
+        self.last_sync = None
+        self.mrs = {}                                   #epic name -> {normalized MR URL -> {sha, updated_at, state}}
+        self.failed = {}                                #epic name -> issue keys whose links or MRs failed, retried next run
+        self.skipped = 0
+        if os.path.exists(filepath):
+            with open(filepath, "r") as fileptr:
+                data = json.load(fileptr)
+            if data.get("last_sync"):
+                self.last_sync = datetime.fromisoformat(data["last_sync"])
+            self.mrs = data.get("merge_requests", {})
+            self.failed = data.get("failed_issues", {})
+
+    def since(self):
+        return self.last_sync - SYNC_OVERLAP if self.last_sync else None
+
+    #MRs are tracked per epic, an MR linked from two epics is written into both epic folders
+    def get(self, epic_name, mr_url):
+        return self.mrs.get(epic_name, {}).get(mr_url)
+
+    def is_merged(self, epic_name, mr_url):
+        #Merged MRs can never change again, so they are skipped without even asking Gitlab
+        return (self.get(epic_name, mr_url) or {}).get("state") == "merged"
+
+    def is_unchanged(self, epic_name, mr_url, info):
+        recorded = self.get(epic_name, mr_url)
+        return recorded is not None and info.get("sha") is not None and recorded.get("sha") == info["sha"]
+
+    def record(self, epic_name, mr_url, info):
+        self.mrs.setdefault(epic_name, {})[mr_url] = info
+
+    def failed_issues(self, epic_name):
+        return self.failed.get(epic_name, [])
+
+    def set_failed_issues(self, epic_name, issue_keys):
+        #Replaces the epic's list: retried issues that went through this time are dropped from it
+        if issue_keys:
+            self.failed[epic_name] = sorted(issue_keys)
+        else:
+            self.failed.pop(epic_name, None)
+
+    def save(self):
+        #Only called after a completed run, through a temp file so an interrupted save keeps the previous state
+        folder = os.path.dirname(self.filepath)
+        if folder != "":
+            os.makedirs(folder, exist_ok=True)
+        tmp_path = f"{self.filepath}.tmp"
+        with open(tmp_path, "w") as fileptr:
+            json.dump({"last_sync": self.started.isoformat(timespec="seconds"), "merge_requests": self.mrs, "failed_issues": self.failed},
+                      fileptr, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.filepath)
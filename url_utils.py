@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+#Helpers for the Gitlab/Github/Jira web URLs handed to the downloader scripts
+
+import re
+from urllib.parse import urlparse, urlunparse
+
+
+#Tabs of an MR/PR page point to the same MR/PR (Ex: .../merge_requests/177/diffs, .../pull/12/files)
+TAB_SUFFIX_RE = re.compile(r"(/(?:merge_requests|pull|pulls)/\d+)/(?:diffs|commits|pipelines|files|checks)$")
+
+
+def normalize_url(url):
+    #Same MR/PR/commit linked in different ways should map to one key: no query/fragment, no tab, no trailing slash
+    parsed = urlparse(url.strip())
+    path = TAB_SUFFIX_RE.sub(r"\1", parsed.path.rstrip("/"))
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), path, "", "", ""))
+
+
+#Project paths can be nested any number of groups deep, Ex: /group/subgroup/project/-/merge_requests/177
+GITLAB_RESOURCE_RE = re.compile(r"^/(?P<project>.+?)(?:/-)?/(?P<kind>merge_requests|commit|commits)/(?P<ref>[^/]+)")
+
+
+def parse_gitlab_url(url):
+    #https://gitlab.host.com/group/subgroup/project/-/merge_requests/177/diffs?x=1
+    # -> (https://gitlab.host.com, group/subgroup/project, merge_requests, 177)
+    parsed = urlparse(url.strip())
+    match = GITLAB_RESOURCE_RE.match(parsed.path)
+    if match is None:
+        raise ValueError(f"Not a Gitlab merge request or commit URL: {url}")
+    return f"{parsed.scheme}://{parsed.netloc}", match.group("project"), match.group("kind"), match.group("ref")